@@ -0,0 +1,388 @@
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from helpers import BitMapHelper
+from hbdisk import HbDisk, HbFolder
+
+# 结果超过基线这个比例就算退化
+DEFAULT_THRESHOLD = 0.2
+# 每轮测量至少累计这么多秒，耗时很短的操作要重复多次取平均，否则结果只是抖动
+DEFAULT_MIN_TIME = 0.2
+# 和基线比较时有指标退化，最多重新测试几次
+DEFAULT_RETRIES = 2
+MB = 1024 * 1024
+minTime = DEFAULT_MIN_TIME
+
+
+# 记录一项指标。better为"higher"表示越大越好（吞吐量），"lower"表示越小越好（耗时）。同一项测了多次时保留最好的结果
+class Results:
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, name: str, value: float, unit: str, better: str):
+        old = self.metrics.get(name)
+        if old is None or (value > old["value"] if better == "higher" else value < old["value"]):
+            self.metrics[name] = {"value": round(value, 6), "unit": unit, "better": better}
+        print("%-48s %14.3f %s" % (name, value, unit), flush=True)
+
+
+# 测量fn每次调用的耗时（秒）。每轮反复调用fn，直到累计的耗时达到minTime，取平均；共repeat轮，取最快的一轮。
+# 给出setup时每次调用前先调用setup（不计时），结果作为fn的参数
+def bestOf(repeat: int, fn, setup=None):
+    best = None
+    for _ in range(repeat):
+        used = 0.0
+        calls = 0
+        while calls == 0 or used < minTime:
+            arg = setup() if setup is not None else None
+            start = time.perf_counter()
+            fn(arg) if setup is not None else fn()
+            used += time.perf_counter() - start
+            calls += 1
+        best = used / calls if best is None else min(best, used / calls)
+    return best
+
+
+def newMemoryDisk(sizeMB: int, inodeCount: int = 1024):
+    return HbDisk(sizeMB * 512 + 64, inodeCount, "bench")
+
+
+# 建立在当前目录下的空间文件上，和服务器一样使用mmap和元数据日志
+def newImageDisk(name: str, sizeMB: int, inodeCount: int = 1024):
+    return HbDisk(sizeMB * 512 + 64, inodeCount, name, writer=open(name + ".hbdk", "xb+"))
+
+
+# image为True时在空间文件上测试，指标名中加上image
+def benchFileThroughput(results: Results, sizes, repeat: int, image=False):
+    rnd = random.Random(1)
+    prefix = "file.image" if image else "file"
+    for sizeMB in sizes:
+        disk = newImageDisk("file%d" % sizeMB, sizeMB * 2 + 8) if image else newMemoryDisk(sizeMB * 2 + 8)
+        root = HbFolder(disk, "", disk.rootInode)
+        data = rnd.randbytes(sizeMB * MB)
+        file = root.createFile("seq")
+
+        def writeAll():
+            file.write(data, True)
+
+        used = bestOf(repeat, writeAll)
+        results.add("%s.seqWrite.%dMB" % (prefix, sizeMB), sizeMB / used, "MB/s", "higher")
+        buffer = bytearray(sizeMB * MB)
+
+        def readAll():
+            file.readIntoAt(0, memoryview(buffer))
+
+        used = bestOf(repeat, readAll)
+        assert buffer == data
+        results.add("%s.seqRead.%dMB" % (prefix, sizeMB), sizeMB / used, "MB/s", "higher")
+
+        # 4KB随机读写
+        opCount = 2000
+        offsets = [rnd.randrange(0, sizeMB * MB - 4096) for _ in range(opCount)]
+        chunk = rnd.randbytes(4096)
+
+        def randomWrite():
+            for offset in offsets:
+                file.seek(offset)
+                file.write(chunk)
+
+        used = bestOf(repeat, randomWrite)
+        results.add("%s.randWrite4K.%dMB" % (prefix, sizeMB), opCount / used, "ops/s", "higher")
+        view = memoryview(bytearray(4096))
+
+        def randomRead():
+            for offset in offsets:
+                file.readIntoAt(offset, view)
+
+        used = bestOf(repeat, randomRead)
+        results.add("%s.randRead4K.%dMB" % (prefix, sizeMB), opCount / used, "ops/s", "higher")
+        if image:
+            disk.saveToDisk()
+
+
+def benchResize(results: Results, sizeMB: int, repeat: int):
+    disk = newMemoryDisk(sizeMB + 8)
+    root = HbFolder(disk, "", disk.rootInode)
+    file = root.createFile("resize")
+
+    def emptyFile():
+        file.resize(0)
+        return file
+
+    # resize变大只留下空洞，要截断的块需要先分配好。数据不影响截断，不用真正写入
+    def fullFile():
+        file.resize(sizeMB * MB)
+        file.fillHoles(0, sizeMB * MB)
+        return file
+
+    # 在远超文件尾的位置写一个字节，只分配写到的那一块
+    def sparseWrite(f):
+        f.seek(sizeMB * MB)
+        f.write(b"x")
+
+    used = bestOf(repeat, lambda f: f.resize(sizeMB * MB), emptyFile)
+    results.add("resize.grow.%dMB" % sizeMB, used * 1000, "ms", "lower")
+    used = bestOf(repeat, lambda f: f.resize(0), fullFile)
+    results.add("resize.truncate.%dMB" % sizeMB, used * 1000, "ms", "lower")
+    used = bestOf(repeat, sparseWrite, emptyFile)
+    results.add("resize.sparseWrite.%dMB" % sizeMB, used * 1000, "ms", "lower")
+
+
+# 只在内存中读写的存储，给BitMapHelper单独测试用
+class MemoryStore:
+    def __init__(self, size: int):
+        self.content = bytearray(size)
+
+    def readAt(self, ptr: int, length: int):
+        return bytes(self.content[ptr:ptr + length])
+
+    def writeAt(self, ptr: int, content):
+        self.content[ptr:ptr + len(content)] = content
+
+
+def benchBitmap(results: Results, bitCount: int, repeat: int):
+    rnd = random.Random(2)
+    byteCount = bitCount // 8
+    opCount = 20000
+
+    # 几乎占满的位图：每个字节中只有极少数位是空闲的
+    def setup():
+        store = MemoryStore(byteCount)
+        store.content[:] = b"\xff" * byteCount
+        for bitId in rnd.sample(range(bitCount), bitCount // 1000):
+            store.content[bitId >> 3] &= ~(128 >> (bitId & 7)) & 255
+        return BitMapHelper(store, 0, byteCount)
+
+    def allocAndFree(helper: BitMapHelper):
+        for _ in range(opCount):
+            helper.setZero(helper.allocZero())
+
+    used = bestOf(repeat, allocAndFree, setup)
+    results.add("bitmap.allocZeroSetZero.%dbits" % bitCount, opCount / used, "pairs/s", "higher")
+
+    def allocRun(helper: BitMapHelper):
+        for _ in range(opCount // 10):
+            helper.allocRun(1)
+
+    used = bestOf(repeat, allocRun, setup)
+    results.add("bitmap.allocRun.%dbits" % bitCount, opCount // 10 / used, "ops/s", "higher")
+
+
+def benchFolder(results: Results, counts, repeat: int):
+    for count in counts:
+        names = ["file%06d.txt" % i for i in range(count)]
+
+        def setup():
+            disk = newMemoryDisk(16 + count // 256, count + 16)
+            return HbFolder(disk, "", disk.rootInode)
+
+        def create(folder: HbFolder):
+            for name in names:
+                folder.createFile(name)
+
+        used = bestOf(repeat, create, setup)
+        results.add("folder.create.%d" % count, count / used, "ops/s", "higher")
+        folder = setup()
+        create(folder)
+
+        def lookup():
+            for name in names:
+                folder.findFileEntry(name)
+
+        used = bestOf(repeat, lookup)
+        results.add("folder.lookup.%d" % count, count / used, "ops/s", "higher")
+
+        def delete(folder: HbFolder):
+            for name in names:
+                folder.deleteSubFile(name)
+
+        def filledFolder():
+            folder = setup()
+            create(folder)
+            return folder
+
+        used = bestOf(repeat, delete, filledFolder)
+        results.add("folder.delete.%d" % count, count / used, "ops/s", "higher")
+
+
+# 在磁盘上建立一个大空间文件，测量重新打开、挂载并读出根目录的时间
+def benchMount(results: Results, sizeMB: int, fileCount: int, repeat: int):
+    name = "mount%d" % sizeMB
+    disk = HbDisk(sizeMB * 512, fileCount + 16, name, writer=open(name + ".hbdk", "xb+"))
+    root = HbFolder(disk, "", disk.rootInode)
+    for i in range(fileCount):
+        root.createFile("f%d" % i).write(b"x" * 3000)
+    disk.saveToDisk()
+    path = name + ".hbdk"
+
+    def openOnly():
+        d = HbDisk(fileSize=os.path.getsize(path), reader=open(path, "rb+"))
+        d.saveToDisk()
+
+    def openAndMount():
+        d = HbDisk(fileSize=os.path.getsize(path), reader=open(path, "rb+"))
+        HbFolder(d, "", d.rootInode)
+        d.saveToDisk()
+
+    results.add("mount.open.%dMB" % sizeMB, bestOf(repeat, openOnly) * 1000, "ms", "lower")
+    results.add("mount.full.%dMB" % sizeMB, bestOf(repeat, openAndMount) * 1000, "ms", "lower")
+
+
+# 用Flask测试客户端测量接口的端到端延迟（中位数）
+def benchServer(results: Results, repeat: int):
+    try:
+        import server
+        from manager import StorageManager
+    except ImportError as e:
+        print("跳过server测试：%s" % e)
+        return
+    server.storageMgr = StorageManager([])
+    client = server.app.test_client()
+    client.post("/create_disk", json={"size": 64, "diskName": "benchServer"})
+    client.post("/goto", json={"directory": ["benchServer"]})
+    for i in range(200):
+        client.post("/create_file", json={"fileName": "f%d" % i})
+    data = random.Random(3).randbytes(4 * MB)
+    client.post("/upload", data={"file": (io.BytesIO(data), "big.bin")}, content_type="multipart/form-data")
+    client.post("/create_file", json={"fileName": "text.txt"})
+    textPath = client.post("/open_file", json={"fileName": "text.txt"}).get_json()["data"]["filePath"]
+    client.post("/write_from_start", json={"filePath": textPath, "content": "hello world\n" * 1000})
+    bigPath = client.post("/open_file", json={"fileName": "big.bin"}).get_json()["data"]["filePath"]
+    counter = [0]
+
+    def createAndDelete():
+        counter[0] += 1
+        name = "tmp%d" % counter[0]
+        client.post("/create_file", json={"fileName": name})
+        client.post("/delete", json={"fileName": name, "fileType": 0})
+
+    cases = [
+        ("update_file_list", lambda: client.get("/update_file_list")),
+        ("read_all", lambda: client.post("/read_all", json={"filePath": textPath})),
+        ("read_range", lambda: client.post("/read_range", json={"filePath": textPath, "offset": 100, "length": 200})),
+        ("download4MB", lambda: client.get("/download/" + bigPath).get_data()),
+        ("downloadRange64K", lambda: client.get("/download/" + bigPath, headers={"Range": "bytes=0-65535"}).get_data()),
+        ("createAndDelete", createAndDelete),
+    ]
+    for name, fn in cases:
+        samples = []
+        # 每个请求都很快，样本要足够多中位数才稳定
+        while len(samples) < max(repeat * 10, 20) or sum(samples) < minTime * repeat:
+            start = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - start)
+        samples.sort()
+        results.add("server.%s" % name, samples[len(samples) // 2] * 1000, "ms", "lower")
+
+
+# 和基线比较，返回退化的指标列表
+def compare(metrics: dict, baseline: dict, threshold: float):
+    regressions = []
+    print("\n%-48s %12s %12s %9s" % ("指标", "基线", "本次", "变化"))
+    for name, metric in metrics.items():
+        base = baseline.get(name)
+        if base is None or base["value"] == 0:
+            continue
+        change = metric["value"] / base["value"] - 1
+        # 统一成正数表示变好
+        better = change if metric["better"] == "higher" else -change
+        mark = ""
+        if better < -threshold:
+            mark = "  退化"
+            regressions.append(name)
+        print("%-48s %12.3f %12.3f %+8.1f%%%s" % (name, base["value"], metric["value"], better * 100, mark))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="hbdisk存储引擎和HTTP接口的性能测试")
+    parser.add_argument("--quick", action="store_true", help="只跑较小的规模，用于快速检查")
+    parser.add_argument("--output", help="把结果以JSON写入这个文件")
+    parser.add_argument("--baseline", help="与这个JSON结果文件比较")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="超过这个比例的变差算作退化")
+    parser.add_argument("--only", help="只跑名字以这些前缀开头的测试，用逗号分隔，如file,bitmap")
+    parser.add_argument("--repeat", type=int, default=3, help="每项测试重复的轮数，取最好的一轮")
+    parser.add_argument("--min-time", type=float, default=DEFAULT_MIN_TIME, help="每轮测量至少累计的秒数")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES, help="有指标退化时重新测试的次数")
+    args = parser.parse_args()
+    global minTime
+    minTime = args.min_time
+
+    quick = args.quick
+    suites = [
+        ("file", lambda r: benchFileThroughput(r, [1, 8] if quick else [1, 16, 64], args.repeat)),
+        ("file", lambda r: benchFileThroughput(r, [1, 8] if quick else [1, 16, 64], args.repeat, True)),
+        ("resize", lambda r: benchResize(r, 16 if quick else 256, args.repeat)),
+        ("bitmap", lambda r: benchBitmap(r, 1 << 20 if quick else 1 << 23, args.repeat)),
+        ("folder", lambda r: benchFolder(r, [1000, 10000] if quick else [1000, 10000, 100000], args.repeat)),
+        ("mount", lambda r: benchMount(r, 64 if quick else 1024, 1000 if quick else 10000, args.repeat)),
+        ("server", lambda r: benchServer(r, args.repeat)),
+    ]
+    only = args.only.split(",") if args.only else None
+    results = Results()
+    workDir = tempfile.TemporaryDirectory()
+    oldDir = os.getcwd()
+    # 测试中建立的空间文件都放在临时目录里
+    os.chdir(workDir.name)
+    try:
+        for name, suite in suites:
+            if only is None or any(name.startswith(prefix) for prefix in only):
+                suite(results)
+    finally:
+        os.chdir(oldDir)
+        workDir.cleanup()
+
+    # 在新的进程中重新跑names中的测试，结果合并进results
+    def rerun(names):
+        print("\n重新测试：%s" % ", ".join(sorted(names)), flush=True)
+        with tempfile.TemporaryDirectory() as tempDir:
+            output = os.path.join(tempDir, "rerun.json")
+            command = [sys.executable, os.path.abspath(__file__), "--only", ",".join(sorted(names)),
+                       "--output", output, "--repeat", str(args.repeat), "--min-time", str(minTime)]
+            subprocess.run(command + (["--quick"] if quick else []), check=True)
+            with open(output) as f:
+                for name, metric in json.load(f)["results"].items():
+                    results.add(name, metric["value"], metric["unit"], metric["better"])
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results.metrics, baseline, args.threshold)
+        # 共享的机器上整体变慢可以持续很久，同一个进程中的结果也会一直偏低。
+        # 退化的指标所在的测试在新的进程中再跑几遍，取最好的结果，仍然退化才算数
+        for _ in range(args.retries):
+            if len(regressions) == 0:
+                break
+            rerun({name.split(".")[0] for name in regressions})
+            regressions = compare(results.metrics, baseline, args.threshold)
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "quick": quick,
+            "repeat": args.repeat,
+            "minTime": minTime
+        },
+        "results": results.metrics
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    if len(regressions) > 0:
+        print("\n%d项指标退化：%s" % (len(regressions), ", ".join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
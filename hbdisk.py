@@ -1,111 +1,511 @@
+import hashlib
 import io
+import lzma
+import mmap
+import os
+import queue
 import struct
 import math
+import threading
+import weakref
+from contextlib import contextmanager
+from array import array
+from collections import deque, OrderedDict
 from typing import BinaryIO
-from helpers import BitMapHelper
+import metrics
+from helpers import JOURNAL_REVOKE, UNRESOLVED, BitMapHelper, BlockCache, BlockMap, MetaJournal, MetaOverlay, RWLock
 import time
+import traceback
+import zlib
+
+# mmap扩容时每次最多增长的字节数
+MMAP_GROW_STEP = 64 * 1024 * 1024
+# 非mmap模式下块缓存默认占用的内存（字节）
+DEFAULT_CACHE_SIZE = 16 * 1024 * 1024
+# 批量分配块时一次清零的最大块数
+ZERO_FILL_CHUNK = 1024
+# iterChunks默认每段的大小
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# writeFrom每次从流中读入并写入的大小
+DEFAULT_UPLOAD_CHUNK_SIZE = 1024 * 1024
+# inode缓存默认容量（个）
+DEFAULT_INODE_CACHE_SIZE = 16384
+# 元数据日志组提交的默认间隔（秒）和触发提交的批大小（字节）
+DEFAULT_JOURNAL_INTERVAL = 0.05
+DEFAULT_JOURNAL_BATCH_SIZE = 1024 * 1024
+# 日志文件超过这个大小时做一次检查点：把空间文件落盘后清空日志
+JOURNAL_CHECKPOINT_SIZE = 64 * 1024 * 1024
+# 扩展头占用空间名区域的最后64字节，空间名因此最长191字节。依次是魔数、正常关闭标志、块大小的以2为底的对数、
+# 新文件默认的压缩方式（在COMPRESSION_METHODS中的序号）、是否去重和压缩计数是否有效，其余保留。块大小为0表示旧空间文件，块大小为2048
+EXT_HEADER_PTR = 224
+EXT_HEADER_SIZE = 64
+EXT_HEADER_MAGIC = b"HBX1"
+EXT_HEADER_FORMAT = "4sBBBBB"
+# 压缩计数：所有压缩文件的原始长度之和、数据占用的块数。和GDT一样进日志，每个操作结束时写一次
+COMPRESSION_COUNTERS_PTR = EXT_HEADER_PTR + 16
+COMPRESSION_COUNTERS_FORMAT = "qq"
+MAX_DISK_NAME_LENGTH = EXT_HEADER_PTR - 33
+# 后台回收延迟删除的文件时，每次操作最多截掉的字节数
+RECLAIM_STEP = 65536 * 2048
+# 数据块大小：默认2048字节，建立空间时可以在1K到64K之间选择2的幂
+DEFAULT_BLOCK_SIZE = 2048
+MIN_BLOCK_SHIFT = 10
+MAX_BLOCK_SHIFT = 16
+# 支持的压缩方式，空字符串表示不压缩
+COMPRESSION_METHODS = ["", "zlib", "lzma"]
+# 压缩文件以簇为单位压缩，每簇包含的块数
+CLUSTER_BLOCKS = 16
+# 解压后的簇的缓存默认占用的内存（字节）
+DEFAULT_CLUSTER_CACHE_SIZE = 8 * 1024 * 1024
+# 去重区域紧接在数据块之后：每块2字节的额外引用数，再是每块8字节的内容哈希（0表示没有记录）
+MAX_EXTRA_REFS = 65535
+# 快照保存在空间文件旁边，文件名为"<空间文件名>.snap.<快照名>"
+SNAPSHOT_SEPARATOR = ".snap."
+# 建立快照和克隆时每次复制的最大字节数
+SNAPSHOT_COPY_CHUNK = 1024 * 1024
 
 
 def toBytes(v: int):
     return bytearray(struct.pack("q", v))
 
 
+# 位图的位顺序与BitMapHelper相同，每个字节的最高位在前
+def testBit(bits, i: int) -> bool:
+    return bits[i >> 3] & (128 >> (i & 7)) != 0
+
+
+def iterSetBits(bits, count: int):
+    for byteIndex, byte in enumerate(bits):
+        if byte == 0:
+            continue
+        for bit in range(8):
+            i = (byteIndex << 3) + bit
+            if byte & (128 >> bit) and i < count:
+                yield i
+
+
+def blocksToBitmap(blockIds, length: int) -> bytearray:
+    bits = bytearray(length)
+    for i in blockIds:
+        bits[i >> 3] |= 128 >> (i & 7)
+    return bits
+
+
+# 把升序的块号合并成(起始块号, 块数)的连续段
+def iterRuns(blockIds):
+    start = -1
+    length = 0
+    for i in blockIds:
+        if i == start + length:
+            length += 1
+            continue
+        if length > 0:
+            yield start, length
+        start, length = i, 1
+    if length > 0:
+        yield start, length
+
+
+# 把source中[ptr, ptr + length)复制到target的同一位置。系统支持时用copy_file_range，在支持共享数据的文件系统上不用真正复制。
+# source在这之前就结束时，剩下的部分保留target中原有的空洞（读出来是0）
+def copyRange(source: int, target: int, ptr: int, length: int):
+    end = ptr + length
+    while ptr < end:
+        n = min(SNAPSHOT_COPY_CHUNK, end - ptr)
+        copied = 0
+        if hasattr(os, "copy_file_range"):
+            try:
+                copied = os.copy_file_range(source, target, n, ptr, ptr)
+            except OSError:
+                copied = 0
+        if copied <= 0:
+            content = os.pread(source, n, ptr)
+            if len(content) == 0:
+                return
+            copied = os.pwrite(target, content, ptr)
+        ptr += copied
+
+
 class HbDisk:
     def __init__(self, dataBlockCount: int = 0, inodeCount: int = 0,
                  diskName: str = "",
                  fileSize: int = 0,
-                 reader: BinaryIO = None):
+                 reader: BinaryIO = None,
+                 useMmap: bool = True,
+                 cacheSize: int = DEFAULT_CACHE_SIZE,
+                 inodeCacheSize: int = DEFAULT_INODE_CACHE_SIZE,
+                 writer: BinaryIO = None,
+                 journal: bool = True,
+                 journalInterval: float = DEFAULT_JOURNAL_INTERVAL,
+                 journalBatchSize: int = DEFAULT_JOURNAL_BATCH_SIZE,
+                 blockSize: int = DEFAULT_BLOCK_SIZE,
+                 compression: str = "",
+                 dedup: bool = False,
+                 readOnly: bool = False,
+                 baseDisk: "HbDisk" = None):
         self.streamPtr = 0
+        # 计数，见metrics模块。lastAccessEnd用来判断一次访问是否跳过了位置（算作一次seek）
+        self.counters = metrics.newCounters()
+        self.lastAccessEnd = 0
+        # 元数据日志，只在空间建立在真实文件上时使用
+        self.journal = None
+        self.journalInterval = journalInterval
+        self.journalBatchSize = journalBatchSize
+        # 上次检查点以来作为元数据写进日志的数据块，释放时要在日志中撤销（见revokeBlocks）
+        self.journaledBlocks = set()
+        # 使用日志时，元数据的修改在日志提交之前只留在这里（预写）
+        self.overlay = None
+        # 每个线程当前所在操作的嵌套深度和收集到的元数据写入
+        self.opState = threading.local()
+        # mmap后端，为None时退回到普通文件对象读写
+        self.mm = None
+        self.mmView = None
+        self.mmSize = 0
+        # 块缓存，只在非mmap模式下使用
+        self.cache = None
+        # inode缓存：按inode号做LRU，另用弱引用表找回仍在使用中的INode
+        self.inodeCacheSize = inodeCacheSize
+        self.inodeCache: OrderedDict[int, INode] = OrderedDict()
+        self.inodeRefs = weakref.WeakValueDictionary()
         # 计算gdt表各参数位置
         self.gdtPtr = 0
         self.diskNameLenPtr = 32
         self.diskNamePtr = self.diskNameLenPtr + 1
         self.hasDiskFile = False
+        # 打开已有空间时块大小以扩展头中记录的为准
+        self.setBlockSize(blockSize if reader is None else DEFAULT_BLOCK_SIZE)
+        # 新建文件默认使用的压缩方式，打开已有空间时以扩展头为准
+        self.checkCompression(compression)
+        self.compression = compression if reader is None else ""
+        # 解压后的簇：(inode地址, 簇号) -> 整簇内容，按LRU淘汰
+        self.clusterCache: OrderedDict[tuple, bytes] = OrderedDict()
+        self.clusterCacheSize = DEFAULT_CLUSTER_CACHE_SIZE
+        self.clusterCacheLock = threading.Lock()
+        # 解压缓存的命中次数，只统计本次挂载以来的
+        self.compressionStats = {"cacheHits": 0, "cacheMisses": 0}
+        # 不以内联方式存放的压缩文件的原始长度之和、数据占用的块数，保存在扩展头之后（见saveCompressionCounters）。
+        # 旧空间文件中没有这两个计数，挂载时统计（见countCompressed）
+        self.compressedBytes = 0
+        self.compressedBlocks = 0
+        self.compressionCountersValid = reader is None
+        self.compressionDirty = False
+        # 是否对普通文件的整块数据去重，只能在建立空间时打开。引用数和哈希在挂载时读入内存
+        self.dedup = dedup and reader is None
+        self.extraRefs = None
+        # 被共用的块数和去重省下的块数（所有块的额外引用数之和），在setExtraRefs中随时更新
+        self.sharedBlocks = 0
+        self.savedBlocks = 0
+        self.blockHashes = None
+        self.dedupIndex = {}
+        # 快照以只读方式挂载，普通文件的数据块从建立快照的空间baseDisk中读，baseBits标出这些块
+        self.readOnly = readOnly
+        self.baseDisk = baseDisk
+        self.baseBits = None
+        # 所有快照引用的普通文件数据块，不能原地修改也不能真正释放（写时复制）。没有快照时为None
+        self.frozenBits = None
+        # 整个空间的读写锁：读操作共享，修改元数据的操作（见operation）独占
+        self.lock = RWLock()
+        # 保护mmap扩容、文件指针和inode缓存
+        self.mmLock = threading.Lock()
+        self.fileLock = threading.Lock()
+        self.inodeLock = threading.Lock()
+        self.fd = None
+        # 空闲计数只在内存中修改，每个操作结束时才写一次GDT
+        self.gdtDirty = False
+        # 上次是否正常关闭，没有正常关闭时挂载时要根据位图重新统计空闲计数
+        self.hasExtHeader = True
+        self.clean = False
+        self.needsRecount = False
+        # 延迟删除：目录项已经去掉、等待后台线程回收的(inode地址, 类型)
+        self.deleteQueue = queue.Queue()
+        self.deleteThread = None
+        self.deleteThreadLock = threading.Lock()
 
         if reader is not None:
             self.hasDiskFile = True
-            self.file = reader
+            self.setFile(reader)
             self.diskSize = fileSize
+            if useMmap:
+                self.openMmap()
+            if journal:
+                # 先重放上次没有做检查点的日志，再读GDT
+                self.openJournal()
             self.dataBlockCount, self.inodeCount, self.dataBlockLeft, self.inodeLeft = struct.unpack("qqqq",
-                                                                                                     self.read(32))
-            self.diskNameLength = self.read(1)[0]
-            self.diskName = self.read(self.diskNameLength).decode("utf-8")
-            blockBitMapLength = math.ceil(self.dataBlockCount / 8)
-            iNodeBitMapLength = math.ceil(self.inodeCount / 8)
+                                                                                                     self.readAt(0, 32))
+            self.diskNameLength = self.readAt(self.diskNameLenPtr, 1)[0]
+            self.diskName = bytes(self.readAt(self.diskNamePtr, self.diskNameLength)).decode("utf-8")
+            self.computeLayout()
+            self.loadExtHeader()
+            if baseDisk is not None:
+                self.baseBits = bytes(self.readAt(self.getImageSize(), math.ceil(self.dataBlockCount / 8)))
+            else:
+                self.loadSnapshots()
         else:
-            self.diskSize = 0
             self.dataBlockCount = dataBlockCount
             self.inodeCount = inodeCount
             self.dataBlockLeft = dataBlockCount
             self.inodeLeft = inodeCount
-            self.file = io.BytesIO()
-            # 初始化GDT
-            self.write(toBytes(dataBlockCount))
-            self.write(toBytes(inodeCount))
-            self.write(toBytes(dataBlockCount))
-            self.write(toBytes(inodeCount))
+            self.computeLayout()
+            if writer is not None:
+                # 直接建立稀疏文件：用truncate定下整个空间的大小，未写过的部分留作空洞
+                self.hasDiskFile = True
+                self.setFile(writer)
+                self.diskSize = self.getImageSize()
+                os.ftruncate(self.file.fileno(), self.diskSize)
+                if useMmap:
+                    self.openMmap()
+            else:
+                self.diskSize = 0
+                self.setFile(io.BytesIO())
+            # 初始化GDT，位图等其余部分本来就是0
+            self.saveDGT()
             # 初始化磁盘名
             encodedName = diskName.encode()
-            self.write(bytes([len(encodedName)]))
-            self.write(bytes(255))
-            self.seek(self.diskNamePtr)
-            self.write(encodedName)
+            if len(encodedName) > MAX_DISK_NAME_LENGTH:
+                raise Exception("空间名不得长于191。")
+            self.writeAt(self.diskNameLenPtr, bytes([len(encodedName)]) + encodedName)
             self.diskName = diskName
-            self.seek(self.diskNamePtr + 255)
-            # 初始化Block bitmap
-            blockBitMapLength = math.ceil(self.dataBlockCount / 8)
-            self.write(bytes(blockBitMapLength))
-            # 初始化Inode Bitmap
-            iNodeBitMapLength = math.ceil(self.inodeCount / 8)
-            self.write(bytes(iNodeBitMapLength))
-        # 计算4个表的起始地址
+            self.saveExtHeader()
+            if writer is not None and journal:
+                self.openJournal()
+        blockBitMapLength = math.ceil(self.dataBlockCount / 8)
+        iNodeBitMapLength = math.ceil(self.inodeCount / 8)
+
+        # mmap本身就由系统页缓存支撑，不需要再加一层缓存
+        if self.mm is None and cacheSize > 0:
+            self.cache = BlockCache(self.rawRead, self.rawWrite, cacheSize, self.blockSize, self.dataTablePtr)
+        if self.journal is not None:
+            self.overlay = MetaOverlay(self.blockSize, self.dataTablePtr)
+
+        # 位图和根目录在第一次用到时才加载（见mount）
+        self.blockBitMapLength = blockBitMapLength
+        self.iNodeBitMapLength = iNodeBitMapLength
+        self.mountLock = threading.Lock()
+        self.mounted = False
+        self._inodeBMHelper = None
+        self._blockBMHelper = None
+        self._rootInode = None
+        if reader is None:
+            self.mount()
+
+    def setFile(self, file: BinaryIO):
+        self.file = file
+        try:
+            self.fd = file.fileno()
+            # 之后用pwrite直接写文件描述符，先把文件对象缓冲区里的内容写出去
+            file.flush()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            self.fd = None
+
+    # 块大小决定每个指针块中的指针数（indexFanout = 2^indexShift）
+    def setBlockSize(self, blockSize: int):
+        blockShift = self.checkBlockSize(blockSize)
+        self.blockSize = blockSize
+        self.blockShift = blockShift
+        self.indexShift = blockShift - 3
+        self.indexFanout = 1 << self.indexShift
+        self.indexFormat = "%dq" % self.indexFanout
+        # 11个直接指针加上一级、二级、三级间接指针能找到的块数决定了文件的最大长度
+        self.maxFileSize = (11 + self.indexFanout + self.indexFanout ** 2 + self.indexFanout ** 3) << blockShift
+        self.clusterSize = blockSize * CLUSTER_BLOCKS
+
+    # 计算4个表的起始地址
+    def computeLayout(self):
         self.blockBitmapPtr = self.diskNamePtr + 255
         self.inodeBitmapPtr = self.blockBitmapPtr + math.ceil(self.dataBlockCount / 8)
         self.inodeTablePtr = self.inodeBitmapPtr + math.ceil(self.inodeCount / 8)
         self.dataTablePtr = self.inodeTablePtr + self.inodeCount * 128
 
-        self.inodeBMHelper = BitMapHelper(self, self.inodeBitmapPtr, iNodeBitMapLength)
-        self.blockBMHelper = BitMapHelper(self, self.blockBitmapPtr, blockBitMapLength)
-
-        # 建立根目录INode
-        if reader is not None:
-            self.rootInode = INode(self, 0)
-        else:
-            a = self.allocINode()
-            self.rootInode = INode(self, a, isNew=True)
+    # 加载两个位图并建立根目录INode。可以在后台线程中提前调用
+    def mount(self):
+        with self.mountLock:
+            if self.mounted:
+                return
+            self._inodeBMHelper = BitMapHelper(self, self.inodeBitmapPtr, self.iNodeBitMapLength)
+            self._blockBMHelper = BitMapHelper(self, self.blockBitmapPtr, self.blockBitMapLength)
+            if self.dedup:
+                self.loadDedup()
+            # 没有正常关闭时根据位图重新统计空闲计数并找出没有回收完的inode。
+            # 挂载完之前needsRecount保持为True，修改操作都会在operation中等待
+            if self.needsRecount:
+                self.dataBlockLeft = self._blockBMHelper.countZero(self.dataBlockCount)
+                self.inodeLeft = self._inodeBMHelper.countZero(self.inodeCount)
+                # 可能是在持有读锁时第一次用到空间，这里不写GDT，由下一个修改操作写
+                self.gdtDirty = True
+                if not self._inodeBMHelper.checkIsFree(0):
+                    self._rootInode = self.getINode(0)
+                    self.queueOrphans()
+                self.needsRecount = False
+            # 旧空间文件中没有压缩计数，在这里统计，同样由下一个修改操作写回
+            if not self.compressionCountersValid:
+                self.countCompressed()
+            # 建立根目录INode
+            if self._rootInode is None:
+                if self.inodeBMHelper.checkIsFree(0):
+                    with self.operation():
+                        self._rootInode = self.createINode()
+                else:
+                    self._rootInode = self.getINode(0)
+            self.mounted = True
+
+    @property
+    def inodeBMHelper(self) -> BitMapHelper:
+        if self._inodeBMHelper is None:
+            self.mount()
+        return self._inodeBMHelper
+
+    @property
+    def blockBMHelper(self) -> BitMapHelper:
+        if self._blockBMHelper is None:
+            self.mount()
+        return self._blockBMHelper
+
+    @property
+    def rootInode(self):
+        if self._rootInode is None:
+            self.mount()
+        return self._rootInode
 
     def allocINode(self):
         i = self.inodeBMHelper.allocZero()
         if i == -1:
             raise Exception("文件节点不足!")
         self.inodeLeft -= 1
-        ptr = self.getINodePtr(i)
-        self.seek(ptr)
-        self.write(bytes(128))
-        self.saveDGT()
+        self.invalidateINode(i)
+        self.writeAt(self.getINodePtr(i), bytes(128))
+        self.gdtDirty = True
         return i
 
+    # 分配一个inode并初始化，返回INode对象
+    def createINode(self):
+        i = self.allocINode()
+        inode = INode(self, i, isNew=True)
+        with self.inodeLock:
+            self.putINodeCache(i, inode)
+        return inode
+
+    def putINodeCache(self, inodeNumber: int, inode):
+        self.inodeCache[inodeNumber] = inode
+        self.inodeCache.move_to_end(inodeNumber)
+        self.inodeRefs[inodeNumber] = inode
+        while len(self.inodeCache) > self.inodeCacheSize:
+            self.inodeCache.popitem(last=False)
+
+    # 按inode号或inode地址取得INode，优先使用缓存
+    def getINode(self, inodeNumber: int = -1, inodePtr: int = -1):
+        if inodeNumber == -1:
+            inodeNumber = self.getINodeNumber(inodePtr)
+        with self.inodeLock:
+            inode = self.inodeCache.get(inodeNumber)
+            if inode is not None:
+                self.inodeCache.move_to_end(inodeNumber)
+                return inode
+            # 被淘汰但仍被打开的文件引用着的inode也要复用，避免同一inode出现两个对象
+            inode = self.inodeRefs.get(inodeNumber)
+            if inode is None:
+                inode = INode(self, inodeNumber)
+            self.putINodeCache(inodeNumber, inode)
+            return inode
+
+    def invalidateINode(self, inodeNumber: int):
+        with self.inodeLock:
+            self.inodeCache.pop(inodeNumber, None)
+            self.inodeRefs.pop(inodeNumber, None)
+
     def allocBlock(self):
         i = self.blockBMHelper.allocZero()
         if i == -1:
             raise Exception("空间不足!")
         self.dataBlockLeft -= 1
-        ptr = self.getDataBlockPtr(i)
-        self.seek(ptr)
-        self.write(bytes(2048))
-        self.saveDGT()
+        self.writeAt(self.getDataBlockPtr(i), bytes(self.blockSize), False)
+        if metrics.ENABLED:
+            metrics.count(self.counters, "zeroFillBytes", self.blockSize)
+        self.gdtDirty = True
         return i
 
+    # 一次分配count个块，尽量连续，只写一次GDT。返回块号列表。
+    # 调用者马上会完整覆盖这些块时可以不清零（zeroFill=False）
+    def allocBlocks(self, count: int, zeroFill=True):
+        if count <= 0:
+            return []
+        if count > self.dataBlockLeft:
+            raise Exception("空间不足!")
+        runs = self.blockBMHelper.allocRun(count)
+        ans = []
+        for start, length in runs:
+            ans.extend(range(start, start + length))
+            if not zeroFill:
+                continue
+            # 连续的块一起清零，每次最多清零ZERO_FILL_CHUNK个块
+            for chunkStart in range(start, start + length, ZERO_FILL_CHUNK):
+                chunkLength = min(ZERO_FILL_CHUNK, start + length - chunkStart)
+                self.writeAt(self.getDataBlockPtr(chunkStart), bytes(chunkLength << self.blockShift), False)
+                if metrics.ENABLED:
+                    metrics.count(self.counters, "zeroFillBytes", chunkLength << self.blockShift)
+        self.dataBlockLeft -= len(ans)
+        self.gdtDirty = True
+        if len(ans) < count:
+            for i in ans:
+                self.releaseBlock(i)
+            raise Exception("空间不足!")
+        return ans
+
     def releaseBlock(self, blockId):
+        if self.dedup and len(self.dropReferences([blockId])) == 0:
+            return
+        if self.isFrozen(blockId):
+            return
         hasChanged = self.blockBMHelper.setZero(blockId)
         if not hasChanged:
             raise Exception("不能释放未被分配的块！")
+        self.revokeBlocks([blockId])
         self.dataBlockLeft += 1
+        self.gdtDirty = True
+
+    # 批量释放块，位图只写回改动的几段。metaBlockIds是其中存放元数据（目录内容、指针块）的块
+    def releaseBlocks(self, blockIds, metaBlockIds=()):
+        if self.dedup:
+            blockIds = self.dropReferences(blockIds)
+        if self.frozenBits is not None:
+            # 快照还在用的块在位图中保持已分配，删除快照时再回收（见reclaimUnreferenced）
+            blockIds = [i for i in blockIds if not self.isFrozen(i)]
+        if len(blockIds) == 0:
+            return
+        changed = self.blockBMHelper.setZeroMany(blockIds)
+        self.dataBlockLeft += changed
+        self.gdtDirty = True
+        if changed != len(blockIds):
+            raise Exception("不能释放未被分配的块！")
+        self.revokeBlocks(blockIds)
+        self.pinBlocks(metaBlockIds)
+
+    # 释放元数据块的操作提交之前，这些块被分配给普通文件后写入的数据先留在内存中，
+    # 否则崩溃后这个操作没有发生，目录或指针块的内容却已经被文件数据覆盖
+    def pinBlocks(self, blockIds):
+        if self.overlay is None:
+            return
+        for start, length in iterRuns(sorted(blockIds)):
+            self.overlay.pin(self.getDataBlockPtr(start), length << self.blockShift, self.readImage)
+
+    # 释放的块之后可能被分配给普通文件，文件数据不进日志，所以要撤销日志中之前写到这些块上的元数据，
+    # 否则崩溃后重放会用旧的目录或索引内容覆盖文件数据
+    def revokeBlocks(self, blockIds):
+        if len(self.journaledBlocks) == 0:
+            return
+        blockIds = sorted(i for i in blockIds if i in self.journaledBlocks)
+        maxLength = (JOURNAL_REVOKE - 1) >> self.blockShift
+        for start, length in iterRuns(blockIds):
+            self.journaledBlocks.difference_update(range(start, start + length))
+            for chunkStart in range(start, start + length, maxLength):
+                chunkLength = min(maxLength, start + length - chunkStart)
+                self.logWrite(self.getDataBlockPtr(chunkStart), chunkLength << self.blockShift)
 
     def releaseINode(self, blockId):
+        self.invalidateINode(blockId)
         hasChanged = self.inodeBMHelper.setZero(blockId)
         if hasChanged:
             self.inodeLeft += 1
+            self.gdtDirty = True
         else:
             raise Exception("不能释放未被文件节点！")
 
@@ -116,328 +516,1436 @@ class HbDisk:
         return (inodePtr - self.inodeTablePtr) >> 7
 
     def getDataBlockPtr(self, dataBlockNumber: int):
-        return self.dataTablePtr + (dataBlockNumber << 11)
+        return self.dataTablePtr + (dataBlockNumber << self.blockShift)
 
     def getDataBlockNum(self, ptr: int):
-        return (ptr - self.dataTablePtr) >> 11
+        return (ptr - self.dataTablePtr) >> self.blockShift
+
+    def getDedupRegionSize(self):
+        return self.dataBlockCount * 10 if self.dedup else 0
+
+    def getRefCountPtr(self, blockId: int):
+        return self.dataTablePtr + (self.dataBlockCount << self.blockShift) + blockId * 2
+
+    def getBlockHashPtr(self, blockId: int):
+        return self.dataTablePtr + (self.dataBlockCount << self.blockShift) + self.dataBlockCount * 2 + blockId * 8
+
+    # 读入所有块的额外引用数和哈希，建立哈希到块号的索引
+    def loadDedup(self):
+        self.extraRefs = array("H")
+        self.extraRefs.frombytes(self.readAt(self.getRefCountPtr(0), self.dataBlockCount * 2))
+        self.sharedBlocks = len(self.extraRefs) - self.extraRefs.count(0)
+        self.savedBlocks = sum(self.extraRefs)
+        self.blockHashes = array("Q")
+        self.blockHashes.frombytes(self.readAt(self.getBlockHashPtr(0), self.dataBlockCount * 8))
+        self.dedupIndex = {h: i for i, h in enumerate(self.blockHashes) if h != 0}
+
+    @staticmethod
+    def hashBlock(content) -> int:
+        return int.from_bytes(hashlib.blake2b(content, digest_size=8).digest(), "little") or 1
+
+    def setBlockHash(self, blockId: int, blockHash: int):
+        oldHash = self.blockHashes[blockId]
+        if oldHash == blockHash:
+            return
+        if oldHash != 0 and self.dedupIndex.get(oldHash) == blockId:
+            del self.dedupIndex[oldHash]
+        self.blockHashes[blockId] = blockHash
+        if blockHash != 0:
+            self.dedupIndex[blockHash] = blockId
+        self.writeAt(self.getBlockHashPtr(blockId), struct.pack("Q", blockHash))
+
+    def setExtraRefs(self, blockId: int, count: int):
+        oldCount = self.extraRefs[blockId]
+        self.sharedBlocks += (count > 0) - (oldCount > 0)
+        self.savedBlocks += count - oldCount
+        self.extraRefs[blockId] = count
+        self.writeAt(self.getRefCountPtr(blockId), struct.pack("H", count))
+
+    # 找一个内容与content相同、还能增加引用的块，没有时返回-1。哈希相同时还要比较内容
+    def findDuplicate(self, blockHash: int, content) -> int:
+        blockId = self.dedupIndex.get(blockHash)
+        if blockId is None or self.extraRefs[blockId] >= MAX_EXTRA_REFS:
+            return -1
+        if bytes(self.readAt(self.getDataBlockPtr(blockId), self.blockSize)) != bytes(content):
+            return -1
+        return blockId
+
+    def isShared(self, blockId: int):
+        return self.dedup and self.extraRefs[blockId] > 0
+
+    # 去掉每个块的一个引用，返回引用已经全部去掉、需要真正释放的块
+    def dropReferences(self, blockIds):
+        freed = []
+        for blockId in blockIds:
+            if self.extraRefs[blockId] > 0:
+                self.setExtraRefs(blockId, self.extraRefs[blockId] - 1)
+            else:
+                self.setBlockHash(blockId, 0)
+                freed.append(blockId)
+        return freed
+
+    def getDedupStats(self):
+        if not self.dedup or self.extraRefs is None:
+            return None
+        blocksLeft = self.getBlocksLeft()
+        usedBlocks = 0 if blocksLeft is None else self.dataBlockCount - blocksLeft
+        return {
+            "sharedBlocks": self.sharedBlocks,
+            "savedBlocks": self.savedBlocks,
+            "ratio": round((usedBlocks + self.savedBlocks) / usedBlocks, 3) if usedBlocks > 0 else None
+        }
+
+    # 没有正常关闭的空间在挂载（重新统计）之前不知道空闲块数和inode数，返回None
+    def getBlocksLeft(self):
+        return None if self.needsRecount else self.dataBlockLeft
+
+    def getINodesLeft(self):
+        return None if self.needsRecount else self.inodeLeft
+
+    def getImageSize(self):
+        return self.dataTablePtr + (self.dataBlockCount << self.blockShift) + self.getDedupRegionSize()
+
+    def isFrozen(self, blockId: int):
+        return self.frozenBits is not None and testBit(self.frozenBits, blockId)
+
+    # 快照是一个与空间文件布局相同的稀疏文件，只写入了元数据：GDT、位图、inode表、目录和指针块以及去重区域。
+    # 普通文件的数据块仍在空间文件里，在快照文件末尾用一个位图标出，这些块在空间中被冻结，修改时先复制（见HbFile.unshareBlock）
+    def getSnapshotPath(self, snapshotName: str):
+        name = getattr(self.file, "name", None)
+        if not self.hasDiskFile or not isinstance(name, str):
+            raise Exception("只有保存在文件中的空间才能建立快照。")
+        return name + SNAPSHOT_SEPARATOR + snapshotName
+
+    def listSnapshots(self):
+        name = getattr(self.file, "name", None)
+        if not self.hasDiskFile or not isinstance(name, str) or self.readOnly:
+            return []
+        directory, prefix = os.path.split(os.path.abspath(name))
+        prefix += SNAPSHOT_SEPARATOR
+        return sorted(f[len(prefix):] for f in os.listdir(directory) if f.startswith(prefix))
+
+    # 根据现有的快照重新计算冻结的块
+    def loadSnapshots(self):
+        length = math.ceil(self.dataBlockCount / 8)
+        frozen = 0
+        for snapshotName in self.listSnapshots():
+            with open(self.getSnapshotPath(snapshotName), "rb") as f:
+                frozen |= int.from_bytes(os.pread(f.fileno(), length, self.getImageSize()), "big")
+        self.frozenBits = bytearray(frozen.to_bytes(length, "big")) if frozen != 0 else None
+
+    # 从根目录开始找出所有目录的inode地址，files不为None时把其他文件的inode地址加入files
+    def findDirINodes(self, files: set = None):
+        found = {self.rootInode.ptr}
+        stack = [self.rootInode]
+        while len(stack) > 0:
+            folder = HbFolder(self, "", stack.pop())
+            for entry in folder.fileList:
+                if entry.fileType == 1 and entry.inodePtr not in found:
+                    found.add(entry.inodePtr)
+                    stack.append(self.getINode(inodePtr=entry.inodePtr))
+                elif entry.fileType != 1 and files is not None:
+                    files.add(entry.inodePtr)
+        return found
+
+    # 延迟删除队列只在内存中，没有正常关闭时其中还没回收的inode仍然已分配，但已经不在任何目录中。
+    # 把这些inode重新交给后台线程回收。目录的内容可能已经回收了一部分，所以都按普通文件回收，
+    # 其中的文件和子目录同样不可达，会各自被找到
+    def queueOrphans(self):
+        files = set()
+        reachable = self.findDirINodes(files) | files
+        for inodeNumber in iterSetBits(self.inodeBMHelper.getBitMap(), self.inodeCount):
+            inodePtr = self.getINodePtr(inodeNumber)
+            if inodePtr not in reachable:
+                self.deferDelete(inodePtr, 0)
+
+    # 收集所有已分配的inode用到的块，返回(元数据块, 普通文件数据块)两个块号集合。指针块和dirINodes中目录的块都算元数据。
+    # 等待延迟删除的inode仍然已分配，它们的块也会收集到
+    def collectBlocks(self, dirINodes=()):
+        metaBlocks = set()
+        dataBlocks = set()
+        for inodeNumber in iterSetBits(self.inodeBMHelper.getBitMap(), self.inodeCount):
+            inode = self.getINode(inodeNumber)
+            HbFile(self, "", inode).collectBlocks(metaBlocks, metaBlocks if inode.ptr in dirINodes else dataBlocks)
+        return metaBlocks, dataBlocks
+
+    # 从readAt读出[ptr, ptr + length)写到文件fd的同一位置
+    def copyOut(self, fd: int, ptr: int, length: int):
+        for chunkStart in range(ptr, ptr + length, SNAPSHOT_COPY_CHUNK):
+            os.pwrite(fd, self.readAt(chunkStart, min(SNAPSHOT_COPY_CHUNK, ptr + length - chunkStart)), chunkStart)
+
+    @staticmethod
+    def checkSnapshotName(snapshotName: str):
+        if len(snapshotName.encode()) > MAX_DISK_NAME_LENGTH:
+            raise Exception("快照名不得长于191。")
+        if len(snapshotName) == 0:
+            raise Exception("快照名不得为空。")
+        if '/' in snapshotName:
+            raise Exception("快照名不得包含'/'。")
+
+    # 建立快照，只复制元数据，耗时与数据量无关
+    def createSnapshot(self, snapshotName: str):
+        self.checkSnapshotName(snapshotName)
+        path = self.getSnapshotPath(snapshotName)
+        with self.operation():
+            if os.path.exists(path):
+                raise Exception("该快照已存在。")
+            metaBlocks, dataBlocks = self.collectBlocks(self.findDirINodes())
+            if self.gdtDirty:
+                self.saveDGT()
+            if self.compressionDirty:
+                self.saveCompressionCounters()
+            # 克隆时直接从空间文件复制冻结的块，日志和缓存中还没写出的内容要先写出去
+            self.flushJournal()
+            self.flushCache()
+            imageSize = self.getImageSize()
+            bitMapLength = math.ceil(self.dataBlockCount / 8)
+            dataBits = blocksToBitmap(dataBlocks, bitMapLength)
+            with open(path, "xb") as f:
+                fd = f.fileno()
+                try:
+                    os.ftruncate(fd, imageSize + bitMapLength)
+                    self.copyOut(fd, 0, self.dataTablePtr)
+                    if self.hasExtHeader:
+                        # 快照中的内容是完整的，挂载时不用重新统计空闲计数
+                        os.pwrite(fd, self.packExtHeader(True), EXT_HEADER_PTR)
+                    for start, length in iterRuns(sorted(metaBlocks)):
+                        self.copyOut(fd, self.getDataBlockPtr(start), length << self.blockShift)
+                    if self.dedup:
+                        self.copyOut(fd, self.getRefCountPtr(0), self.getDedupRegionSize())
+                    os.pwrite(fd, dataBits, imageSize)
+                    os.fsync(fd)
+                except BaseException:
+                    f.close()
+                    os.remove(path)
+                    raise
+            frozen = int.from_bytes(self.frozenBits or b"", "big") | int.from_bytes(dataBits, "big")
+            if frozen != 0:
+                self.frozenBits = bytearray(frozen.to_bytes(bitMapLength, "big"))
+
+    # 删除快照并回收只有它还在用的块
+    def deleteSnapshot(self, snapshotName: str):
+        path = self.getSnapshotPath(snapshotName)
+        with self.operation():
+            if not os.path.exists(path):
+                raise Exception("未找到该快照。")
+            os.remove(path)
+            self.loadSnapshots()
+            self.reclaimUnreferenced()
+
+    # 释放位图中已分配、但没有被任何inode引用也没有被快照冻结的块，返回释放的块数
+    def reclaimUnreferenced(self):
+        with self.operation():
+            metaBlocks, dataBlocks = self.collectBlocks()
+            blockIds = [i for i in iterSetBits(self.blockBMHelper.getBitMap(), self.dataBlockCount)
+                        if i not in metaBlocks and i not in dataBlocks and not self.isFrozen(i)]
+            if len(blockIds) == 0:
+                return 0
+            if self.dedup:
+                for i in blockIds:
+                    if self.extraRefs[i] != 0:
+                        self.setExtraRefs(i, 0)
+                    self.setBlockHash(i, 0)
+            self.dataBlockLeft += self.blockBMHelper.setZeroMany(blockIds)
+            self.gdtDirty = True
+            self.revokeBlocks(blockIds)
+            return len(blockIds)
+
+    # 把快照复制成一个独立的空间文件path：快照中的元数据加上它引用的数据块。
+    # 复制出来的位图中可能有快照建立时就已经不再使用的块，打开后用reclaimUnreferenced回收
+    def cloneSnapshot(self, snapshotName: str, path: str):
+        snapshotPath = self.getSnapshotPath(snapshotName)
+        if not os.path.exists(snapshotPath):
+            raise Exception("未找到该快照。")
+        with open(snapshotPath, "rb") as source, open(path, "xb") as target:
+            try:
+                self.copySnapshot(source.fileno(), target.fileno(), self.getImageSize())
+            except BaseException:
+                target.close()
+                os.remove(path)
+                raise
+
+    # 快照中已分配的块：普通文件的数据块从空间文件复制，其余的从快照文件复制
+    def copySnapshot(self, src: int, dst: int, imageSize: int):
+        bitMapLength = math.ceil(self.dataBlockCount / 8)
+        os.ftruncate(dst, imageSize)
+        copyRange(src, dst, 0, self.dataTablePtr)
+        baseBits = os.pread(src, bitMapLength, imageSize)
+        usedBits = os.pread(src, bitMapLength, self.blockBitmapPtr)
+        for start, length in iterRuns(iterSetBits(usedBits, self.dataBlockCount)):
+            # 一段中来自空间文件和快照文件的块交替出现时再分开复制
+            i = start
+            while i < start + length:
+                fromBase = testBit(baseBits, i)
+                j = i + 1
+                while j < start + length and testBit(baseBits, j) == fromBase:
+                    j += 1
+                copyRange(self.fd if fromBase else src, dst, self.getDataBlockPtr(i), (j - i) << self.blockShift)
+                i = j
+        if self.dedup:
+            copyRange(src, dst, self.getRefCountPtr(0), self.getDedupRegionSize())
+        os.fsync(dst)
 
     def saveDGT(self):
-        self.seek(0)
-        self.write(toBytes(self.dataBlockCount))
-        self.write(toBytes(self.inodeCount))
-        self.write(toBytes(self.dataBlockLeft))
-        self.write(toBytes(self.inodeLeft))
+        self.gdtDirty = False
+        self.writeAt(0, struct.pack("qqqq", self.dataBlockCount, self.inodeCount, self.dataBlockLeft,
+                                    self.inodeLeft))
+
+    # 读扩展头。空间名长于191字节的旧空间文件没有扩展头，和没有正常关闭的空间一样，每次挂载都重新统计空闲计数
+    def loadExtHeader(self):
+        self.hasExtHeader = self.diskNameLength <= MAX_DISK_NAME_LENGTH
+        if self.hasExtHeader:
+            magic, clean, blockShift, compression, dedup, countersValid = struct.unpack_from(
+                EXT_HEADER_FORMAT, self.readAt(EXT_HEADER_PTR, EXT_HEADER_SIZE))
+            self.needsRecount = magic != EXT_HEADER_MAGIC or clean != 1
+            if magic != EXT_HEADER_MAGIC:
+                # 没有扩展头标记的空间文件早于压缩功能，其中没有压缩文件。计数的位置上可能有旧的空间名，要写一次0
+                self.compressionCountersValid = True
+                self.compressionDirty = True
+            else:
+                if blockShift != 0:
+                    self.setBlockSize(1 << blockShift)
+                if compression < len(COMPRESSION_METHODS):
+                    self.compression = COMPRESSION_METHODS[compression]
+                self.dedup = dedup == 1
+                self.compressionCountersValid = countersValid == 1
+                if self.compressionCountersValid:
+                    self.compressedBytes, self.compressedBlocks = struct.unpack(
+                        COMPRESSION_COUNTERS_FORMAT, self.readAt(COMPRESSION_COUNTERS_PTR, 16))
+        else:
+            self.needsRecount = True
+        if self.readOnly:
+            # 快照建立时已经是完整的，不用重新统计也不能写
+            self.needsRecount = False
+            return
+        # 打开后先标记为未正常关闭并落盘，之后的修改才能写进空间文件
+        self.clean = False
+        self.saveExtHeader()
+        if self.hasDiskFile:
+            self.syncImage()
 
-    def rename(self, newName: str):
+    # 扩展头不进日志：关闭标志只在打开和关闭时写，并且都会立即落盘
+    def saveExtHeader(self):
+        if not self.hasExtHeader:
+            return
+        self.writeAt(EXT_HEADER_PTR, self.packExtHeader(self.clean), False)
+
+    def packExtHeader(self, clean: bool) -> bytes:
+        return struct.pack(EXT_HEADER_FORMAT, EXT_HEADER_MAGIC, 1 if clean else 0, self.blockShift,
+                           COMPRESSION_METHODS.index(self.compression), 1 if self.dedup else 0,
+                           1 if self.compressionCountersValid else 0)
+
+    def saveCompressionCounters(self):
+        self.compressionDirty = False
+        if self.hasExtHeader:
+            self.writeAt(COMPRESSION_COUNTERS_PTR,
+                         struct.pack(COMPRESSION_COUNTERS_FORMAT, self.compressedBytes, self.compressedBlocks))
+
+    # 压缩文件的原始长度或占用的块数变化时调用
+    def addCompressed(self, logicalBytes: int, blocks: int):
+        if not self.compressionCountersValid:
+            return
+        self.compressedBytes += logicalBytes
+        self.compressedBlocks += blocks
+        self.compressionDirty = True
+
+    # 扫描所有inode得到压缩计数，只有旧空间文件才需要。只在挂载时调用，此时还没有修改操作
+    def countCompressed(self):
+        compressedBytes = 0
+        compressedBlocks = 0
+        for inodeNumber in iterSetBits(self.inodeBMHelper.getBitMap(), self.inodeCount):
+            inode = self.getINode(inodeNumber)
+            if inode.isCompressed() and not inode.isInline():
+                dataBlocks = set()
+                HbFile(self, "", inode).collectBlocks(set(), dataBlocks)
+                compressedBytes += inode.size
+                compressedBlocks += len(dataBlocks)
+        self.compressedBytes = compressedBytes
+        self.compressedBlocks = compressedBlocks
+        self.compressionCountersValid = True
+        self.compressionDirty = not self.readOnly
+
+    # 返回块大小以2为底的对数
+    @staticmethod
+    def checkBlockSize(blockSize: int):
+        blockShift = blockSize.bit_length() - 1
+        if blockSize != 1 << blockShift or not MIN_BLOCK_SHIFT <= blockShift <= MAX_BLOCK_SHIFT:
+            raise Exception("块大小必须是1024到65536之间的2的幂。")
+        return blockShift
+
+    @staticmethod
+    def checkCompression(compression: str):
+        if compression not in COMPRESSION_METHODS:
+            raise Exception("不支持的压缩方式。")
+
+    @staticmethod
+    def checkDiskName(newName: str):
         encodedName = newName.encode()
-        if len(encodedName) > 255:
-            raise Exception("空间名不得长于255。")
+        if len(encodedName) > MAX_DISK_NAME_LENGTH:
+            raise Exception("空间名不得长于191。")
         if len(encodedName) == 0:
             raise Exception("空间名不得为空。")
-        if newName.find('/') > 0:
+        if '/' in newName:
             raise Exception("空间名不得包含'/'。")
-        self.diskNameLength = len(encodedName)
-        self.diskName = newName
 
-        self.seek(self.diskNameLenPtr)
-        self.write(bytes([self.diskNameLength]))
-        self.write(encodedName)
+    def rename(self, newName: str):
+        self.checkDiskName(newName)
+        encodedName = newName.encode()
+        with self.operation():
+            self.diskNameLength = len(encodedName)
+            self.diskName = newName
+            self.writeAt(self.diskNameLenPtr, bytes([self.diskNameLength]) + encodedName)
+            if not self.hasExtHeader:
+                # 旧空间文件改成较短的名字后就有位置放扩展头了
+                self.hasExtHeader = True
+                self.saveExtHeader()
+
+    def openMmap(self):
+        try:
+            fd = self.file.fileno()
+            size = os.fstat(fd).st_size
+            if size <= 0:
+                return
+            self.file.flush()
+            self.mm = mmap.mmap(fd, size, access=mmap.ACCESS_READ if self.readOnly else mmap.ACCESS_WRITE)
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            # 不支持mmap的文件对象（如BytesIO）继续使用文件读写
+            self.mm = None
+            return
+        self.mmSize = size
+        self.mmView = memoryview(self.mm).toreadonly()
+
+    # 通过ftruncate扩大文件并重新映射。旧的映射在仍被外部memoryview引用时不能关闭，交给GC回收
+    def growMmap(self, minSize: int):
+        newSize = max(minSize, min(self.mmSize * 2, self.mmSize + MMAP_GROW_STEP))
+        granularity = mmap.ALLOCATIONGRANULARITY
+        newSize = (newSize + granularity - 1) // granularity * granularity
+        fd = self.file.fileno()
+        os.ftruncate(fd, newSize)
+        self.mm = mmap.mmap(fd, newSize)
+        self.mmView = memoryview(self.mm).toreadonly()
+        self.mmSize = newSize
+
+    def closeMmap(self):
+        if self.mm is None:
+            return
+        self.mm.flush()
+        fd = self.file.fileno()
+        self.mmView = None
+        self.mm = None
+        # 去掉扩容时多分配的尾部
+        os.ftruncate(fd, self.diskSize)
+
+    # 打开与空间文件同名的.journal日志，重放其中已提交的记录后把空间文件落盘并清空日志
+    def openJournal(self):
+        name = getattr(self.file, "name", None)
+        if not isinstance(name, str):
+            return
+        path = name + ".journal"
+        if MetaJournal.replay(path, self.writeAt) > 0:
+            self.syncImage()
+        self.journal = MetaJournal(path, self.journalInterval, self.journalBatchSize, self.applyCommitted)
+        self.journal.truncate()
+
+    # 把一个逻辑操作中的所有元数据写入合成一条日志记录，可以嵌套，只有最外层结束时才写日志
+    # 最外层的操作同时持有空间的写锁
+    @contextmanager
+    def operation(self):
+        depth = getattr(self.opState, "depth", 0)
+        if depth == 0:
+            if self.readOnly:
+                raise Exception("快照是只读的。")
+            if self.needsRecount:
+                self.mount()
+            self.lock.acquireWrite()
+            self.opState.writes = []
+            if metrics.ENABLED:
+                self.opState.start = time.perf_counter()
+        self.opState.depth = depth + 1
+        try:
+            yield
+        finally:
+            if depth == 0 and self.gdtDirty:
+                self.saveDGT()
+            if depth == 0 and self.compressionDirty:
+                self.saveCompressionCounters()
+            self.opState.depth = depth
+            if depth == 0:
+                try:
+                    writes = self.opState.writes
+                    self.opState.writes = None
+                    if self.journal is not None and len(writes) > 0:
+                        self.journal.append(writes, self.tagPending)
+                        if self.journal.size > JOURNAL_CHECKPOINT_SIZE:
+                            self.checkpoint()
+                finally:
+                    self.lock.releaseWrite()
+                    start = getattr(self.opState, "start", None)
+                    if metrics.ENABLED and start is not None:
+                        metrics.count(self.counters, "operations")
+                        metrics.count(self.counters, metrics.OPERATION_SECONDS, time.perf_counter() - start)
+                    self.opState.start = None
+
+    # content为整数时是撤销项（见MetaJournal.encodeEntry）
+    def logWrite(self, ptr: int, content):
+        if not isinstance(content, int):
+            content = bytes(content)
+            if len(content) > 0 and self.dataTablePtr <= ptr < self.getDataBlockPtr(self.dataBlockCount):
+                self.journaledBlocks.update(range(self.getDataBlockNum(ptr),
+                                                  self.getDataBlockNum(ptr + len(content) - 1) + 1))
+        if getattr(self.opState, "depth", 0) > 0:
+            self.opState.writes.append((ptr, content))
+        else:
+            self.journal.append([(ptr, content)], self.tagPending)
+
+    def tagPending(self, seq: int):
+        if self.overlay is not None:
+            self.overlay.tag(seq)
 
+    # 日志提交到seq之后，把这些记录对应的元数据写进空间文件
+    def applyCommitted(self, seq: int):
+        if self.overlay is not None:
+            self.overlay.apply(seq, self.writeImage)
+
+    # 提交日志中的记录并写进空间文件
+    def flushJournal(self):
+        if self.journal is None:
+            return
+        self.journal.commit()
+        self.applyCommitted(self.journal.committedSeq)
+
+    # 把缓存和映射区中的内容都写到空间文件并fsync
+    def syncImage(self):
+        self.flushCache()
+        if self.mm is not None:
+            self.mm.flush()
+        self.file.flush()
+        if self.fd is not None:
+            os.fsync(self.fd)
+
+    # 日志中的记录都已经反映到落盘的空间文件里，可以清空日志
+    def checkpoint(self):
+        if self.journal is None:
+            return
+        self.flushJournal()
+        self.syncImage()
+        self.journal.truncate()
+        self.journaledBlocks.clear()
+
+    def getJournalStats(self):
+        if self.journal is None:
+            return None
+        return self.journal.getStats()
+
+    def flushCache(self):
+        if self.cache is not None:
+            self.cache.flush()
+
+    def getCacheStats(self):
+        if self.cache is None:
+            return None
+        return self.cache.getStats()
+
+    def getCachedCluster(self, key: tuple):
+        with self.clusterCacheLock:
+            content = self.clusterCache.get(key)
+            if content is None:
+                self.compressionStats["cacheMisses"] += 1
+                return None
+            self.clusterCache.move_to_end(key)
+            self.compressionStats["cacheHits"] += 1
+            return content
+
+    def putCachedCluster(self, key: tuple, content: bytes):
+        with self.clusterCacheLock:
+            self.clusterCache[key] = content
+            self.clusterCache.move_to_end(key)
+            while len(self.clusterCache) > max(1, self.clusterCacheSize // self.clusterSize):
+                self.clusterCache.popitem(last=False)
+
+    # 去掉一个文件从第fromCluster簇开始的缓存
+    def dropClusters(self, inodePtr: int, fromCluster: int = 0):
+        with self.clusterCacheLock:
+            for key in [k for k in self.clusterCache if k[0] == inodePtr and k[1] >= fromCluster]:
+                self.clusterCache.pop(key)
+
+    # 旧空间文件在挂载（统计）之前不知道压缩计数，这时原始长度、占用空间和压缩比都为None
+    def getCompressionStats(self):
+        stats = dict(self.compressionStats)
+        stats["method"] = self.compression
+        if not self.compressionCountersValid:
+            stats["logicalBytes"] = stats["storedBytes"] = stats["ratio"] = None
+            return stats
+        stats["logicalBytes"] = self.compressedBytes
+        stats["storedBytes"] = self.compressedBlocks << self.blockShift
+        stats["ratio"] = round(stats["logicalBytes"] / stats["storedBytes"], 3) if stats["storedBytes"] > 0 else None
+        return stats
+
+    # 交给后台线程回收一个已经从目录中去掉的文件或目录
+    def deferDelete(self, inodePtr: int, fileType: int):
+        with self.deleteThreadLock:
+            if self.deleteThread is None:
+                self.deleteThread = threading.Thread(target=self.deleteLoop, daemon=True)
+                self.deleteThread.start()
+        self.deleteQueue.put((inodePtr, fileType))
+
+    def deleteLoop(self):
+        while True:
+            inodePtr, fileType = self.deleteQueue.get()
+            try:
+                reclaimINode(self, inodePtr, fileType)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.deleteQueue.task_done()
+
+    # 等所有延迟删除都回收完
+    def drainDeletes(self):
+        if self.deleteThread is not None:
+            self.deleteQueue.join()
+
+    def getPendingDeletes(self):
+        return self.deleteQueue.unfinished_tasks
+
+    # 等延迟删除回收完、正在进行的读写都结束后再关闭
     def saveToDisk(self):
-        if self.hasDiskFile:
-            self.file.close()
+        if self.readOnly:
+            with self.lock.writeLocked():
+                self.mmView = None
+                self.mm = None
+                self.file.close()
             return
-        realFile = open(self.diskName + ".hbdk", "xb")
-        self.file.seek(0)
-        realFile.write(self.file.read())
+        # 没有正常关闭、也还没有挂载过的空间要先重新统计，才能标记为正常关闭
+        if self.needsRecount:
+            self.mount()
+        self.drainDeletes()
+        with self.lock.writeLocked():
+            if self.gdtDirty:
+                self.saveDGT()
+            if self.compressionDirty:
+                self.saveCompressionCounters()
+            self.clean = True
+            self.saveExtHeader()
+            self.flushCache()
+            if self.hasDiskFile:
+                if self.journal is not None:
+                    self.checkpoint()
+                    self.journal.close(True)
+                    self.journal = None
+                else:
+                    self.syncImage()
+                self.closeMmap()
+                self.file.close()
+                return
+            realFile = open(self.diskName + ".hbdk", "xb")
+            realFile.write(self.rawRead(0, self.diskSize))
 
+    # 流式接口，只为兼容保留，内部都使用不依赖当前位置的readAt/writeAt
     def seek(self, ptr: int):
         self.streamPtr = ptr
-        if self.diskSize <= ptr:
-            self.file.seek(self.diskSize - 1)  # 指针移动到文件尾部！
-            self.file.write(bytes(ptr - self.diskSize + 1))
-            self.diskSize = ptr + 1
-        self.file.seek(ptr)
 
     def read(self, length: int) -> bytes:
-        if self.diskSize <= self.streamPtr + length:
-            self.file.write(bytes(self.streamPtr + length - self.diskSize + 1))
-            self.diskSize = self.streamPtr + length + 1
-            self.file.seek(self.streamPtr)
+        content = self.readAt(self.streamPtr, length)
         self.streamPtr += length
-        return self.file.read(length)
+        return content
 
-    def write(self, content: bytes):
-        if self.diskSize <= self.streamPtr + len(content) + 1:
-            self.diskSize = self.streamPtr + len(content) + 1
+    def write(self, content: bytes, isMeta=True):
+        self.writeAt(self.streamPtr, content, isMeta)
         self.streamPtr += len(content)
-        self.file.write(content)
+
+    # 文件对象支持fileno时用pread/pwrite，不移动共享的文件指针；否则（如BytesIO）加锁后seek
+    def rawRead(self, ptr: int, length: int) -> bytes:
+        if self.fd is not None:
+            content = os.pread(self.fd, length, ptr)
+        else:
+            with self.fileLock:
+                self.file.seek(ptr)
+                content = self.file.read(length)
+        # 读到文件尾部之后的部分视为0
+        if len(content) < length:
+            content += bytes(length - len(content))
+        return content
+
+    def rawWrite(self, ptr: int, content: bytes):
+        if self.fd is not None:
+            os.pwrite(self.fd, content, ptr)
+            return
+        with self.fileLock:
+            self.file.seek(ptr)
+            self.file.write(content)
+
+    def countAccess(self, kind: str, ptr: int, length: int):
+        if ptr != self.lastAccessEnd:
+            metrics.count(self.counters, "seeks")
+        self.lastAccessEnd = ptr + length
+        metrics.count(self.counters, kind + "Calls")
+        metrics.count(self.counters, kind + "Bytes", length)
+
+    # 保证映射区覆盖到end。多个读线程可能同时触发扩容，所以加锁后再检查一次
+    def ensureMapped(self, end: int):
+        with self.mmLock:
+            if end > self.mmSize:
+                self.growMmap(end)
+            if end > self.diskSize:
+                self.diskSize = end
+
+    # mmap模式下返回只读memoryview，它直接指向映射区，后续写入会反映到其中
+    def readAt(self, ptr: int, length: int) -> bytes:
+        if metrics.ENABLED:
+            self.countAccess("read", ptr, length)
+        if self.baseBits is not None and self.dataTablePtr <= ptr < self.getDataBlockPtr(self.dataBlockCount):
+            return self.readSnapshotAt(ptr, length)
+        return self.readOwn(ptr, length)
+
+    def readOwn(self, ptr: int, length: int) -> bytes:
+        if self.overlay is not None and len(self.overlay.pages) > 0:
+            content = self.overlay.read(ptr, length, self.readImage)
+            if content is not None:
+                return content
+        return self.readImage(ptr, length)
+
+    # 直接读空间文件，不包括还没有提交的元数据
+    def readImage(self, ptr: int, length: int) -> bytes:
+        end = ptr + length
+        if self.mm is not None:
+            if end > self.mmSize:
+                self.ensureMapped(end)
+            return self.mmView[ptr:end]
+        if self.cache is not None:
+            return self.cache.read(ptr, length)
+        return self.rawRead(ptr, length)
+
+    # 快照的数据区中，连续的几块来自同一处时一起读
+    def readSnapshotAt(self, ptr: int, length: int) -> bytes:
+        end = ptr + length
+        parts = []
+        while ptr < end:
+            blockId = self.getDataBlockNum(ptr)
+            fromBase = testBit(self.baseBits, blockId)
+            blockId += 1
+            while self.getDataBlockPtr(blockId) < end and testBit(self.baseBits, blockId) == fromBase:
+                blockId += 1
+            partEnd = min(end, self.getDataBlockPtr(blockId))
+            if fromBase:
+                with self.baseDisk.lock.readLocked():
+                    parts.append(self.baseDisk.readAt(ptr, partEnd - ptr))
+            else:
+                parts.append(self.readOwn(ptr, partEnd - ptr))
+            ptr = partEnd
+        return parts[0] if len(parts) == 1 else b"".join(parts)
+
+    # isMeta为False表示写的是文件数据，不进日志
+    def writeAt(self, ptr: int, content: bytes, isMeta=True):
+        if metrics.ENABLED:
+            self.countAccess("write", ptr, len(content))
+        if self.overlay is not None:
+            if isMeta:
+                self.overlay.write(ptr, content, self.readImage)
+                self.logWrite(ptr, content)
+                return
+            if len(self.overlay.pages) > 0:
+                self.overlay.patch(ptr, content, self.writeImage)
+                return
+        elif isMeta and self.journal is not None:
+            self.logWrite(ptr, content)
+        self.writeImage(ptr, content)
+
+    def writeImage(self, ptr: int, content: bytes):
+        end = ptr + len(content)
+        if self.mm is not None:
+            if end > self.mmSize or end > self.diskSize:
+                self.ensureMapped(end)
+            self.mm[ptr:end] = content
+            return
+        if end > self.diskSize:
+            self.diskSize = end
+        if self.cache is not None:
+            self.cache.write(ptr, content)
+            return
+        self.rawWrite(ptr, content)
+
+
+# inode的磁盘格式：size(8) + 修改时间(8) + 11个直接指针 + 一级/二级/三级间接指针，共128字节
+INODE_FORMAT = "qq14q"
+# size字段的最高字节存放inode标志，低56位是文件长度
+INODE_SIZE_MASK = (1 << 56) - 1
+# 文件内容直接存放在指针区域中
+INODE_FLAG_INLINE = 1
+# 文件按簇压缩存放，两个标志分别对应zlib和lzma
+INODE_FLAG_ZLIB = 2
+INODE_FLAG_LZMA = 4
+INODE_COMPRESSION_FLAGS = {"": 0, "zlib": INODE_FLAG_ZLIB, "lzma": INODE_FLAG_LZMA}
+INODE_COMPRESSION_MASK = INODE_FLAG_ZLIB | INODE_FLAG_LZMA
+# 不超过这个长度的文件内容直接放在inode的指针区域里，不占用数据块
+INLINE_DATA_SIZE = 112
+# lzma使用不带文件头的原始格式，每簇可以省下几十字节
+LZMA_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 1}]
+
+
+def compressCluster(flags: int, content: bytes) -> bytes:
+    if flags & INODE_FLAG_LZMA:
+        return lzma.compress(content, format=lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+    return zlib.compress(content)
+
+
+def decompressCluster(flags: int, content) -> bytes:
+    if flags & INODE_FLAG_LZMA:
+        return lzma.decompress(content, format=lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+    return zlib.decompress(content)
 
 
 class INode:
+    __slots__ = ("disk", "ptr", "size", "flags", "lastModifyTimeStamp", "blockPtrs", "blockMap", "indexBlocks",
+                 "dirEntries", "dirDeadBytes", "compressedSize", "lock", "__weakref__")
+
     def __init__(self, disk: HbDisk, inodeNumber: int = -1, inodePtr: int = -1, isNew=False):
         self.disk = disk
+        # 逻辑块到磁盘地址的映射及上级指针块的缓存，由HbFile按需建立
+        self.blockMap = None
+        self.indexBlocks = None
+        # 目录的文件名索引及墓碑字节数，由HbFolder按需建立
+        self.dirEntries = None
+        self.dirDeadBytes = 0
+        # 文件锁：多个读线程同时解析块映射或加载目录时互斥
+        self.lock = threading.RLock()
         if inodePtr != -1:
             self.ptr = inodePtr
         else:
             self.ptr = disk.getINodePtr(inodeNumber)
-        disk.seek(self.ptr)
         if isNew:
             self.size = 0
-            disk.write(struct.pack("q", 0))
+            self.flags = 0
             self.lastModifyTimeStamp = math.floor(time.time() * 1000)
-            disk.write(struct.pack("q", self.lastModifyTimeStamp))
+            self.blockPtrs = [0] * 14
+            disk.writeAt(self.ptr, struct.pack("qq", 0, self.lastModifyTimeStamp))
         else:
-            self.size = struct.unpack("q", disk.read(8))[0]
-            self.lastModifyTimeStamp = struct.unpack("q", disk.read(8))[0]
+            # 一次读出整个inode
+            values = struct.unpack(INODE_FORMAT, disk.readAt(self.ptr, 128))
+            self.size = values[0] & INODE_SIZE_MASK
+            self.flags = values[0] >> 56
+            self.lastModifyTimeStamp = values[1]
+            # 内联的文件没有块指针，指针区域中是文件内容
+            self.blockPtrs = [0] * 14 if self.isInline() else list(values[2:])
+        # 已经计入空间压缩计数的原始长度，和磁盘上的inode一致
+        self.compressedSize = self.getCompressedSize()
 
     def save(self):
-        self.disk.seek(self.ptr)
-        self.disk.write(struct.pack("q", self.size))
         self.lastModifyTimeStamp = math.floor(time.time() * 1000)
-        self.disk.write(struct.pack("q", self.lastModifyTimeStamp))
+        self.disk.writeAt(self.ptr, struct.pack("qq", self.size | self.flags << 56, self.lastModifyTimeStamp))
+        compressedSize = self.getCompressedSize()
+        if compressedSize != self.compressedSize:
+            self.disk.addCompressed(compressedSize - self.compressedSize, 0)
+            self.compressedSize = compressedSize
+
+    def getCompressedSize(self):
+        return self.size if self.isCompressed() and not self.isInline() else 0
+
+    def isInline(self):
+        return self.flags & INODE_FLAG_INLINE != 0
+
+    def isCompressed(self):
+        return self.flags & INODE_COMPRESSION_MASK != 0
+
+    # 内联内容在磁盘上的地址
+    def getInlineDataPtr(self):
+        return self.ptr + 16
+
+    def saveBlockPtr(self, index: int, ptr: int):
+        self.blockPtrs[index] = ptr
+        self.disk.writeAt(self.ptr + 16 + index * 8, struct.pack("q", ptr))
+
+    # 一次写回全部14个指针
+    def saveBlockPtrs(self):
+        self.disk.writeAt(self.ptr + 16, struct.pack("14q", *self.blockPtrs))
 
     def getDirBlockPtr(self, dirBlockIndex: int):
-        self.disk.seek(self.ptr + 16 + dirBlockIndex * 8)
-        return struct.unpack("q", self.disk.read(8))[0]
+        return self.blockPtrs[dirBlockIndex]
 
     def saveDirBlockPtr(self, dirBlockIndex: int, ptr: int):
-        self.disk.seek(self.ptr + 16 + dirBlockIndex * 8)
-        self.disk.write(struct.pack("q", ptr))
+        self.saveBlockPtr(dirBlockIndex, ptr)
 
     def getIndirectBlockPtr(self):
-        self.disk.seek(self.ptr + 104)
-        return struct.unpack("q", self.disk.read(8))[0]
+        return self.blockPtrs[11]
 
     def saveIndirectBlockPtr(self, ptr: int):
-        self.disk.seek(self.ptr + 104)
-        self.disk.write(struct.pack("q", ptr))
+        self.saveBlockPtr(11, ptr)
 
     def getDoubleIndirectBlockPtr(self):
-        self.disk.seek(self.ptr + 112)
-        return struct.unpack("q", self.disk.read(8))[0]
+        return self.blockPtrs[12]
 
     def saveDoubleIndirectBlockPtr(self, ptr: int):
-        self.disk.seek(self.ptr + 112)
-        self.disk.write(struct.pack("q", ptr))
+        self.saveBlockPtr(12, ptr)
 
     def getThirdIndirectBlockPtr(self):
-        self.disk.seek(self.ptr + 120)
-        return struct.unpack("q", self.disk.read(8))[0]
+        return self.blockPtrs[13]
 
     def saveThirdIndirectBlockPtr(self, ptr: int):
-        self.disk.seek(self.ptr + 120)
-        self.disk.write(struct.pack("q", ptr))
+        self.saveBlockPtr(13, ptr)
+
+
+# 块号在索引树中的路径：第一个元素是inode中的指针槽位，后面依次是各级指针块中的槽位。每个指针块有2^shift个指针
+def getIndexPath(blockId: int, shift: int = 8):
+    if blockId < 11:
+        return (blockId,)
+    mask = (1 << shift) - 1
+    n = blockId - 11
+    if n < 1 << shift:
+        return 11, n
+    n -= 1 << shift
+    if n < 1 << (shift * 2):
+        return 12, n >> shift, n & mask
+    n -= 1 << (shift * 2)
+    return 13, n >> (shift * 2), (n >> shift) & mask, n & mask
 
 
 class HbFile:
+    # 普通文件的内容不写日志，目录的内容属于元数据
+    isMetadata = False
+
     def __init__(self, disk: HbDisk, path: str, inode: INode):
         self.disk = disk
         self.path = path
         self.inode = inode
         # 当前文件的指针
         self.nowPtr = 0
-        # 当前找到了文件的第几个快
-        self.nowBlockId = -1
-        # 当前文件块在disk上的起始地址
-        self.nowBlockStartPtr = -1
+        # 填补空洞时预先批量分配好的块，getBlockStartPtrOrAlloc优先从这里取
+        self.blockPool = deque()
+
+    def allocBlockPtr(self):
+        if len(self.blockPool) > 0:
+            return self.disk.getDataBlockPtr(self.blockPool.popleft())
+        return self.disk.getDataBlockPtr(self.disk.allocBlock())
+
+    # 文件的逻辑块号到磁盘地址的映射，挂在INode上，这样同一个文件的所有HbFile对象看到的都一样
+    def getBlockMap(self):
+        if self.inode.blockMap is None:
+            self.inode.blockMap = BlockMap()
+            self.inode.indexBlocks = {}
+        return self.inode.blockMap
+
+    # 读出一个上级（非叶子）指针块的全部内容，结果缓存在INode上
+    def getIndexBlock(self, ptr: int):
+        indexBlocks = self.inode.indexBlocks
+        block = indexBlocks.get(ptr)
+        if block is None:
+            block = list(struct.unpack(self.disk.indexFormat, self.disk.readAt(ptr, self.disk.blockSize)))
+            indexBlocks[ptr] = block
+            if metrics.ENABLED:
+                metrics.count(self.disk.counters, "indirectBlockReads")
+        return block
+
+    # 找到blockId所在的叶子指针块的地址，上级指针块不存在时返回0
+    def getLeafIndexBlockPtr(self, path):
+        ptr = self.inode.blockPtrs[path[0]]
+        for slot in path[1:-1]:
+            if ptr == 0:
+                return 0
+            ptr = self.getIndexBlock(ptr)[slot]
+        return ptr
+
+    # 解析[startBlock, endBlock)的块地址。叶子指针块整块读入，一次填满它覆盖的所有块
+    def resolveBlocks(self, startBlock: int, endBlock: int):
+        with self.inode.lock:
+            blockMap = self.getBlockMap()
+            # 叶子指针块只解析到文件尾为止
+            mapLength = max(endBlock, self.getBlockCount(self.inode.size))
+            blockId = startBlock
+            while blockId < endBlock:
+                if blockMap[blockId] != UNRESOLVED:
+                    blockId += 1
+                    continue
+                path = getIndexPath(blockId, self.disk.indexShift)
+                if len(path) == 1:
+                    blockMap[blockId] = self.inode.blockPtrs[blockId]
+                    if metrics.ENABLED:
+                        metrics.count(self.disk.counters, "blockResolutions")
+                    blockId += 1
+                    continue
+                leafBase = blockId - path[-1]
+                leafPtr = self.getLeafIndexBlockPtr(path)
+                leafEnd = min(leafBase + self.disk.indexFanout, mapLength)
+                ptrs = array("q")
+                if leafPtr == 0:
+                    ptrs.frombytes(bytes((leafEnd - leafBase) * 8))
+                else:
+                    ptrs.frombytes(self.disk.readAt(leafPtr, (leafEnd - leafBase) * 8))
+                    if metrics.ENABLED:
+                        metrics.count(self.disk.counters, "indirectBlockReads")
+                blockMap.setRange(leafBase, ptrs)
+                if metrics.ENABLED:
+                    metrics.count(self.disk.counters, "blockResolutions", leafEnd - leafBase)
+                blockId = leafEnd
+
+    def getBlockPtr(self, blockId: int):
+        blockMap = self.getBlockMap()
+        if blockMap[blockId] == UNRESOLVED:
+            self.resolveBlocks(blockId, blockId + 1)
+        return blockMap[blockId]
+
+    # 修改一个指针槽位，parentPtr为None表示inode本身
+    def savePointer(self, parentPtr, slot: int, ptr: int):
+        if parentPtr is None:
+            self.inode.saveBlockPtr(slot, ptr)
+            return
+        self.disk.writeAt(parentPtr + slot * 8, struct.pack("q", ptr))
+        block = self.inode.indexBlocks.get(parentPtr)
+        if block is not None:
+            block[slot] = ptr
+
+    # 从inode开始沿路径往下走，返回[(父块地址, 槽位, 指向的地址), ...]。alloc为True时补齐缺失的块，
+    # 给出leafPtr时数据块指针改为leafPtr而不是新分配一块
+    def walkIndexPath(self, blockId: int, alloc=False, leafPtr: int = 0):
+        path = getIndexPath(blockId, self.disk.indexShift)
+        chain = []
+        parentPtr = None
+        for depth, slot in enumerate(path):
+            if depth == len(path) - 1:
+                ptr = self.getBlockPtr(blockId)
+            elif parentPtr is None:
+                ptr = self.inode.blockPtrs[slot]
+            else:
+                ptr = self.getIndexBlock(parentPtr)[slot]
+            if depth == len(path) - 1 and leafPtr != 0:
+                if ptr != leafPtr:
+                    self.savePointer(parentPtr, slot, leafPtr)
+                    self.getBlockMap()[blockId] = leafPtr
+                ptr = leafPtr
+            elif ptr == 0 and alloc:
+                ptr = self.allocBlockPtr()
+                if depth < len(path) - 1:
+                    # 指针块的清零也要进日志，重放后才不会指向垃圾数据
+                    self.disk.writeAt(ptr, bytes(self.disk.blockSize))
+                    if metrics.ENABLED:
+                        metrics.count(self.disk.counters, "zeroFillBytes", self.disk.blockSize)
+                self.savePointer(parentPtr, slot, ptr)
+                if depth < len(path) - 2:
+                    # 新分配的上级指针块已经清零，不用再读
+                    self.inode.indexBlocks[ptr] = [0] * self.disk.indexFanout
+                if depth == len(path) - 1:
+                    self.getBlockMap()[blockId] = ptr
+            chain.append((parentPtr, slot, ptr))
+            if ptr == 0:
+                break
+            parentPtr = ptr
+        return chain
+
+    # 把逻辑块blockId的指针改为ptr，ptr不为0时先补齐缺失的指针块
+    def setBlockPtr(self, blockId: int, ptr: int):
+        if ptr != 0:
+            self.walkIndexPath(blockId, True, ptr)
+            return
+        chain = self.walkIndexPath(blockId)
+        parentPtr, slot, oldPtr = chain[-1]
+        if len(chain) == len(getIndexPath(blockId, self.disk.indexShift)) and oldPtr != 0:
+            self.savePointer(parentPtr, slot, 0)
+            self.getBlockMap()[blockId] = 0
 
     def getBlockStartPtrOrAlloc(self, blockId):
-        if blockId <= 10:
-            ptr0 = self.inode.getDirBlockPtr(blockId)
-            if ptr0 == 0:
-                ptr0 = self.disk.getDataBlockPtr(self.disk.allocBlock())
-                self.inode.saveDirBlockPtr(blockId, ptr0)
-            return ptr0
-
-        if blockId <= 10 + 256:
-            ptr1 = self.inode.getIndirectBlockPtr()
-            if ptr1 == 0:
-                ptr1 = self.disk.getDataBlockPtr(self.disk.allocBlock())
-                self.inode.saveIndirectBlockPtr(ptr1)
-            blockIdL1 = blockId - 11
-            self.disk.seek(ptr1 + blockIdL1 * 8)
-            ptr0 = struct.unpack("q", self.disk.read(8))[0]
-            if ptr0 == 0:
-                ptr0 = self.disk.getDataBlockPtr(self.disk.allocBlock())
-                self.disk.seek(ptr1 + blockIdL1 * 8)
-                self.disk.write(struct.pack("q", ptr0))
-            return ptr0
-
-        if blockId <= 10 + 256 + 256 * 256:
-            ptr2 = self.inode.getDoubleIndirectBlockPtr()
-            if ptr2 == 0:
-                ptr2 = self.disk.getDataBlockPtr(self.disk.allocBlock())
-                self.inode.saveDoubleIndirectBlockPtr(ptr2)
-            blockIdL2 = math.floor((blockId - 11 - 256) / 256)
-            self.disk.seek(ptr2 + blockIdL2 * 8)
-            ptr1 = struct.unpack("q", self.disk.read(8))[0]
-            if ptr1 == 0:
-                ptr1 = self.disk.getDataBlockPtr(self.disk.allocBlock())
-                self.disk.seek(ptr2 + blockIdL2 * 8)
-                self.disk.write(struct.pack("q", ptr1))
-            blockIdL1 = (blockId - 11) % 256
-            self.disk.seek(ptr1 + blockIdL1 * 8)
-            ptr0 = struct.unpack("q", self.disk.read(8))[0]
-            if ptr0 == 0:
-                ptr0 = self.disk.getDataBlockPtr(self.disk.allocBlock())
-                self.disk.seek(ptr1 + blockIdL1 * 8)
-                self.disk.write(struct.pack("q", ptr0))
-            return ptr0
-
-        if blockId <= 10 + 256 + 256 * 256 + 256 * 256 * 256:
-            ptr3 = self.inode.getThirdIndirectBlockPtr()
-            if ptr3 == 0:
-                ptr3 = self.disk.getDataBlockPtr(self.disk.allocBlock())
-                self.inode.saveThirdIndirectBlockPtr(ptr3)
-            blockIdL3 = math.floor((blockId - 11 - 256 - 65536) / 65536)
-            self.disk.seek(ptr3 + blockIdL3 * 8)
-            ptr2 = struct.unpack("q", self.disk.read(8))[0]
-            if ptr2 == 0:
-                ptr2 = self.disk.getDataBlockPtr(self.disk.allocBlock())
-                self.disk.seek(ptr3 + blockIdL3 * 8)
-                self.disk.write(struct.pack("q", ptr2))
-            blockIdL2 = (blockId - 11 - 256) % 65536
-            self.disk.seek(ptr2 + blockIdL2 * 8)
-            ptr1 = struct.unpack("q", self.disk.read(8))[0]
-            if ptr1 == 0:
-                ptr1 = self.disk.getDataBlockPtr(self.disk.allocBlock())
-                self.disk.seek(ptr2 + blockIdL2 * 8)
-                self.disk.write(struct.pack("q", ptr1))
-            blockIdL1 = (blockId - 11) % 256
-            self.disk.seek(ptr1 + blockIdL1 * 8)
-            ptr0 = struct.unpack("q", self.disk.read(8))[0]
-            if ptr0 == 0:
-                ptr0 = self.disk.getDataBlockPtr(self.disk.allocBlock())
-                self.disk.seek(ptr1 + blockIdL1 * 8)
-                self.disk.write(struct.pack("q", ptr0))
-            return ptr0
-
-    # 释放文件的一个块，如果这个块是上一级的第一个块，则上一级所占的空间也会被释放
-    def releaseIfUsed(self, blockId):
-        if blockId <= 10:
-            ptr0 = self.inode.getDirBlockPtr(blockId)
-            if ptr0 != 0:
-                self.disk.releaseBlock(self.disk.getDataBlockNum(ptr0))
-                self.inode.saveDirBlockPtr(blockId, 0)
+        ptr = self.getBlockPtr(blockId)
+        if ptr != 0:
+            return ptr
+        return self.walkIndexPath(blockId, True)[-1][2]
+
+    # 收集指针块ptr（覆盖从base开始的span个逻辑块）下逻辑块号不小于keep的所有块的地址，数据块放进freed，
+    # 指针块放进freedIndex。保留下来的指针块中被截掉的槽位一次清零；整块都不再需要时返回True，由调用者释放ptr本身
+    def releaseSubtree(self, ptr: int, base: int, span: int, keep: int, freed: list, freedIndex: list):
+        if keep >= base + span:
+            return False
+        fanout = self.disk.indexFanout
+        childSpan = span >> self.disk.indexShift
+        block = struct.unpack(self.disk.indexFormat, self.disk.readAt(ptr, self.disk.blockSize))
+        firstSlot = 0 if keep <= base else min(fanout, (keep - base + childSpan - 1) // childSpan)
+        for slot in range(firstSlot, fanout):
+            child = block[slot]
+            if child == 0:
+                continue
+            if childSpan > 1:
+                childBase = base + slot * childSpan
+                self.releaseSubtree(child, childBase, childSpan, childBase, freed, freedIndex)
+                freedIndex.append(child)
+            else:
+                freed.append(child)
+        if keep <= base:
+            self.inode.indexBlocks.pop(ptr, None)
+            return True
+        if childSpan > 1 and (keep - base) % childSpan != 0:
+            # keep所在的下级指针块只截掉后一部分
+            slot = (keep - base) // childSpan
+            if block[slot] != 0:
+                self.releaseSubtree(block[slot], base + slot * childSpan, childSpan, keep, freed, freedIndex)
+        if any(block[firstSlot:]):
+            self.disk.writeAt(ptr + firstSlot * 8, bytes((fanout - firstSlot) * 8))
+            cached = self.inode.indexBlocks.get(ptr)
+            if cached is not None:
+                cached[firstSlot:] = [0] * (fanout - firstSlot)
+        return False
+
+    # 把文件用到的指针块的块号加入indexBlocks，数据块的块号加入dataBlocks
+    def collectBlocks(self, indexBlocks: set, dataBlocks: set):
+        if self.inode.isInline():
             return
-
-        # 通过一级指针释放占用
-        if blockId <= 10 + 256:
-            # 先找到一级指针块
-            ptr1 = self.inode.getIndirectBlockPtr()
-            # 如果一级指针块不存在就直接return
-            if ptr1 == 0:
-                return
-            # 计算是一级指针的第几个块
-            blockIdL1 = blockId - 11
-            # 获取一级指针指向的块地址
-            self.disk.seek(ptr1 + blockIdL1 * 8)
-            ptr0 = struct.unpack("q", self.disk.read(8))[0]
-            # 释放一级指针指向的块（如果有）
-            if ptr0 != 0:
-                self.disk.releaseBlock(self.disk.getDataBlockNum(ptr0))
-                # 把一级指针的块地址设成0
-                self.disk.seek(ptr1 + blockIdL1 * 8)
-                self.disk.write(bytes(8))
-            # 如果一级指针空了，就释放一级指针块
-            if blockIdL1 == 0:
-                self.disk.releaseBlock(self.disk.getDataBlockNum(ptr1))
-                self.inode.saveIndirectBlockPtr(0)
+        blockPtrs = self.inode.blockPtrs
+        for ptr in blockPtrs[:11]:
+            if ptr != 0:
+                dataBlocks.add(self.disk.getDataBlockNum(abs(ptr)))
+        for slot, depth in ((11, 1), (12, 2), (13, 3)):
+            if blockPtrs[slot] != 0:
+                self.collectSubtree(blockPtrs[slot], depth, indexBlocks, dataBlocks)
+
+    def collectSubtree(self, ptr: int, depth: int, indexBlocks: set, dataBlocks: set):
+        indexBlocks.add(self.disk.getDataBlockNum(ptr))
+        for child in struct.unpack(self.disk.indexFormat, self.disk.readAt(ptr, self.disk.blockSize)):
+            if child == 0:
+                continue
+            if depth > 1:
+                self.collectSubtree(child, depth - 1, indexBlocks, dataBlocks)
+            else:
+                dataBlocks.add(self.disk.getDataBlockNum(abs(child)))
+
+    # 释放逻辑块号不小于keep的所有数据块和不再需要的指针块。整棵指针树只走一遍，位图一次批量释放
+    def releaseBlocksFrom(self, keep: int):
+        # 没有读过的文件也要先建立指针块缓存，释放时会从中去掉对应的项
+        self.getBlockMap()
+        freed = []
+        freedIndex = []
+        blockPtrs = self.inode.blockPtrs
+        for slot in range(keep, 11):
+            if blockPtrs[slot] != 0:
+                freed.append(blockPtrs[slot])
+                blockPtrs[slot] = 0
+        fanout = self.disk.indexFanout
+        for slot, base, span in ((11, 11, fanout), (12, 11 + fanout, fanout ** 2),
+                                 (13, 11 + fanout + fanout ** 2, fanout ** 3)):
+            ptr = blockPtrs[slot]
+            if ptr != 0 and self.releaseSubtree(ptr, base, span, keep, freed, freedIndex):
+                freedIndex.append(ptr)
+                blockPtrs[slot] = 0
+        self.inode.saveBlockPtrs()
+        # 压缩的簇的第一个指针是负数
+        dataBlocks = [self.disk.getDataBlockNum(abs(ptr)) for ptr in freed]
+        indexBlocks = [self.disk.getDataBlockNum(ptr) for ptr in freedIndex]
+        if self.inode.isCompressed():
+            self.disk.addCompressed(0, -len(dataBlocks))
+        self.disk.releaseBlocks(dataBlocks + indexBlocks, dataBlocks + indexBlocks if self.isMetadata else indexBlocks)
+
+    # 改为内联存储或调整内联文件的长度。指针区域中文件尾之后的部分始终为0
+    def resizeInline(self, newSize: int):
+        inode = self.inode
+        if inode.isInline():
+            if newSize < inode.size:
+                self.disk.writeAt(inode.getInlineDataPtr() + newSize, bytes(inode.size - newSize))
             return
-
-        if blockId <= 10 + 256 + 256 * 256:
-            ptr2 = self.inode.getDoubleIndirectBlockPtr()
-            if ptr2 == 0:
+        # 用数据块存储的文件缩小到能放进inode时，把剩下的内容移进inode并释放所有块
+        content = bytearray(min(inode.size, newSize))
+        self.readIntoAt(0, memoryview(content))
+        if inode.size > 0:
+            self.releaseBlocksFrom(0)
+        if inode.isCompressed():
+            self.disk.dropClusters(inode.ptr)
+        inode.blockMap = None
+        inode.indexBlocks = None
+        inode.flags |= INODE_FLAG_INLINE
+        self.disk.writeAt(inode.getInlineDataPtr(), bytes(content) + bytes(INLINE_DATA_SIZE - len(content)))
+
+    # 内联文件变大时改回用数据块存储，返回原来的内容，由调用者在分配好块之后写回
+    def leaveInline(self):
+        inode = self.inode
+        content = bytes(self.disk.readAt(inode.getInlineDataPtr(), inode.size))
+        inode.flags &= ~INODE_FLAG_INLINE
+        inode.blockPtrs = [0] * 14
+        inode.saveBlockPtrs()
+        inode.size = 0
+        return content
+
+    # 变大时新增的部分是空洞（指针为0），读出来是0，写入时才分配块（见fillHoles）
+    def resize(self, newSize: int, save=True):
+        if newSize > self.disk.maxFileSize:
+            raise Exception("文件长度不得超过%d字节。" % self.disk.maxFileSize)
+        with self.disk.operation():
+            if newSize <= INLINE_DATA_SIZE:
+                self.resizeInline(newSize)
+                self.inode.size = newSize
+                if save:
+                    self.inode.save()
                 return
-
-            blockIdL2 = math.floor((blockId - 11 - 256) / 256)
-            self.disk.seek(ptr2 + blockIdL2 * 8)
-            ptr1 = struct.unpack("q", self.disk.read(8))[0]
-            if ptr1 == 0:
+            inlineContent = self.leaveInline() if self.inode.isInline() else b""
+            if self.inode.isCompressed():
+                self.resizeClusters(newSize, inlineContent)
+                if save:
+                    self.inode.save()
                 return
+            nowBlockCount = self.getBlockCount(self.inode.size)
+            newBlockCount = self.getBlockCount(newSize)
+            nowBlockEnd = nowBlockCount << self.disk.blockShift
+            if self.inode.size < newSize and self.inode.size < nowBlockEnd:
+                # 最后一块中原文件尾之后可能残留着缩小前的数据，变大时要清零
+                tailLength = min(newSize, nowBlockEnd) - self.inode.size
+                if self.usesDedup() or self.usesFrozenBlocks():
+                    self.unshareBlock(self.inode.size >> self.disk.blockShift)
+                for diskPtr, offset, n in self.iterExtents(self.inode.size, tailLength):
+                    if diskPtr != 0:
+                        self.disk.writeAt(diskPtr, bytes(n), self.isMetadata)
+                        if metrics.ENABLED:
+                            metrics.count(self.disk.counters, "zeroFillBytes", n)
+            if newBlockCount < nowBlockCount:
+                self.releaseBlocksFrom(newBlockCount)
+                self.getBlockMap().truncate(newBlockCount)
+            if len(inlineContent) > 0:
+                self.inode.size = newSize
+                self.fillHoles(0, len(inlineContent))
+                for diskPtr, offset, n in self.iterExtents(0, len(inlineContent)):
+                    self.disk.writeAt(diskPtr, inlineContent[offset:offset + n], self.isMetadata)
+            self.inode.size = newSize
+            if save:
+                self.inode.save()
 
-            blockIdL1 = (blockId - 11) % 256
-            self.disk.seek(ptr1 + blockIdL1 * 8)
-            ptr0 = struct.unpack("q", self.disk.read(8))[0]
-            if ptr0 == 0:
-                return
-
-            self.disk.releaseBlock(self.disk.getDataBlockNum(ptr0))
-            self.disk.seek(ptr1 + blockIdL1 * 8)
-            self.disk.write(bytes(8))
-
-            if blockIdL1 == 0:
-                self.disk.releaseBlock(self.disk.getDataBlockNum(ptr1))
-                self.disk.seek(ptr2 + blockIdL2 * 8)
-                self.disk.write(bytes(8))
-
-            if blockIdL2 == 0:
-                self.disk.releaseBlock(self.disk.getDataBlockNum(ptr2))
-                self.inode.saveDoubleIndirectBlockPtr(0)
-
+    # 给[pos, pos + length)中的空洞分配块，数据块一次批量分配。会被整块覆盖的新块不用清零。
+    # 空间不足时把这次分配的块都还回去，文件保持原样
+    def fillHoles(self, pos: int, length: int):
+        disk = self.disk
+        end = pos + length
+        firstBlock = pos >> disk.blockShift
+        endBlock = self.getBlockCount(end)
+        self.resolveBlocks(firstBlock, endBlock)
+        blockMap = self.inode.blockMap
+        holes = [i for i in range(firstBlock, endBlock) if blockMap[i] == 0]
+        if len(holes) == 0:
             return
-
-        if blockId <= 10 + 256 + 256 * 256 + 256 * 256 * 256:
-            ptr3 = self.inode.getThirdIndirectBlockPtr()
-            if ptr3 == 0:
-                return
-
-            blockIdL3 = math.floor((blockId - 11 - 256 - 65536) / 65536)
-            self.disk.seek(ptr3 + blockIdL3 * 8)
-            ptr2 = struct.unpack("q", self.disk.read(8))[0]
-            if ptr2 == 0:
-                return
-
-            blockIdL2 = (blockId - 11 - 256) % 65536
-            self.disk.seek(ptr2 + blockIdL2 * 8)
-            ptr1 = struct.unpack("q", self.disk.read(8))[0]
-            if ptr1 == 0:
-                return
-
-            blockIdL1 = (blockId - 11) % 256
-            self.disk.seek(ptr1 + blockIdL1 * 8)
-            ptr0 = struct.unpack("q", self.disk.read(8))[0]
-            if ptr0 == 0:
-                return
-
-            self.disk.releaseBlock(self.disk.getDataBlockNum(ptr0))
-            self.disk.seek(ptr1 + blockIdL1 * 8)
-            self.disk.write(bytes(8))
-
-            if blockIdL1 == 0:
-                self.disk.releaseBlock(self.disk.getDataBlockNum(ptr1))
-                self.disk.seek(ptr2 + blockIdL2 * 8)
-                self.disk.write(bytes(8))
-
-            if blockIdL2 == 0:
-                self.disk.releaseBlock(self.disk.getDataBlockNum(ptr2))
-                self.disk.seek(ptr3 + blockIdL3 * 8)
-                self.disk.write(bytes(8))
-
-            if blockIdL3 == 0:
-                self.disk.releaseBlock(self.disk.getDataBlockNum(ptr3))
-                self.inode.saveThirdIndirectBlockPtr(0)
-
-    def resize(self, newSize: int):
-        nowBlockCount = math.ceil(self.inode.size / 2048)
-        if newSize >= nowBlockCount * 2048:
-            if math.ceil(newSize / 2048) - nowBlockCount > self.disk.dataBlockLeft:
-                raise Exception("剩余空间不足！")
-            for i in range(nowBlockCount, math.ceil(newSize / 2048)):
-                self.getBlockStartPtrOrAlloc(i)
-                self.inode.size += 2048
-                self.inode.save()
-        elif newSize <= nowBlockCount * 2048 - 2048:
-            for i in range(nowBlockCount - 1, math.ceil(newSize / 2048) - 1, -1):
-                self.releaseIfUsed(i)
-                self.inode.size -= 2048
-                self.inode.save()
+        self.blockPool.extend(disk.allocBlocks(len(holes), False))
+        filled = []
+        try:
+            for blockId in holes:
+                ptr = self.getBlockStartPtrOrAlloc(blockId)
+                filled.append(blockId)
+                blockStart = blockId << disk.blockShift
+                if pos > blockStart or end < blockStart + disk.blockSize:
+                    disk.writeAt(ptr, bytes(disk.blockSize), False)
+                    if metrics.ENABLED:
+                        metrics.count(disk.counters, "zeroFillBytes", disk.blockSize)
+        except Exception:
+            # 已经补上的块改回空洞，新分配的指针块留在文件里，以后写入时还能用上
+            blockIds = [disk.getDataBlockNum(blockMap[i]) for i in filled]
+            for blockId in filled:
+                self.setBlockPtr(blockId, 0)
+            disk.releaseBlocks(blockIds)
+            raise
+        finally:
+            while len(self.blockPool) > 0:
+                disk.releaseBlock(self.blockPool.pop())
+
+    # 压缩文件改变长度。变大时只改长度，没有写过的簇不占用块，读出来是0；
+    # 缩小时重写被截断的那一簇，释放之后的所有块
+    def resizeClusters(self, newSize: int, inlineContent: bytes):
+        clusterSize = self.disk.clusterSize
+        if newSize < self.inode.size:
+            keepClusters = (newSize + clusterSize - 1) // clusterSize
+            if newSize % clusterSize != 0:
+                clusterId = newSize // clusterSize
+                self.storeCluster(clusterId, self.loadCluster(clusterId)[:newSize % clusterSize])
+            self.releaseBlocksFrom(keepClusters * CLUSTER_BLOCKS)
+            self.getBlockMap().truncate(keepClusters * CLUSTER_BLOCKS)
+            self.disk.dropClusters(self.inode.ptr, keepClusters)
         self.inode.size = newSize
+        if len(inlineContent) > 0:
+            self.storeCluster(0, inlineContent)
+
+    # 读出一簇解压后的完整内容，文件尾之后和没有写过的部分为0。
+    # 压缩的簇第一个指针取负，数据以4字节的压缩后长度开头，依次存放在前几个指针指向的块中
+    def loadCluster(self, clusterId: int) -> bytes:
+        key = (self.inode.ptr, clusterId)
+        content = self.disk.getCachedCluster(key)
+        if content is not None:
+            return content
+        blockSize = self.disk.blockSize
+        clusterSize = self.disk.clusterSize
+        firstBlock = clusterId * CLUSTER_BLOCKS
+        self.resolveBlocks(firstBlock, firstBlock + CLUSTER_BLOCKS)
+        ptrs = self.inode.blockMap.getRange(firstBlock, firstBlock + CLUSTER_BLOCKS)
+        if ptrs[0] < 0:
+            first = self.disk.readAt(-ptrs[0], blockSize)
+            length = struct.unpack_from("I", first)[0]
+            blockCount = (length + 4 + blockSize - 1) // blockSize
+            stored = b"".join([first] + [self.disk.readAt(abs(ptr), blockSize) for ptr in ptrs[1:blockCount]])
+            content = decompressCluster(self.inode.flags, stored[4:4 + length])
+            if metrics.ENABLED:
+                metrics.count(self.disk.counters, "clusterDecompressions")
+        else:
+            content = b"".join(bytes(blockSize) if ptr == 0 else self.disk.readAt(ptr, blockSize) for ptr in ptrs)
+        content = bytes(content) + bytes(clusterSize - len(content))
+        self.disk.putCachedCluster(key, content)
+        return content
+
+    # 写入一簇的内容（不超过一簇，之后的部分视为0）。能省下至少一块时压缩存放，全为0时不占用块。
+    # 尽量复用这一簇原来的块，多余的释放，不够的再分配
+    def storeCluster(self, clusterId: int, content):
+        blockSize = self.disk.blockSize
+        firstBlock = clusterId * CLUSTER_BLOCKS
+        self.resolveBlocks(firstBlock, firstBlock + CLUSTER_BLOCKS)
+        oldPtrs = [abs(ptr) for ptr in self.inode.blockMap.getRange(firstBlock, firstBlock + CLUSTER_BLOCKS)
+                   if ptr != 0]
+        oldBlockCount = len(oldPtrs)
+        if self.disk.frozenBits is not None:
+            # 快照还在用的块不能覆盖，交给releaseBlocks后另外分配
+            frozen = [self.disk.getDataBlockNum(ptr) for ptr in oldPtrs
+                      if self.disk.isFrozen(self.disk.getDataBlockNum(ptr))]
+            if len(frozen) > 0:
+                self.disk.releaseBlocks(frozen)
+                oldPtrs = [ptr for ptr in oldPtrs if not self.disk.isFrozen(self.disk.getDataBlockNum(ptr))]
+        content = bytes(content).rstrip(b"\0")
+        stored = content
+        isCompressed = False
+        if len(content) > 0:
+            packed = compressCluster(self.inode.flags, content)
+            rawBlockCount = (len(content) + blockSize - 1) // blockSize
+            if (len(packed) + 4 + blockSize - 1) // blockSize < rawBlockCount:
+                stored = struct.pack("I", len(packed)) + packed
+                isCompressed = True
+            if metrics.ENABLED:
+                metrics.count(self.disk.counters, "clusterCompressions")
+        blockCount = (len(stored) + blockSize - 1) // blockSize
+        if blockCount > len(oldPtrs):
+            newBlocks = self.disk.allocBlocks(blockCount - len(oldPtrs), False)
+            ptrs = oldPtrs + [self.disk.getDataBlockPtr(i) for i in newBlocks]
+        else:
+            ptrs = oldPtrs[:blockCount]
+            self.disk.releaseBlocks([self.disk.getDataBlockNum(ptr) for ptr in oldPtrs[blockCount:]])
+        # 物理上相邻的块一起写，最后一块补0
+        i = 0
+        while i < blockCount:
+            j = i + 1
+            while j < blockCount and ptrs[j] == ptrs[j - 1] + blockSize:
+                j += 1
+            chunk = stored[i * blockSize:j * blockSize]
+            self.disk.writeAt(ptrs[i], chunk + bytes((j - i) * blockSize - len(chunk)), False)
+            i = j
+        for i in range(CLUSTER_BLOCKS):
+            ptr = ptrs[i] if i < blockCount else 0
+            if i == 0 and isCompressed:
+                ptr = -ptr
+            if self.inode.blockMap[firstBlock + i] != ptr:
+                self.setBlockPtr(firstBlock + i, ptr)
+        self.disk.addCompressed(0, blockCount - oldBlockCount)
+        self.disk.putCachedCluster((self.inode.ptr, clusterId), content + bytes(self.disk.clusterSize - len(content)))
+
+    # 把content写到压缩文件的pos处，文件长度已经调整好。整簇覆盖时不用先读出原来的内容
+    def writeClusters(self, pos: int, content):
+        clusterSize = self.disk.clusterSize
+        end = pos + len(content)
+        for clusterId in range(pos // clusterSize, (end + clusterSize - 1) // clusterSize):
+            clusterStart = clusterId * clusterSize
+            low = max(pos, clusterStart) - clusterStart
+            high = min(end, clusterStart + clusterSize) - clusterStart
+            validLength = min(clusterSize, self.inode.size - clusterStart)
+            part = content[clusterStart + low - pos:clusterStart + high - pos]
+            if low == 0 and high >= validLength:
+                self.storeCluster(clusterId, part)
+                continue
+            cluster = bytearray(self.loadCluster(clusterId)[:validLength])
+            cluster[low:high] = part
+            self.storeCluster(clusterId, cluster)
+
+    # 从压缩文件中读出[pos, pos + len(view))
+    def readClustersInto(self, pos: int, view: memoryview):
+        clusterSize = self.disk.clusterSize
+        done = 0
+        while done < len(view):
+            clusterId, offset = divmod(pos + done, clusterSize)
+            n = min(clusterSize - offset, len(view) - done)
+            view[done:done + n] = self.loadCluster(clusterId)[offset:offset + n]
+            done += n
+
+    # 去重只用于空间打开了去重的普通文件，压缩文件和内联文件除外
+    def usesDedup(self):
+        return self.disk.dedup and not self.isMetadata and not self.inode.isCompressed() and not self.inode.isInline()
+
+    # 空间有快照时，普通文件的块可能被快照冻结
+    def usesFrozenBlocks(self):
+        return self.disk.frozenBits is not None and not self.isMetadata
+
+    # 准备原地修改逻辑块blockId：与其他文件共用或被快照冻结时先复制一份（写时复制），原来的哈希也不再有效。
+    # 返回修改后的地址。调用者会覆盖整块时不必复制原来的内容（copy=False）
+    def unshareBlock(self, blockId: int, copy=True):
+        disk = self.disk
+        ptr = self.getBlockPtr(blockId)
+        if ptr == 0:
+            return 0
+        blockNum = disk.getDataBlockNum(ptr)
+        if disk.isShared(blockNum) or disk.isFrozen(blockNum):
+            newNum = disk.allocBlocks(1, False)[0]
+            newPtr = disk.getDataBlockPtr(newNum)
+            if copy:
+                disk.writeAt(newPtr, bytes(disk.readAt(ptr, disk.blockSize)), False)
+            disk.releaseBlocks([blockNum])
+            self.setBlockPtr(blockId, newPtr)
+            return newPtr
+        if disk.dedup:
+            disk.setBlockHash(blockNum, 0)
+        return ptr
+
+    # 写入[pos, pos + length)之前，把其中被快照冻结的块换成新块，只写一部分的块要复制原来的内容
+    def unfreezeBlocks(self, pos: int, length: int):
+        disk = self.disk
+        end = pos + length
+        for blockId in range(pos >> disk.blockShift, self.getBlockCount(end)):
+            ptr = self.getBlockPtr(blockId)
+            if ptr == 0 or not disk.isFrozen(disk.getDataBlockNum(ptr)):
+                continue
+            blockStart = blockId << disk.blockShift
+            self.unshareBlock(blockId, pos > blockStart or end < blockStart + disk.blockSize)
+
+    # 在去重的文件中写入，文件长度已经调整好。整块写入时先按哈希找内容相同的块，
+    # 找到就改为引用它并释放原来的块；否则写入自己的块（空洞时新分配，共用时先复制）并记下哈希
+    def writeBlocksDedup(self, pos: int, content):
+        disk = self.disk
+        blockSize = disk.blockSize
+        end = pos + len(content)
+        for blockId in range(pos >> disk.blockShift, self.getBlockCount(end)):
+            blockStart = blockId << disk.blockShift
+            low = max(pos, blockStart) - blockStart
+            high = min(end, blockStart + blockSize) - blockStart
+            part = content[blockStart + low - pos:blockStart + high - pos]
+            if high - low < blockSize:
+                ptr = self.unshareBlock(blockId) or self.getBlockStartPtrOrAlloc(blockId)
+                disk.writeAt(ptr + low, part, False)
+                continue
+            ptr = self.getBlockPtr(blockId)
+            blockNum = disk.getDataBlockNum(ptr) if ptr != 0 else None
+            blockHash = disk.hashBlock(part)
+            duplicate = disk.findDuplicate(blockHash, part)
+            if duplicate == blockNum:
+                continue
+            if duplicate != -1:
+                disk.setExtraRefs(duplicate, disk.extraRefs[duplicate] + 1)
+                self.setBlockPtr(blockId, disk.getDataBlockPtr(duplicate))
+                if ptr != 0:
+                    disk.releaseBlocks([blockNum])
+                if metrics.ENABLED:
+                    metrics.count(disk.counters, "dedupHits")
+                continue
+            if ptr == 0:
+                ptr = disk.getDataBlockPtr(disk.allocBlocks(1, False)[0])
+                self.setBlockPtr(blockId, ptr)
+            else:
+                ptr = self.unshareBlock(blockId, False)
+            disk.writeAt(ptr, part, False)
+            disk.setBlockHash(disk.getDataBlockNum(ptr), blockHash)
+
+    # 设置文件的压缩方式，只能在文件为空时设置
+    def setCompression(self, compression: str):
+        self.disk.checkCompression(compression)
+        with self.disk.operation():
+            if self.inode.size > 0:
+                raise Exception("只能给空文件设置压缩方式。")
+            self.inode.flags = self.inode.flags & ~INODE_COMPRESSION_MASK | INODE_COMPRESSION_FLAGS[compression]
+            self.inode.save()
 
     def getSize(self):
         return self.inode.size
 
+    # 长度为size的内容占用的块数
+    def getBlockCount(self, size: int):
+        return (size + self.disk.blockSize - 1) >> self.disk.blockShift
+
     def seek(self, ptr: int):
         if ptr < 0:
             raise Exception("Pointer of a file should be greater than 0.")
@@ -445,122 +1953,275 @@ class HbFile:
             self.resize(ptr)
         self.nowPtr = ptr
 
-    def loadBlockPtr(self):
-        # 如果指针对应的块还没有找到，则找到对应的块并缓存指针
-        if self.nowBlockId == -1 or not ((self.nowBlockId >> 11) < self.nowPtr < ((self.nowBlockId + 1) >> 11)):
-            newBid = self.nowPtr >> 11
-            self.nowBlockStartPtr = self.getBlockStartPtrOrAlloc(newBid)
-            if self.nowBlockStartPtr < 0:
-                raise Exception()
-            self.nowBlockId = newBid
+    # 把文件中[pos, pos + length)拆成若干段磁盘上连续的区域，返回(磁盘地址, 段内偏移, 长度)，地址为0表示没有分配块
+    def iterExtents(self, pos: int, length: int):
+        if length <= 0:
+            return
+        if self.inode.isInline():
+            yield self.inode.getInlineDataPtr() + pos, 0, length
+            return
+        blockSize = self.disk.blockSize
+        self.resolveBlocks(pos >> self.disk.blockShift, self.getBlockCount(pos + length))
+        blockMap = self.inode.blockMap
+        done = 0
+        while done < length:
+            blockId, offsetInBlock = divmod(pos + done, blockSize)
+            ptr = blockMap[blockId]
+            startPtr = ptr + offsetInBlock if ptr != 0 else 0
+            n = min(blockSize - offsetInBlock, length - done)
+            # 合并物理上相邻的后续块
+            while done + n < length:
+                nextPtr = blockMap[blockId + 1]
+                if (ptr == 0 and nextPtr != 0) or (ptr != 0 and nextPtr != ptr + blockSize):
+                    break
+                blockId += 1
+                ptr = nextPtr
+                n += min(blockSize, length - done - n)
+            yield startPtr, done, n
+            done += n
+
+    # 从文件的pos处开始读，填满view或读到文件尾为止，不移动nowPtr。返回读到的字节数
+    def readIntoAt(self, pos: int, view: memoryview):
+        with self.disk.lock.readLocked():
+            length = max(0, min(len(view), self.inode.size - pos))
+            if self.inode.isCompressed() and not self.inode.isInline():
+                self.readClustersInto(pos, view[:length])
+                return length
+            for diskPtr, offset, n in self.iterExtents(pos, length):
+                if diskPtr == 0:
+                    view[offset:offset + n] = bytes(n)
+                else:
+                    view[offset:offset + n] = self.disk.readAt(diskPtr, n)
+            return length
+
+    # 读到预先分配好的bytearray/memoryview中，返回读到的字节数
+    def readinto(self, buffer):
+        n = self.readIntoAt(self.nowPtr, memoryview(buffer).cast("B"))
+        self.nowPtr += n
+        return n
 
     def read(self, readLength=0):
-        result = bytes(0)
         if readLength < 0:
             raise Exception("Read length should be greater than 0.")
         if readLength == 0:
             readLength = self.inode.size - self.nowPtr
-        readLength = min(self.inode.size - self.nowPtr, readLength)
-        while readLength > 0:
-            self.loadBlockPtr()
-            readLengthInBlock = min(2048 - self.nowPtr % 2048, readLength)
-            self.disk.seek(self.nowBlockStartPtr + self.nowPtr % 2048)
-            self.nowPtr += readLengthInBlock
-            result += self.disk.read(readLengthInBlock)
-            readLength -= readLengthInBlock
-        return result
+        readLength = max(0, min(self.inode.size - self.nowPtr, readLength))
+        result = bytearray(readLength)
+        self.readinto(result)
+        return bytes(result)
+
+    # 按块对齐分段读出文件中[pos, end)的部分，pos默认为nowPtr，end默认为文件尾，每段不超过chunkSize，不移动nowPtr。
+    # 每段单独取读锁，下载大文件时不会一直挡住写操作
+    def iterChunks(self, chunkSize: int = DEFAULT_CHUNK_SIZE, pos: int = -1, end: int = -1):
+        blockShift = self.disk.blockShift
+        chunkSize = max(self.disk.blockSize, chunkSize >> blockShift << blockShift)
+        if pos == -1:
+            pos = self.nowPtr
+        while pos < self.inode.size and (end == -1 or pos < end):
+            chunkEnd = min((pos // chunkSize + 1) * chunkSize, self.inode.size)
+            if end != -1:
+                chunkEnd = min(chunkEnd, end)
+            chunk = bytearray(chunkEnd - pos)
+            self.readIntoAt(pos, memoryview(chunk))
+            pos = chunkEnd
+            yield bytes(chunk)
 
     def write(self, content: bytes, w=False):
-        if w:
-            self.nowPtr = 0
-            self.resize(len(content))
-        elif self.inode.size < len(content) + self.nowPtr:
-            self.resize(len(content) + self.nowPtr)
-
-        # writeLenTotal = len(content)
-        writeStartIndex = 0
-        lengthLeft = len(content)
-        while lengthLeft > 0:
-            writeLength = min(lengthLeft, 2048 - self.nowPtr % 2048)
-            self.loadBlockPtr()
-            self.disk.seek(self.nowBlockStartPtr + self.nowPtr % 2048)
-            self.disk.write(content[writeStartIndex:writeStartIndex + writeLength])
-            self.nowPtr += writeLength
-            writeStartIndex += writeLength
-            lengthLeft -= writeLength
-        self.inode.save()
+        with self.disk.operation():
+            oldSize = self.inode.size
+            if w:
+                self.nowPtr = 0
+                if self.inode.isCompressed():
+                    # 整个文件重写，被截断的簇不必先重新压缩一遍
+                    self.resize(0, False)
+                self.resize(len(content), False)
+            elif self.inode.size < len(content) + self.nowPtr:
+                self.resize(len(content) + self.nowPtr, False)
+
+            content = memoryview(content)
+            try:
+                self.writeContent(content)
+            except Exception:
+                # 空间不足等写入失败时，追加写入的文件恢复原来的长度
+                if not w and self.inode.size != oldSize:
+                    self.resize(oldSize)
+                raise
+            self.nowPtr += len(content)
+            self.inode.save()
+
+    # 把content写到nowPtr处，文件长度已经调整好
+    def writeContent(self, content: memoryview):
+        if self.inode.isCompressed() and not self.inode.isInline():
+            self.writeClusters(self.nowPtr, content)
+        elif self.usesDedup():
+            self.writeBlocksDedup(self.nowPtr, content)
+        else:
+            # 内联的内容在inode里，和其他元数据一样要进日志
+            isMeta = self.isMetadata or self.inode.isInline()
+            if not self.inode.isInline():
+                self.fillHoles(self.nowPtr, len(content))
+                if self.usesFrozenBlocks():
+                    self.unfreezeBlocks(self.nowPtr, len(content))
+            for diskPtr, offset, n in self.iterExtents(self.nowPtr, len(content)):
+                self.disk.writeAt(diskPtr, content[offset:offset + n], isMeta)
+
+    # 从流中分段读入并从nowPtr开始写，内存占用不超过chunkSize，每段是一次单独的操作。
+    # sizeHint为预计写入的长度，大于0时先一次分配好所有块，最后按实际长度截断。返回写入的字节数
+    def writeFrom(self, stream, sizeHint: int = -1, chunkSize: int = DEFAULT_UPLOAD_CHUNK_SIZE):
+        start = self.nowPtr
+        if sizeHint > 0 and start + sizeHint > self.inode.size:
+            with self.disk.operation():
+                self.resize(start + sizeHint)
+                if not self.inode.isInline() and not self.inode.isCompressed() and not self.usesDedup():
+                    # 预分配的块马上会被流中的数据覆盖，不需要清零
+                    self.fillHoles(start, sizeHint)
+        buffer = bytearray(chunkSize)
+        view = memoryview(buffer)
+        readinto = getattr(stream, "readinto", None)
+        total = 0
+        while True:
+            # 攒满一段再写，网络流每次可能只返回很少的数据
+            n = 0
+            while n < chunkSize:
+                if readinto is not None:
+                    got = readinto(view[n:])
+                else:
+                    chunk = stream.read(chunkSize - n)
+                    got = len(chunk)
+                    view[n:n + got] = chunk
+                if not got:
+                    break
+                n += got
+            if n == 0:
+                break
+            self.write(view[:n])
+            total += n
+            if n < chunkSize:
+                break
+        if total < sizeHint and self.inode.size == start + sizeHint:
+            self.resize(start + total)
+        return total
+
+
+# 目录项格式：inode地址(8) + 类型(1) + 文件名长度(1) + 文件名。被删除的目录项类型改为TOMBSTONE，原地保留
+TOMBSTONE = 255
+# 墓碑占用的字节数超过这个值并且超过有效目录项时，整理整个目录
+COMPACT_MIN_DEAD_BYTES = 4096
 
 
 class HbDirEntry:
-    def __init__(self, inodePtr: int, fileType: int, fileName: str):
+    def __init__(self, inodePtr: int, fileType: int, fileName: str, offset: int = -1):
         self.fileName = fileName
         self.fileType = fileType
         self.inodePtr = inodePtr
+        # 目录项在目录文件中的位置
+        self.offset = offset
+
+    def toBytes(self):
+        fileNameBytes = self.fileName.encode()
+        return struct.pack("qBB", self.inodePtr, self.fileType, len(fileNameBytes)) + fileNameBytes
 
 
 class HbFolder(HbFile):
+    isMetadata = True
+
     def __init__(self, disk: HbDisk, path: str, inode: INode):
         super().__init__(disk, path, inode)
-        self.fileList: list[HbDirEntry] = []
-        if self.getSize() == 0:
-            return
-        fileListBytes = self.read()
-        reader = io.BytesIO(fileListBytes)
-
-        while True:
-            aa = reader.read(8)
-            if len(aa) == 0:
-                return
-            inodePtr = struct.unpack("q", aa)[0]
-            fileType = reader.read(1)[0]
-            fileNameLength = reader.read(1)[0]
-            fileName = reader.read(fileNameLength).decode()
-            self.fileList.append(HbDirEntry(inodePtr, fileType, fileName))
-
+        # 目录索引挂在INode上，同一目录的所有HbFolder对象共用
+        # 先取空间锁再取文件锁，和写操作的加锁顺序一致
+        with disk.lock.readLocked(), inode.lock:
+            if inode.dirEntries is None:
+                self.loadEntries()
+        self.entries: dict[str, HbDirEntry] = inode.dirEntries
+
+    def loadEntries(self):
+        entries = {}
+        deadBytes = 0
+        fileListBytes = bytearray(self.getSize())
+        self.readIntoAt(0, memoryview(fileListBytes))
+        offset = 0
+        while offset < len(fileListBytes):
+            inodePtr, fileType, fileNameLength = struct.unpack_from("qBB", fileListBytes, offset)
+            entryLength = 10 + fileNameLength
+            if fileType == TOMBSTONE:
+                deadBytes += entryLength
+            else:
+                fileName = fileListBytes[offset + 10:offset + entryLength].decode()
+                entries[fileName] = HbDirEntry(inodePtr, fileType, fileName, offset)
+            offset += entryLength
+        self.inode.dirEntries = entries
+        self.inode.dirDeadBytes = deadBytes
+
+    @property
+    def fileList(self) -> list[HbDirEntry]:
+        return list(self.entries.values())
+
+    # 整理目录：去掉所有墓碑，整体重写
     def save(self):
-        ans = bytes(0)
-        for entry in self.fileList:
-            ans += struct.pack('q', entry.inodePtr)
-            ans += bytes([entry.fileType])
-            fileNameBytes = entry.fileName.encode()
-            ans += bytes([len(fileNameBytes)])
-            ans += fileNameBytes
-        self.write(ans, True)
+        parts = []
+        offset = 0
+        for entry in self.entries.values():
+            entry.offset = offset
+            entryBytes = entry.toBytes()
+            parts.append(entryBytes)
+            offset += len(entryBytes)
+        self.write(b"".join(parts), True)
+        self.inode.dirDeadBytes = 0
+
+    # 在目录文件末尾追加一个目录项
+    def appendEntry(self, entry: HbDirEntry):
+        entry.offset = self.getSize()
+        self.entries[entry.fileName] = entry
+        self.seek(entry.offset)
+        self.write(entry.toBytes())
+
+    # 把目录项原地标记为墓碑，必要时整理目录
+    def removeEntry(self, entry: HbDirEntry):
+        self.entries.pop(entry.fileName, None)
+        self.seek(entry.offset + 8)
+        self.write(bytes([TOMBSTONE]))
+        self.inode.dirDeadBytes += 10 + len(entry.fileName.encode())
+        if self.inode.dirDeadBytes > COMPACT_MIN_DEAD_BYTES and self.inode.dirDeadBytes > self.getSize() // 2:
+            self.save()
 
     def findFileEntry(self, fileName: str):
-        for entry in self.fileList:
-            if entry.fileName == fileName:
-                return entry
-        return None
+        return self.entries.get(fileName)
 
     def createDir(self, dirName: str):
         if self.findFileEntry(dirName) is not None:
             raise Exception("该文件名已经被占用。")
-        inode = INode(self.disk, self.disk.allocINode(), isNew=True)
-        self.fileList.append(HbDirEntry(inode.ptr, 1, dirName))
-        self.save()
-        f = HbFolder(self.disk, "", inode)
-        # 添加.和..
-        f.fileList.append(HbDirEntry(self.inode.ptr, 1, '..'))
-        f.fileList.append(HbDirEntry(inode.ptr, 1, "."))
-        f.save()
-
-    def createFile(self, fileName):
+        with self.disk.operation():
+            inode = self.disk.createINode()
+            self.appendEntry(HbDirEntry(inode.ptr, 1, dirName))
+            f = HbFolder(self.disk, "", inode)
+            # 添加.和..
+            f.entries['..'] = HbDirEntry(self.inode.ptr, 1, '..')
+            f.entries["."] = HbDirEntry(inode.ptr, 1, ".")
+            f.save()
+
+    # compression为None时使用空间默认的压缩方式
+    def createFile(self, fileName, compression: str = None):
+        if compression is None:
+            compression = self.disk.compression
+        self.disk.checkCompression(compression)
         if self.findFileEntry(fileName) is not None:
             raise Exception("该文件名已经被占用。")
-        if len(fileName) > 255:
+        if len(fileName.encode()) > 255:
             raise Exception("新文件名长度不得大于255。")
         if len(fileName) == 0:
             raise Exception("新文件名不得为空。")
         if fileName.find('/') > 0:
             raise Exception("新文件名不得包含'/'。")
-        inode = INode(self.disk, self.disk.allocINode(), isNew=True)
-        self.fileList.append(HbDirEntry(inode.ptr, 0, fileName))
-        self.save()
-        return HbFile(self.disk, "", inode)
+        with self.disk.operation():
+            inode = self.disk.createINode()
+            self.appendEntry(HbDirEntry(inode.ptr, 0, fileName))
+            file = HbFile(self.disk, "", inode)
+            if compression != "":
+                file.setCompression(compression)
+            return file
 
     def renameSubFile(self, oldName, newName):
-        if len(newName) > 255:
+        if len(newName.encode()) > 255:
             raise Exception("新文件名长度不得大于255。")
         if len(newName) == 0:
             raise Exception("新文件名不得为空。")
@@ -569,29 +2230,51 @@ class HbFolder(HbFile):
         entry = self.findFileEntry(oldName)
         if entry is None:
             raise Exception("未找到该文件。")
-        entry.fileName = newName
-        self.save()
+        if self.findFileEntry(newName) is not None:
+            raise Exception("该文件名已经被占用。")
+        with self.disk.operation():
+            if len(newName.encode()) == len(oldName.encode()):
+                # 长度不变时原地改名
+                self.entries.pop(oldName)
+                entry.fileName = newName
+                self.entries[newName] = entry
+                self.seek(entry.offset + 10)
+                self.write(newName.encode())
+                return
+            self.removeEntry(entry)
+            self.appendEntry(HbDirEntry(entry.inodePtr, entry.fileType, newName))
 
-    def deleteSubFile(self, fileName, recursive=False):
+    # deferred为True时只去掉目录项，文件占用的空间由后台线程回收
+    def deleteSubFile(self, fileName, recursive=False, deferred=False):
         entry = self.findFileEntry(fileName)
         if entry is None:
             raise Exception("未找到该文件。")
-        self.deleteEntry(entry, recursive)
-        self.fileList.remove(entry)
-        self.save()
+        if deferred:
+            self.checkDeletable(entry, recursive)
+            with self.disk.operation():
+                self.removeEntry(entry)
+            self.disk.deferDelete(entry.inodePtr, entry.fileType)
+            return
+        with self.disk.operation():
+            self.deleteEntry(entry, recursive)
+            self.removeEntry(entry)
 
-    def deleteEntry(self, entry, recursive):
+    @staticmethod
+    def checkDeletable(entry, recursive):
         if entry.fileName == '..' or entry.fileName == '.':
-            raise "你不能删除这个文件夹。"
+            raise Exception("你不能删除这个文件夹。")
+        if entry.fileType == 1 and not recursive:
+            raise Exception("Folder cannot be deleted without recursive mode.")
+
+    def deleteEntry(self, entry, recursive):
+        self.checkDeletable(entry, recursive)
         if entry.fileType != 1:
-            file = HbFile(self.disk, "", INode(disk=self.disk, inodePtr=entry.inodePtr))
+            file = HbFile(self.disk, "", self.disk.getINode(inodePtr=entry.inodePtr))
             file.resize(0)
-        elif recursive:
-            folder = HbFolder(self.disk, "", INode(disk=self.disk, inodePtr=entry.inodePtr))
+        else:
+            folder = HbFolder(self.disk, "", self.disk.getINode(inodePtr=entry.inodePtr))
             folder.deleteAllSubFile()
             folder.resize(0)
-        else:
-            raise Exception("Folder cannot be deleted without recursive mode.")
         self.disk.releaseINode(self.disk.getINodeNumber(entry.inodePtr))
 
     def getFile(self, fileName: str):
@@ -599,11 +2282,26 @@ class HbFolder(HbFile):
         if entry is None:
             raise Exception("未找到该文件。")
         if entry.fileType == 0:
-            return HbFile(self.disk, "", INode(disk=self.disk, inodePtr=entry.inodePtr))
+            return HbFile(self.disk, "", self.disk.getINode(inodePtr=entry.inodePtr))
         elif entry.fileType == 1:
-            return HbFolder(self.disk, "", INode(disk=self.disk, inodePtr=entry.inodePtr))
+            return HbFolder(self.disk, "", self.disk.getINode(inodePtr=entry.inodePtr))
 
     def deleteAllSubFile(self):
         for entry in self.fileList:
             if entry.fileName != '..' and entry.fileName != '.':
                 self.deleteEntry(entry, True)
+
+
+# 回收一个已经不在任何目录中的文件或目录。大文件从尾部分段截断，每段是一次单独的操作，不会长时间挡住其他请求
+def reclaimINode(disk: HbDisk, inodePtr: int, fileType: int):
+    inode = disk.getINode(inodePtr=inodePtr)
+    if fileType == 1:
+        folder = HbFolder(disk, "", inode)
+        for entry in folder.fileList:
+            if entry.fileName != '..' and entry.fileName != '.':
+                reclaimINode(disk, entry.inodePtr, entry.fileType)
+    file = HbFile(disk, "", inode)
+    while file.getSize() > 0:
+        file.resize(max(0, file.getSize() - RECLAIM_STEP))
+    with disk.operation():
+        disk.releaseINode(disk.getINodeNumber(inodePtr))
@@ -1,109 +1,731 @@
-import math
-from collections import deque
+import bisect
+import os
+import struct
+import threading
+import zlib
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
 
+import metrics
 
-class LeafNode:
-    def __init__(self, val, ptr):
-        self.val = val
-        self.ptr = ptr
-        self.depth = 0
-
-
-class TreeNode:
-    def __init__(self, leftNode, rightNode):
-        self.leftNode = leftNode
-        self.rightNode = rightNode
-        self.val = (leftNode.val & rightNode.val) if rightNode is not None else leftNode.val
-        self.depth = self.leftNode.depth + 1
-
-    def update(self):
-        self.val = (self.leftNode.val & self.rightNode.val) if self.rightNode is not None else self.leftNode.val
+# 每个字（8字节，64位）都被占满时的样子
+FULL_WORD = b"\xff" * 8
 
 
 # bitMapLength: 字节
+# 位图整体保存在一个bytearray里，上面用数组形式的线段树记录每个64位字是否已满，
+# full[1]是根，full[i]的孩子是full[2i]和full[2i+1]，叶子从full[leafCount]开始
 class BitMapHelper:
     def __init__(self, reader, bitMapStartPtr, bitMapLength):
         self.reader = reader
+        # 计数记在所属的空间上
+        self.counters = getattr(reader, "counters", None)
         self.bitMapStartPtr = bitMapStartPtr
-        binQueue = deque()
-        self.reader.seek(bitMapStartPtr)
         self.bitMapLength = bitMapLength
-        # 叶子节点
-        for i in range(0, bitMapLength, 1):
-            node = LeafNode(self.reader.read(1)[0], bitMapStartPtr + i)
-            binQueue.append(node)
-
-        self.root = binQueue[0]
-        while True:
-            left = binQueue.popleft()
-            self.root = left
-            if len(binQueue) <= 0:
+        self.wordCount = max(1, (bitMapLength + 7) >> 3)
+        # 一次读入整个位图，最后一个字不满8字节的部分补成已占用
+        self.bits = bytearray(reader.readAt(bitMapStartPtr, bitMapLength))
+        self.bits += b"\xff" * (self.wordCount * 8 - bitMapLength)
+        self.leafCount = 1
+        while self.leafCount < self.wordCount:
+            self.leafCount <<= 1
+        self.full = bytearray(self.leafCount) + bytearray(b"\x01" * self.leafCount)
+        bits = self.bits
+        leafCount = self.leafCount
+        for w in range(self.wordCount):
+            if bits[w << 3:(w << 3) + 8] != FULL_WORD:
+                self.full[leafCount + w] = 0
+        for i in range(leafCount - 1, 0, -1):
+            self.full[i] = self.full[i << 1] & self.full[(i << 1) + 1]
+
+    # 第w个字变化后，更新它到根的路径
+    def updateWord(self, w: int):
+        i = self.leafCount + w
+        isFull = 1 if self.bits[w << 3:(w << 3) + 8] == FULL_WORD else 0
+        if self.full[i] == isFull:
+            return
+        self.full[i] = isFull
+        updates = 1
+        i >>= 1
+        while i > 0:
+            v = self.full[i << 1] & self.full[(i << 1) + 1]
+            if self.full[i] == v:
                 break
-            right = None if (binQueue[0].depth != left.depth) else binQueue.popleft()
-            node = TreeNode(left, right)
-            binQueue.append(node)
+            self.full[i] = v
+            updates += 1
+            i >>= 1
+        if metrics.ENABLED and self.counters is not None:
+            metrics.count(self.counters, "bitmapNodeUpdates", updates)
+
+    # 返回第一个为0的位，没有时返回-1
+    def findZero(self):
+        if self.full[1]:
+            return -1
+        i = 1
+        leafCount = self.leafCount
+        while i < leafCount:
+            i <<= 1
+            if self.full[i]:
+                i += 1
+        byteIndex = (i - leafCount) << 3
+        while self.bits[byteIndex] == 255:
+            byteIndex += 1
+        byte = self.bits[byteIndex]
+        bitId = byteIndex << 3
+        bitMask = 128
+        while byte & bitMask:
+            bitMask >>= 1
+            bitId += 1
+        return bitId
+
+    def saveBytes(self, firstByte: int, lastByte: int):
+        self.reader.writeAt(self.bitMapStartPtr + firstByte, bytes(self.bits[firstByte:lastByte + 1]))
 
     # 找到一个0并反转为1，返回0代表的block
     def allocZero(self):
-        if self.root.val == 255:
+        bitId = self.findZero()
+        if bitId == -1:
             return -1
+        byteIndex = bitId >> 3
+        self.bits[byteIndex] |= 128 >> (bitId & 7)
+        self.saveBytes(byteIndex, byteIndex)
+        self.updateWord(byteIndex >> 3)
+        if metrics.ENABLED and self.counters is not None:
+            metrics.count(self.counters, "bitmapAllocs")
+        return bitId
 
-        nowNode = self.root
-        nodeStack = deque()
-        while type(nowNode) != LeafNode:
-            nodeStack.append(nowNode)
-            if nowNode.leftNode.val != 255:
-                nowNode = nowNode.leftNode
-            else:
-                nowNode = nowNode.rightNode
-
-        i = 0
-        bitMask = 128
-        while bitMask > 0:
-            if nowNode.val & bitMask == 0:
-                nowNode.val |= bitMask
-                self.reader.seek(nowNode.ptr)
-                self.reader.write(bytes([nowNode.val]))
+    # 分配count个位，尽量连续。返回[(起始位, 长度), ...]，空间不足时返回的总长度小于count
+    def allocRun(self, count: int):
+        runs = []
+        bits = self.bits
+        while count > 0:
+            start = self.findZero()
+            if start == -1:
                 break
-            bitMask >>= 1
-            i += 1
-
-        while len(nodeStack) > 0:
-            n = nodeStack.pop()
-            n.update()
+            bitId = start
+            totalBits = self.bitMapLength << 3
+            while count > 0 and bitId < totalBits:
+                byteIndex = bitId >> 3
+                # 整字节空闲时一次占用8位
+                if bitId & 7 == 0 and count >= 8 and bits[byteIndex] == 0:
+                    bits[byteIndex] = 255
+                    bitId += 8
+                    count -= 8
+                    continue
+                bitMask = 128 >> (bitId & 7)
+                if bits[byteIndex] & bitMask:
+                    break
+                bits[byteIndex] |= bitMask
+                bitId += 1
+                count -= 1
+            runs.append((start, bitId - start))
+            if metrics.ENABLED and self.counters is not None:
+                metrics.count(self.counters, "bitmapAllocs", bitId - start)
+            firstByte = start >> 3
+            lastByte = (bitId - 1) >> 3
+            self.saveBytes(firstByte, lastByte)
+            for w in range(firstByte >> 3, (lastByte >> 3) + 1):
+                self.updateWord(w)
+        return runs
 
-        return (nowNode.ptr - self.bitMapStartPtr) * 8 + i
+    # 统计前bitCount位中0的个数
+    def countZero(self, bitCount: int):
+        fullBytes = bitCount >> 3
+        used = bin(int.from_bytes(self.bits[:fullBytes], "big")).count("1")
+        restBits = bitCount & 7
+        if restBits > 0:
+            used += bin(self.bits[fullBytes] >> (8 - restBits)).count("1")
+        return bitCount - used
 
     # 如果该位置为1返回True，否则返回False
     def setZero(self, bitId: int):
-        byteIndex = math.floor(bitId / 8)
-        nowNode = self.root
-        nodeStack = deque()
-        while type(nowNode) != LeafNode:
-            nodeStack.append(nowNode)
-            bitMask = 1 << (nowNode.depth - 1)
-            if byteIndex & bitMask > 0:
-                nowNode = nowNode.rightNode
-            else:
-                nowNode = nowNode.leftNode
-        bitMask = 128 >> (bitId % 8)
-        if nowNode.val & bitMask == 0:
+        byteIndex = bitId >> 3
+        bitMask = 128 >> (bitId & 7)
+        if self.bits[byteIndex] & bitMask == 0:
             return False
-        nowNode.val = nowNode.val & ~bitMask
-        self.reader.seek(nowNode.ptr)
-        self.reader.write(bytes([nowNode.val]))
-        while len(nodeStack) > 0:
-            n = nodeStack.pop()
-            n.update()
+        self.bits[byteIndex] &= ~bitMask & 255
+        self.saveBytes(byteIndex, byteIndex)
+        self.updateWord(byteIndex >> 3)
+        if metrics.ENABLED and self.counters is not None:
+            metrics.count(self.counters, "bitmapFrees")
         return True
 
+    # 一次把多个位清零，改动的字节合并成尽量少的几段写回。返回实际由1变为0的位数
+    def setZeroMany(self, bitIds):
+        bits = self.bits
+        touched = set()
+        changed = 0
+        for bitId in bitIds:
+            byteIndex = bitId >> 3
+            bitMask = 128 >> (bitId & 7)
+            if bits[byteIndex] & bitMask:
+                bits[byteIndex] &= ~bitMask & 255
+                touched.add(byteIndex)
+                changed += 1
+        runStart = -1
+        runEnd = -1
+        for byteIndex in sorted(touched):
+            # 间隔不大的两段一起写，中间没改的字节原样写回
+            if runStart != -1 and byteIndex - runEnd <= 64:
+                runEnd = byteIndex
+                continue
+            if runStart != -1:
+                self.saveBytes(runStart, runEnd)
+            runStart = runEnd = byteIndex
+        if runStart != -1:
+            self.saveBytes(runStart, runEnd)
+        for w in {byteIndex >> 3 for byteIndex in touched}:
+            self.updateWord(w)
+        if metrics.ENABLED and self.counters is not None:
+            metrics.count(self.counters, "bitmapFrees", changed)
+        return changed
+
     def getBitMap(self):
-        self.reader.seek(self.bitMapStartPtr)
-        return self.reader.read(self.bitMapLength)
+        return bytes(self.bits[:self.bitMapLength])
 
     def checkIsFree(self, index: int):
-        self.reader.seek(self.bitMapStartPtr + index // 8)
-        byte = self.reader.read(1)[0]
-        bitMask = 128 >> (index % 8)
-        return byte & bitMask == 0
+        return self.bits[index >> 3] & (128 >> (index & 7)) == 0
+
+
+# 以块为单位的写回LRU缓存。页按pageOffset对齐，使数据块恰好对应一页
+class BlockCache:
+    def __init__(self, loader, storer, capacity: int, pageSize: int = 2048, pageOffset: int = 0):
+        # loader(ptr, length) -> bytes, storer(ptr, content)
+        self.loader = loader
+        self.storer = storer
+        self.pageSize = pageSize
+        self.pageOffset = pageOffset % pageSize
+        # 最多缓存的页数
+        self.capacity = max(1, capacity // pageSize)
+        self.pages: OrderedDict[int, bytearray] = OrderedDict()
+        self.dirty = set()
+        self.hits = 0
+        self.misses = 0
+        self.writeBacks = 0
+        # 多个线程同时读写时保护页表和LRU顺序
+        self.lock = threading.Lock()
+
+    def getPageStart(self, pageId: int):
+        return self.pageOffset + pageId * self.pageSize
+
+    def loadPage(self, pageId: int):
+        start = self.getPageStart(pageId)
+        if start < 0:
+            # 第一页可能只有一部分在文件范围内
+            return bytearray(-start) + bytearray(self.loader(0, self.pageSize + start))
+        return bytearray(self.loader(start, self.pageSize))
+
+    def storePages(self, firstPageId: int, content):
+        start = self.getPageStart(firstPageId)
+        if start < 0:
+            content = content[-start:]
+            start = 0
+        self.storer(start, content)
+        self.writeBacks += 1
+
+    def getPage(self, pageId: int, load=True):
+        page = self.pages.get(pageId)
+        if page is not None:
+            self.hits += 1
+            self.pages.move_to_end(pageId)
+            return page
+        self.misses += 1
+        page = self.loadPage(pageId) if load else bytearray(self.pageSize)
+        self.pages[pageId] = page
+        while len(self.pages) > self.capacity:
+            self.evict()
+        return page
+
+    def evict(self):
+        pageId, page = self.pages.popitem(last=False)
+        if pageId in self.dirty:
+            self.dirty.discard(pageId)
+            self.storePages(pageId, page)
+
+    def read(self, ptr: int, length: int) -> bytes:
+        pageId, inPage = divmod(ptr - self.pageOffset, self.pageSize)
+        with self.lock:
+            if inPage + length <= self.pageSize:
+                return bytes(self.getPage(pageId)[inPage:inPage + length])
+            result = bytearray()
+            while length > 0:
+                n = min(length, self.pageSize - inPage)
+                result += self.getPage(pageId)[inPage:inPage + n]
+                length -= n
+                pageId += 1
+                inPage = 0
+            return bytes(result)
+
+    def write(self, ptr: int, content):
+        pageId, inPage = divmod(ptr - self.pageOffset, self.pageSize)
+        content = memoryview(content)
+        written = 0
+        with self.lock:
+            while written < len(content):
+                n = min(len(content) - written, self.pageSize - inPage)
+                # 整页覆盖时不需要先从文件读入
+                page = self.getPage(pageId, load=n != self.pageSize)
+                page[inPage:inPage + n] = content[written:written + n]
+                self.dirty.add(pageId)
+                written += n
+                pageId += 1
+                inPage = 0
+
+    # 把所有脏页写回，相邻的脏页合并成一次写入
+    def flush(self):
+        with self.lock:
+            if len(self.dirty) == 0:
+                return
+            runStart = -1
+            run = bytearray()
+            lastPageId = None
+            for pageId in sorted(self.dirty):
+                if lastPageId is not None and pageId == lastPageId + 1:
+                    run += self.pages[pageId]
+                else:
+                    if lastPageId is not None:
+                        self.storePages(runStart, run)
+                    runStart = pageId
+                    run = bytearray(self.pages[pageId])
+                lastPageId = pageId
+            self.storePages(runStart, run)
+            self.dirty.clear()
+
+    def getStats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "writeBacks": self.writeBacks,
+            "cachedBlocks": len(self.pages),
+            "dirtyBlocks": len(self.dirty),
+            "capacityBlocks": self.capacity
+        }
+
+
+# 读写锁：读锁可以被多个线程同时持有，写锁独占。两种锁对同一线程都可重入，
+# 持有写锁的线程可以再取读锁；只持有读锁的线程也可以升级为写锁，但同一时刻只能有一个线程这样做。
+# 有线程在等写锁时，新的读者要排队，避免写者饿死
+class RWLock:
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        # 线程id -> 该线程持有的读锁层数
+        self.readers: dict[int, int] = {}
+        self.writer = None
+        self.writerDepth = 0
+        self.waitingWriters = 0
+
+    def acquireRead(self):
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer == me or me in self.readers:
+                self.readers[me] = self.readers.get(me, 0) + 1
+                return
+            while self.writer is not None or self.waitingWriters > 0:
+                self.cond.wait()
+            self.readers[me] = 1
+
+    def releaseRead(self):
+        me = threading.get_ident()
+        with self.cond:
+            depth = self.readers[me] - 1
+            if depth == 0:
+                self.readers.pop(me)
+                self.cond.notify_all()
+            else:
+                self.readers[me] = depth
+
+    def acquireWrite(self):
+        me = threading.get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.writerDepth += 1
+                return
+            self.waitingWriters += 1
+            while self.writer is not None or any(t != me for t in self.readers):
+                self.cond.wait()
+            self.waitingWriters -= 1
+            self.writer = me
+            self.writerDepth = 1
+
+    def releaseWrite(self):
+        with self.cond:
+            self.writerDepth -= 1
+            if self.writerDepth == 0:
+                self.writer = None
+                self.cond.notify_all()
+
+    @contextmanager
+    def readLocked(self):
+        self.acquireRead()
+        try:
+            yield
+        finally:
+            self.releaseRead()
+
+    @contextmanager
+    def writeLocked(self):
+        self.acquireWrite()
+        try:
+            yield
+        finally:
+            self.releaseWrite()
+
+
+# BlockMap中尚未解析的位置
+UNRESOLVED = -1
+# BlockMap每段的块数（以2为底的对数）
+BLOCK_MAP_CHUNK_SHIFT = 8
+
+
+# 文件逻辑块号到磁盘地址的映射。按段分配，只有解析过的段才占用内存，稀疏文件中的大段空洞不用展开
+class BlockMap:
+    def __init__(self, chunkShift: int = BLOCK_MAP_CHUNK_SHIFT):
+        self.chunkShift = chunkShift
+        self.chunkSize = 1 << chunkShift
+        self.chunkMask = self.chunkSize - 1
+        # 段号 -> 该段各块的地址
+        self.chunks = {}
+
+    def getChunk(self, chunkId: int):
+        chunk = self.chunks.get(chunkId)
+        if chunk is None:
+            chunk = array("q", [UNRESOLVED]) * self.chunkSize
+            self.chunks[chunkId] = chunk
+        return chunk
+
+    def __getitem__(self, blockId: int) -> int:
+        chunk = self.chunks.get(blockId >> self.chunkShift)
+        if chunk is None:
+            return UNRESOLVED
+        return chunk[blockId & self.chunkMask]
+
+    def __setitem__(self, blockId: int, ptr: int):
+        self.getChunk(blockId >> self.chunkShift)[blockId & self.chunkMask] = ptr
+
+    # 返回[start, end)的地址列表
+    def getRange(self, start: int, end: int) -> list:
+        return [self[i] for i in range(start, end)]
+
+    # 从start开始依次设为ptrs中的地址
+    def setRange(self, start: int, ptrs: array):
+        done = 0
+        while done < len(ptrs):
+            blockId = start + done
+            offset = blockId & self.chunkMask
+            n = min(len(ptrs) - done, self.chunkSize - offset)
+            self.getChunk(blockId >> self.chunkShift)[offset:offset + n] = ptrs[done:done + n]
+            done += n
+
+    # 去掉逻辑块号不小于length的所有项
+    def truncate(self, length: int):
+        for chunkId in [c for c in self.chunks if c << self.chunkShift >= length]:
+            del self.chunks[chunkId]
+        chunk = self.chunks.get(length >> self.chunkShift)
+        if chunk is not None:
+            offset = length & self.chunkMask
+            chunk[offset:] = array("q", [UNRESOLVED]) * (self.chunkSize - offset)
+
+
+# 还没有提交到日志的元数据。写入先按页留在内存中，对应的日志记录fsync之后才写进空间文件，
+# 保证空间文件中不会出现日志里还没有的修改。页按pageOffset对齐，使数据块恰好对应一页
+class MetaOverlay:
+    def __init__(self, pageSize: int, pageOffset: int = 0):
+        self.pageSize = pageSize
+        self.pageOffset = pageOffset % pageSize
+        # 页号 -> [页内容, 所属日志记录的序号, 是否修改过]。序号为None表示所属操作还没有结束
+        self.pages: dict[int, list] = {}
+        # 属于当前操作、结束时要标上记录序号的页
+        self.current = []
+        self.lock = threading.Lock()
+
+    def getPageStart(self, pageId: int):
+        return self.pageOffset + pageId * self.pageSize
+
+    # 返回[ptr, end)中已经在内存里的页（页号, 页起点），按地址排序
+    def findPages(self, ptr: int, end: int):
+        firstPageId = (ptr - self.pageOffset) // self.pageSize
+        lastPageId = (end - 1 - self.pageOffset) // self.pageSize
+        if lastPageId - firstPageId + 1 <= len(self.pages):
+            pageIds = [i for i in range(firstPageId, lastPageId + 1) if i in self.pages]
+        else:
+            pageIds = sorted(i for i in self.pages if firstPageId <= i <= lastPageId)
+        return [(i, self.getPageStart(i)) for i in pageIds]
+
+    # 取出一页并归到当前操作，不在内存中时用loader从空间文件读入
+    def holdPage(self, pageId: int, loader):
+        page = self.pages.get(pageId)
+        if page is None:
+            start = self.getPageStart(pageId)
+            content = bytearray(self.pageSize)
+            # 第一页可能只有一部分在文件范围内
+            loadStart = max(0, start)
+            content[loadStart - start:] = loader(loadStart, start + self.pageSize - loadStart)
+            page = [content, None, False]
+            self.pages[pageId] = page
+            self.current.append(pageId)
+        elif page[1] is not None:
+            page[1] = None
+            self.current.append(pageId)
+        return page
+
+    # 写元数据
+    def write(self, ptr: int, content, loader):
+        end = ptr + len(content)
+        with self.lock:
+            pageId = (ptr - self.pageOffset) // self.pageSize
+            start = self.getPageStart(pageId)
+            while start < end:
+                page = self.holdPage(pageId, loader)
+                low = max(ptr, start)
+                high = min(end, start + self.pageSize)
+                page[0][low - start:high - start] = content[low - ptr:high - ptr]
+                page[2] = True
+                pageId += 1
+                start += self.pageSize
+
+    # 把[ptr, end)所在的页按现在的内容留在内存中，当前操作提交之前对这些页的写入都不会到达空间文件
+    def pin(self, ptr: int, length: int, loader):
+        with self.lock:
+            firstPageId = (ptr - self.pageOffset) // self.pageSize
+            lastPageId = (ptr + length - 1 - self.pageOffset) // self.pageSize
+            for pageId in range(firstPageId, lastPageId + 1):
+                self.holdPage(pageId, loader)
+
+    # 写文件数据：落在内存中的页里的部分改在页上，之后随页一起写出，其余部分直接用storer写
+    def patch(self, ptr: int, content, storer):
+        end = ptr + len(content)
+        with self.lock:
+            direct = ptr
+            for pageId, start in self.findPages(ptr, end):
+                page = self.pages[pageId]
+                low = max(ptr, start)
+                high = min(end, start + self.pageSize)
+                if low > direct:
+                    storer(direct, content[direct - ptr:low - ptr])
+                page[0][low - start:high - start] = content[low - ptr:high - ptr]
+                page[2] = True
+                direct = high
+            if direct < end:
+                storer(direct, content[direct - ptr:])
+
+    # 与内存中的页有重叠时返回合并后的内容，否则返回None，由调用者直接读空间文件
+    def read(self, ptr: int, length: int, loader):
+        end = ptr + length
+        with self.lock:
+            pages = self.findPages(ptr, end)
+            if len(pages) == 0:
+                return None
+            result = bytearray(length)
+            direct = ptr
+            for pageId, start in pages:
+                low = max(ptr, start)
+                high = min(end, start + self.pageSize)
+                if low > direct:
+                    result[direct - ptr:low - ptr] = loader(direct, low - direct)
+                result[low - ptr:high - ptr] = self.pages[pageId][0][low - start:high - start]
+                direct = high
+            if direct < end:
+                result[direct - ptr:] = loader(direct, end - direct)
+            return bytes(result)
+
+    # 当前操作的日志记录序号确定后调用
+    def tag(self, seq: int):
+        with self.lock:
+            for pageId in self.current:
+                page = self.pages.get(pageId)
+                if page is not None and page[1] is None:
+                    page[1] = seq
+            self.current.clear()
+
+    # 序号不大于seq的记录都已经提交，把它们的页写进空间文件
+    def apply(self, seq: int, storer):
+        with self.lock:
+            for pageId in [i for i, page in self.pages.items() if page[1] is not None and page[1] <= seq]:
+                content, _, dirty = self.pages.pop(pageId)
+                if not dirty:
+                    continue
+                start = self.getPageStart(pageId)
+                skip = max(0, -start)
+                storer(start + skip, memoryview(content)[skip:])
+
+    def getStats(self):
+        return {"pendingPages": len(self.pages)}
+
+
+# 元数据预写日志。每个逻辑操作的所有元数据写入合成一条记录，记录先放在内存里，
+# 攒够batchSize字节或者每隔interval秒由后台线程写入日志文件并fsync一次（组提交）。
+# 记录格式：magic(4) + 负载长度(4) + 序号(8) + 负载 + crc32(4)，负载由若干个 地址(8) + 长度(4) + 内容 组成
+# 长度的最高位为1时是撤销项，没有内容：重放时跳过日志中在它之前对这段地址的写入
+JOURNAL_MAGIC = b"HBJ1"
+JOURNAL_HEADER_FORMAT = "=4sIq"
+JOURNAL_HEADER_SIZE = struct.calcsize(JOURNAL_HEADER_FORMAT)
+JOURNAL_REVOKE = 1 << 31
+
+
+# 互不重叠的[start, end)区间的集合，按起点排序
+class RangeSet:
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def add(self, start: int, end: int):
+        # 和新区间重叠或相邻的区间是[i, j)
+        i = bisect.bisect_left(self.ends, start)
+        j = bisect.bisect_right(self.starts, end)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+    # 返回[start, end)中不在集合里的各段
+    def subtract(self, start: int, end: int):
+        ans = []
+        i = bisect.bisect_right(self.ends, start)
+        while start < end and i < len(self.starts) and self.starts[i] < end:
+            if self.starts[i] > start:
+                ans.append((start, self.starts[i]))
+            start = max(start, self.ends[i])
+            i += 1
+        if start < end:
+            ans.append((start, end))
+        return ans
+
+
+class MetaJournal:
+    # 每次提交后调用onCommit(seq)，seq是已经提交的最后一条记录的序号
+    def __init__(self, path: str, interval: float = 0.05, batchSize: int = 1024 * 1024, onCommit=None):
+        self.path = path
+        self.onCommit = onCommit
+        self.file = open(path, "ab")
+        self.interval = interval
+        self.batchSize = batchSize
+        self.lock = threading.Lock()
+        self.pending: list[bytes] = []
+        self.pendingBytes = 0
+        self.seq = 0
+        self.committedSeq = 0
+        # 日志文件中已经提交的字节数
+        self.size = self.file.tell()
+        self.commits = 0
+        self.closed = threading.Event()
+        self.thread = None
+        if interval > 0:
+            self.thread = threading.Thread(target=self.commitLoop, daemon=True)
+            self.thread.start()
+
+    # 内容是整数时表示撤销从ptr开始这么长的一段
+    @staticmethod
+    def encodeEntry(ptr: int, content) -> bytes:
+        if isinstance(content, int):
+            return struct.pack("=qI", ptr, JOURNAL_REVOKE | content)
+        return struct.pack("=qI", ptr, len(content)) + bytes(content)
+
+    @staticmethod
+    def encodeRecord(seq: int, writes) -> bytes:
+        payload = b"".join(MetaJournal.encodeEntry(ptr, content) for ptr, content in writes)
+        header = struct.pack(JOURNAL_HEADER_FORMAT, JOURNAL_MAGIC, len(payload), seq)
+        return header + payload + struct.pack("=I", zlib.crc32(header + payload))
+
+    # 追加一个操作的所有元数据写入[(地址, 内容), ...]。onAppend(seq)在这条记录可能被提交之前调用
+    def append(self, writes, onAppend=None):
+        with self.lock:
+            self.seq += 1
+            record = self.encodeRecord(self.seq, writes)
+            if onAppend is not None:
+                onAppend(self.seq)
+            self.pending.append(record)
+            self.pendingBytes += len(record)
+            full = self.pendingBytes >= self.batchSize
+        if full or self.thread is None:
+            self.commit()
+
+    # 把内存中的记录一次写入日志文件并fsync
+    def commit(self):
+        with self.lock:
+            if len(self.pending) == 0:
+                return
+            self.file.write(b"".join(self.pending))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.size += self.pendingBytes
+            self.pending.clear()
+            self.pendingBytes = 0
+            self.commits += 1
+            self.committedSeq = seq = self.seq
+        if self.onCommit is not None:
+            self.onCommit(seq)
+
+    def commitLoop(self):
+        while not self.closed.wait(self.interval):
+            self.commit()
+
+    # 空间文件已经落盘后清空日志
+    def truncate(self):
+        with self.lock:
+            self.file.truncate(0)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.size = 0
+
+    def close(self, remove=False):
+        self.closed.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.commit()
+        self.file.close()
+        if remove:
+            os.remove(self.path)
+
+    # 按顺序重放日志中所有完整的记录，遇到不完整或校验失败的记录就停止。返回重放的记录数
+    # 被后面的撤销项覆盖的写入不重放：那些块释放后可能已经存放了不进日志的文件数据
+    @staticmethod
+    def replay(path: str, applyWrite):
+        if not os.path.exists(path):
+            return 0
+        with open(path, "rb") as f:
+            content = f.read()
+        offset = 0
+        count = 0
+        entries = []
+        while offset + JOURNAL_HEADER_SIZE <= len(content):
+            magic, length, seq = struct.unpack_from(JOURNAL_HEADER_FORMAT, content, offset)
+            end = offset + JOURNAL_HEADER_SIZE + length
+            if magic != JOURNAL_MAGIC or end + 4 > len(content):
+                break
+            crc = struct.unpack_from("=I", content, end)[0]
+            if zlib.crc32(content[offset:end]) != crc:
+                break
+            ptr = offset + JOURNAL_HEADER_SIZE
+            while ptr < end:
+                writePtr, writeLength = struct.unpack_from("=qI", content, ptr)
+                ptr += 12
+                if writeLength & JOURNAL_REVOKE:
+                    entries.append((writePtr, writeLength & ~JOURNAL_REVOKE, -1))
+                    continue
+                entries.append((writePtr, writeLength, ptr))
+                ptr += writeLength
+            offset = end + 4
+            count += 1
+        # 从后往前找出每个写入中没有被之后的撤销项覆盖的部分，再按原来的顺序写入
+        revoked = RangeSet()
+        parts = []
+        for writePtr, writeLength, contentPtr in reversed(entries):
+            if contentPtr < 0:
+                revoked.add(writePtr, writePtr + writeLength)
+                continue
+            for start, end in revoked.subtract(writePtr, writePtr + writeLength):
+                contentStart = contentPtr + start - writePtr
+                parts.append((start, content[contentStart:contentStart + end - start]))
+        for writePtr, part in reversed(parts):
+            applyWrite(writePtr, part)
+        return count
 
+    def getStats(self):
+        return {
+            "commits": self.commits,
+            "records": self.seq,
+            "journalBytes": self.size,
+            "pendingBytes": self.pendingBytes
+        }
@@ -1,49 +1,121 @@
 import os
+import threading
+from collections import OrderedDict
 
-from hbdisk import HbDisk, HbFile, HbFolder, INode
+from hbdisk import DEFAULT_BLOCK_SIZE, HbDisk, HbFile, HbFolder
+
+# 路径缓存最多保存的目录数
+DENTRY_CACHE_SIZE = 1024
 
 
 class DiskManager:
-    def __init__(self, disk: HbDisk):
+    def __init__(self, disk: HbDisk, dentryCacheSize: int = DENTRY_CACHE_SIZE):
         self.disk = disk
-        self.rootFolder = HbFolder(self.disk, "", self.disk.rootInode)
-        self.dirList = [self.rootFolder]
+        # 根目录在第一次访问时才读取，这样挂载时只需要读GDT
+        self._rootFolder = None
+        self._dirList = None
         self.dirNameList = []
-
-    def gotoDir(self, dirs):
-        newDirList = [self.rootFolder]
-        for i, dirName in enumerate(dirs):
-            nowFolder = newDirList[-1].getFile(dirName)
+        # 路径缓存：目录名元组 -> 从根目录到该目录的所有HbFolder
+        self.dentryCacheSize = dentryCacheSize
+        self.dentryCache: OrderedDict[tuple, list[HbFolder]] = OrderedDict()
+        self.dentryLock = threading.Lock()
+
+    @property
+    def rootFolder(self) -> HbFolder:
+        if self._rootFolder is None:
+            self._rootFolder = HbFolder(self.disk, "", self.disk.rootInode)
+        return self._rootFolder
+
+    @property
+    def dirList(self) -> list[HbFolder]:
+        if self._dirList is None:
+            self._dirList = [self.rootFolder]
+        return self._dirList
+
+    @dirList.setter
+    def dirList(self, value: list[HbFolder]):
+        self._dirList = value
+
+    def putDentry(self, path: tuple, dirList: list[HbFolder]):
+        with self.dentryLock:
+            self.dentryCache[path] = dirList
+            self.dentryCache.move_to_end(path)
+            while len(self.dentryCache) > self.dentryCacheSize:
+                self.dentryCache.popitem(last=False)
+
+    def getDentry(self, path: tuple):
+        with self.dentryLock:
+            dirList = self.dentryCache.get(path)
+            if dirList is not None:
+                self.dentryCache.move_to_end(path)
+            return dirList
+
+    # 返回从根目录到path的所有HbFolder，优先使用缓存
+    def resolveDir(self, path: tuple) -> list[HbFolder]:
+        if len(path) == 0:
+            return [self.rootFolder]
+        dirList = self.getDentry(path)
+        if dirList is not None:
+            return dirList
+        with self.disk.lock.readLocked():
+            dirList = self.resolveDir(path[:-1]).copy()
+            nowFolder = dirList[-1].getFile(path[-1])
             if type(nowFolder) != HbFolder:
                 raise Exception("地址包含文件。")
-            newDirList.append(nowFolder)
-        self.dirList = newDirList
+            dirList.append(nowFolder)
+            self.putDentry(path, dirList)
+        return dirList
+
+    # 当前目录下名为name的项发生变化时，去掉它及其子目录的缓存
+    def invalidateDentry(self, name: str):
+        prefix = tuple(self.dirNameList) + (name,)
+        with self.dentryLock:
+            for path in [p for p in self.dentryCache if p[:len(prefix)] == prefix]:
+                self.dentryCache.pop(path)
+
+    def gotoDir(self, dirs):
+        self.dirList = self.resolveDir(tuple(dirs))
         self.dirNameList = dirs
 
     # 返回这个文件以及其之前所有文件夹的对象
     def getFileAndFullPath(self, fileName: str) -> list[HbFile]:
-        ans = self.dirList.copy()
-        ans.append(ans[-1].getFile(fileName))
-        return ans
+        with self.disk.lock.readLocked():
+            entry = self.dirList[-1].findFileEntry(fileName)
+            if entry is not None and entry.fileType == 1:
+                return self.resolveDir(tuple(self.dirNameList) + (fileName,)).copy()
+            ans = self.dirList.copy()
+            ans.append(ans[-1].getFile(fileName))
+            return ans
 
     # 检测当前目录下有没有这个文件，没有就抛异常
     def checkFileExist(self, fileName: str):
         self.dirList[-1].findFileEntry(fileName)
 
-    def createFile(self, fileName: str):
-        return self.dirList[-1].createFile(fileName)
+    # 修改目录的操作和路径缓存的清理放在同一个写锁里，读线程不会把旧的路径重新放进缓存
+    def createFile(self, fileName: str, compression: str = None):
+        with self.disk.operation():
+            self.invalidateDentry(fileName)
+            return self.dirList[-1].createFile(fileName, compression)
 
     def rename(self, oldName, newName):
-        self.dirList[-1].renameSubFile(oldName, newName)
+        with self.disk.operation():
+            self.dirList[-1].renameSubFile(oldName, newName)
+            self.invalidateDentry(oldName)
+            self.invalidateDentry(newName)
 
     def createFolder(self, fileName: str):
-        return self.dirList[-1].createDir(fileName)
+        with self.disk.operation():
+            self.invalidateDentry(fileName)
+            return self.dirList[-1].createDir(fileName)
 
-    def deleteFile(self, fileName: str, recursive: bool = False):
-        self.dirList[-1].deleteSubFile(fileName, recursive)
+    def deleteFile(self, fileName: str, recursive: bool = False, deferred: bool = False):
+        with self.disk.operation():
+            self.dirList[-1].deleteSubFile(fileName, recursive, deferred)
+            self.invalidateDentry(fileName)
 
     def getFileList(self):
-        return self.dirList[-1].fileList
+        with self.disk.lock.readLocked():
+            return self.dirList[-1].fileList
 
 
 class FileOpenCounter:
@@ -54,87 +126,201 @@ class FileOpenCounter:
 
 
 class StorageManager:
-    def __init__(self, diskMgrList: list[DiskManager] = []):
+    # deferredDelete为True时删除只去掉目录项，空间由各个空间的后台线程回收
+    def __init__(self, diskMgrList: list[DiskManager] = [], deferredDelete: bool = False):
         self.disks = diskMgrList
+        self.deferredDelete = deferredDelete
         self.nowDisk: DiskManager = None
         self.openedFile = {}
+        # 正在上传的文件的完整路径 -> 上传数。上传期间这些文件和它们的上级目录都不能删除或改名
+        self.uploadingFile = {}
+        # 保护当前空间、当前目录和打开文件表。加锁顺序总是先取这个锁再取空间的锁；
+        # 读写文件内容时只在查打开文件表的一瞬间用到它，不会被长时间的目录操作挡住
+        self.lock = threading.RLock()
 
     def switchDisk(self, diskName):
-        if self.nowDisk is not None and self.nowDisk.disk.diskName == diskName:
-            return
-        for disk in self.disks:
-            if disk.disk.diskName == diskName:
-                self.nowDisk = disk
+        with self.lock:
+            if self.nowDisk is not None and self.nowDisk.disk.diskName == diskName:
                 return
-        raise Exception("未找到该空间。")
+            for disk in self.disks:
+                if disk.disk.diskName == diskName:
+                    self.nowDisk = disk
+                    return
+            raise Exception("未找到该空间。")
 
     def clearDisk(self):
-        self.nowDisk = None
+        with self.lock:
+            self.nowDisk = None
 
     def getDir(self) -> list[str]:
-        if self.nowDisk is None:
-            return []
-        ans = [self.nowDisk.disk.diskName]
-        ans += self.nowDisk.dirNameList
-        return ans
+        with self.lock:
+            if self.nowDisk is None:
+                return []
+            ans = [self.nowDisk.disk.diskName]
+            ans += self.nowDisk.dirNameList
+            return ans
 
     def switchDir(self, dirList):
-        self.nowDisk.gotoDir(dirList)
+        with self.lock:
+            self.nowDisk.gotoDir(dirList)
 
     def getDiskReport(self):
+        with self.lock:
+            disks = self.disks.copy()
         ans = []
-        for disk in self.disks:
+        for disk in disks:
             ans.append({
                 "name": disk.disk.diskName,
+                "blockSize": disk.disk.blockSize,
                 "totalBlocks": disk.disk.dataBlockCount,
-                "blocksLeft": disk.disk.dataBlockLeft
+                "blocksLeft": disk.disk.getBlocksLeft(),
+                "cache": disk.disk.getCacheStats(),
+                "journal": disk.disk.getJournalStats(),
+                "pendingDeletes": disk.disk.getPendingDeletes(),
+                "compression": disk.disk.getCompressionStats(),
+                "dedup": disk.disk.getDedupStats(),
+                "snapshots": disk.disk.listSnapshots(),
+                "readOnly": disk.disk.readOnly
             })
         return ans
 
-    def createDisk(self, dataBlockCount, inodeCount, diskName):
+    # 所有空间的快照，用于输出计数
+    def getDisks(self) -> list[HbDisk]:
+        with self.lock:
+            return [disk.disk for disk in self.disks]
+
+    def createDisk(self, dataBlockCount, inodeCount, diskName, blockSize: int = DEFAULT_BLOCK_SIZE,
+                   compression: str = "", dedup: bool = False):
+        with self.lock:
+            for disk in self.disks:
+                if disk.disk.diskName == diskName:
+                    raise Exception("该空间已存在。")
+            HbDisk.checkDiskName(diskName)
+            HbDisk.checkBlockSize(blockSize)
+            HbDisk.checkCompression(compression)
+            # 空间直接建立在.hbdk文件上
+            try:
+                diskFile = open(diskName + ".hbdk", "xb+")
+            except FileExistsError:
+                raise Exception("该空间文件已存在。")
+            newDisk = HbDisk(dataBlockCount, inodeCount, diskName, writer=diskFile, blockSize=blockSize,
+                             compression=compression, dedup=dedup)
+            newDm = DiskManager(newDisk)
+            self.disks.append(newDm)
+
+    def getDiskManager(self, diskName: str) -> DiskManager:
         for disk in self.disks:
             if disk.disk.diskName == diskName:
-                raise Exception("该空间已存在。")
-        newDisk = HbDisk(dataBlockCount, inodeCount, diskName)
-        newDm = DiskManager(newDisk)
-        self.disks.append(newDm)
+                return disk
+        raise Exception("未找到该空间。")
+
+    # 快照挂载后作为一个名为"空间名@快照名"的只读空间出现
+    @staticmethod
+    def getSnapshotDiskName(diskName: str, snapshotName: str):
+        return diskName + "@" + snapshotName
+
+    def createSnapshot(self, diskName: str, snapshotName: str):
+        with self.lock:
+            disk = self.getDiskManager(diskName).disk
+        disk.createSnapshot(snapshotName)
+
+    def deleteSnapshot(self, diskName: str, snapshotName: str):
+        with self.lock:
+            disk = self.getDiskManager(diskName).disk
+            snapshotDiskName = self.getSnapshotDiskName(diskName, snapshotName)
+            if any(dm.disk.diskName == snapshotDiskName for dm in self.disks):
+                raise Exception("该快照已挂载，请先卸载。")
+            disk.deleteSnapshot(snapshotName)
+
+    def mountSnapshot(self, diskName: str, snapshotName: str):
+        with self.lock:
+            disk = self.getDiskManager(diskName).disk
+            snapshotDiskName = self.getSnapshotDiskName(diskName, snapshotName)
+            if any(dm.disk.diskName == snapshotDiskName for dm in self.disks):
+                raise Exception("该快照已挂载。")
+            path = disk.getSnapshotPath(snapshotName)
+            if not os.path.exists(path):
+                raise Exception("未找到该快照。")
+            snapshot = HbDisk(fileSize=os.path.getsize(path), reader=open(path, "rb"), journal=False,
+                              readOnly=True, baseDisk=disk)
+            snapshot.diskName = snapshotDiskName
+            self.disks.append(DiskManager(snapshot))
+
+    def unmountSnapshot(self, snapshotDiskName: str):
+        with self.lock:
+            dm = self.getDiskManager(snapshotDiskName)
+            if not dm.disk.readOnly:
+                raise Exception("该空间不是快照。")
+            if self.nowDisk is dm:
+                raise Exception("请先退出该空间。")
+            prefix = snapshotDiskName + "/"
+            if any(filePath.startswith(prefix) for filePath in self.openedFile):
+                raise Exception("该空间中有文件被占用，请关闭占用的文件。")
+            self.disks.remove(dm)
+            dm.disk.saveToDisk()
+
+    # 从快照克隆出一个新的可写空间
+    def cloneSnapshot(self, diskName: str, snapshotName: str, newDiskName: str):
+        with self.lock:
+            for disk in self.disks:
+                if disk.disk.diskName == newDiskName:
+                    raise Exception("该空间已存在。")
+            HbDisk.checkDiskName(newDiskName)
+            disk = self.getDiskManager(diskName).disk
+            path = newDiskName + ".hbdk"
+            if os.path.exists(path):
+                raise Exception("该空间文件已存在。")
+            disk.cloneSnapshot(snapshotName, path)
+            newDisk = HbDisk(fileSize=os.path.getsize(path), reader=open(path, "rb+"))
+            newDisk.rename(newDiskName)
+            newDisk.reclaimUnreferenced()
+            self.disks.append(DiskManager(newDisk))
 
     def createFolder(self, folderName: str):
-        if self.nowDisk is None:
-            raise Exception("你需要先打开一个空间。")
-        self.nowDisk.createFolder(folderName)
+        with self.lock:
+            if self.nowDisk is None:
+                raise Exception("你需要先打开一个空间。")
+            self.nowDisk.createFolder(folderName)
 
-    def createFile(self, fileName: str):
-        if self.nowDisk is None:
-            raise Exception("你需要先打开一个空间。")
-        return self.nowDisk.createFile(fileName)
+    def createFile(self, fileName: str, compression: str = None):
+        with self.lock:
+            if self.nowDisk is None:
+                raise Exception("你需要先打开一个空间。")
+            return self.nowDisk.createFile(fileName, compression)
 
     def deleteFile(self, fileName):
-        if self.checkFileOpen(fileName) is not None:
-            raise Exception("该文件或文件夹已被占用，请关闭占用的文件。")
-        self.nowDisk.deleteFile(fileName)
+        with self.lock:
+            if self.checkFileOpen(fileName) is not None:
+                raise Exception("该文件或文件夹已被占用，请关闭占用的文件。")
+            self.nowDisk.deleteFile(fileName, False, self.deferredDelete)
 
     def deleteFolder(self, folderName):
-        self.nowDisk.deleteFile(folderName, True)
+        with self.lock:
+            if self.checkFileOpen(folderName) is not None:
+                raise Exception("该文件或文件夹已被占用，请关闭占用的文件。")
+            self.nowDisk.deleteFile(folderName, True, self.deferredDelete)
 
     def renameFile(self, oldName, newName):
-        if self.checkFileOpen(oldName) is not None:
-            raise Exception("该文件或文件夹已被占用，请关闭占用的文件。")
-        if self.nowDisk is None:
-            for disk in self.disks:
-                if disk.disk.diskName == oldName:
-                    disk.disk.rename(newName)
-                    return
-            raise Exception("空间已存在。")
-        self.nowDisk.rename(oldName, newName)
+        with self.lock:
+            if self.checkFileOpen(oldName) is not None:
+                raise Exception("该文件或文件夹已被占用，请关闭占用的文件。")
+            if self.nowDisk is None:
+                for disk in self.disks:
+                    if disk.disk.diskName == oldName:
+                        disk.disk.rename(newName)
+                        return
+                raise Exception("空间已存在。")
+            self.nowDisk.rename(oldName, newName)
 
     def getFileList(self):
-        if self.nowDisk is None:
+        with self.lock:
+            nowDisk = self.nowDisk
+        if nowDisk is None:
             return []
         ans = []
-        ls = self.nowDisk.getFileList()
+        ls = nowDisk.getFileList()
         for file in ls:
-            inode = INode(self.nowDisk.disk, inodePtr=file.inodePtr)
+            inode = nowDisk.disk.getINode(inodePtr=file.inodePtr)
             ans.append({
                 "name": file.fileName,
                 "type": file.fileType,
@@ -147,66 +333,107 @@ class StorageManager:
         filePath = '/'.join(self.getDir() + [fileName])
         if filePath in self.openedFile:
             return filePath
+        prefix = filePath + '/'
+        if any(p == filePath or p.startswith(prefix) for p in self.uploadingFile):
+            return filePath
         return None
 
     def openFile(self, fileName):
-        self.nowDisk.checkFileExist(fileName)
-        fullDir = self.getDir()
-        fullDir.append(fileName)
-        fullDirObj = self.nowDisk.getFileAndFullPath(fileName)
-        # 把这个文件及其上级的所有文件的占用数都+1
-        ans = '/'.join(fullDir)
-        fullDirLenMinusOne = len(fullDir) - 1
-        for i in range(fullDirLenMinusOne, -1, -1):
-            filePath = '/'.join(fullDir[:i + 1])
-            if filePath not in self.openedFile:
-                file = fullDirObj[i]
-                self.openedFile[filePath] = FileOpenCounter(file, i == 0)
-            else:
-                if i == fullDirLenMinusOne:
-                    return
-                self.openedFile[filePath].counter += 1
-        return ans
+        with self.lock:
+            self.nowDisk.checkFileExist(fileName)
+            fullDir = self.getDir()
+            fullDir.append(fileName)
+            fullDirObj = self.nowDisk.getFileAndFullPath(fileName)
+            # 把这个文件及其上级的所有文件的占用数都+1
+            ans = '/'.join(fullDir)
+            fullDirLenMinusOne = len(fullDir) - 1
+            for i in range(fullDirLenMinusOne, -1, -1):
+                filePath = '/'.join(fullDir[:i + 1])
+                if filePath not in self.openedFile:
+                    file = fullDirObj[i]
+                    self.openedFile[filePath] = FileOpenCounter(file, i == 0)
+                else:
+                    if i == fullDirLenMinusOne:
+                        return
+                    self.openedFile[filePath].counter += 1
+            return ans
 
     def closeFile(self, filePath: str):
-        if filePath not in self.openedFile or self.openedFile[filePath].isLeaf:
-            raise Exception("文件未被打开!")
-        dirList = filePath.split('/')
-        for i in range(0, len(dirList)):
-            filePath = '/'.join(dirList[:i + 1])
+        with self.lock:
+            if filePath not in self.openedFile or self.openedFile[filePath].isLeaf:
+                raise Exception("文件未被打开!")
+            dirList = filePath.split('/')
+            for i in range(0, len(dirList)):
+                filePath = '/'.join(dirList[:i + 1])
+                if filePath not in self.openedFile:
+                    raise Exception("Parent dir not in openedList, which should not happen!!")
+                else:
+                    self.openedFile[filePath].counter -= 1
+                    if self.openedFile[filePath].counter == 0:
+                        self.openedFile.pop(filePath)
+
+    # 取得已打开的文件，之后的读写不再持有管理器的锁
+    def getOpenedFile(self, filePath) -> HbFile:
+        with self.lock:
             if filePath not in self.openedFile:
-                raise Exception("Parent dir not in openedList, which should not happen!!")
-            else:
-                self.openedFile[filePath].counter -= 1
-                if self.openedFile[filePath].counter == 0:
-                    self.openedFile.pop(filePath)
+                raise Exception("文件未打开。在目录视图中点击文件打开。")
+            return self.openedFile[filePath].file
 
+    # 不经过文件的当前位置读，多个请求可以同时读同一个打开的文件
     def readAll(self, filePath):
-        if filePath not in self.openedFile:
-            raise Exception("文件未打开。在目录视图中点击文件打开。")
-        file: HbFile = self.openedFile[filePath].file
-        file.seek(0)
-        content = file.read().decode("utf-8")
-        return content
+        file = self.getOpenedFile(filePath)
+        content = bytearray(file.getSize())
+        n = file.readIntoAt(0, memoryview(content))
+        return content[:n].decode("utf-8")
+
+    # 读出文件中从offset开始的最多length个字节，只会读到覆盖这一段的块
+    def readRange(self, filePath, offset: int, length: int):
+        if offset < 0 or length < 0:
+            raise Exception("偏移和长度不得为负。")
+        file = self.getOpenedFile(filePath)
+        content = bytearray(max(0, min(length, file.getSize() - offset)))
+        n = file.readIntoAt(offset, memoryview(content))
+        return bytes(content[:n]), file.getSize()
 
     def writeFromStart(self, filePath, content):
-        if filePath not in self.openedFile:
-            raise Exception("文件未打开。在目录视图中点击文件打开。")
-        file: HbFile = self.openedFile[filePath].file
+        file = self.getOpenedFile(filePath)
         file.write(content.encode(), True)
 
-    def uploadNewFile(self, stream, fileName):
-        file = self.createFile(fileName)
-        file.write(stream.read(), True)
+    # 分段写入上传的内容，sizeHint为客户端声明的长度（未知时为-1）。上传失败时删掉写了一半的文件
+    def uploadNewFile(self, stream, fileName, sizeHint: int = -1):
+        with self.lock:
+            if self.nowDisk is None:
+                raise Exception("你需要先打开一个空间。")
+            folder = self.nowDisk.dirList[-1]
+            file = self.nowDisk.createFile(fileName)
+            filePath = '/'.join(self.getDir() + [fileName])
+            self.uploadingFile[filePath] = self.uploadingFile.get(filePath, 0) + 1
+        try:
+            file.writeFrom(stream, sizeHint)
+        except Exception:
+            self.removeUpload(folder, fileName, file)
+            raise
+        finally:
+            with self.lock:
+                self.uploadingFile[filePath] -= 1
+                if self.uploadingFile[filePath] == 0:
+                    self.uploadingFile.pop(filePath)
+
+    # 按inode删掉上传失败的文件，目录项已经不是这个文件时不删
+    def removeUpload(self, folder: HbFolder, fileName: str, file: HbFile):
+        with folder.disk.operation():
+            entry = folder.findFileEntry(fileName)
+            if entry is not None and entry.inodePtr == file.inode.ptr:
+                folder.deleteSubFile(fileName, False, self.deferredDelete)
 
     def downloadFile(self, filePath):
-        if filePath not in self.openedFile or self.openedFile[filePath].isLeaf:
-            raise Exception("文件未打开。在目录视图中点击文件打开。")
-        file = self.openedFile[filePath].file
-        file.seek(0)
-        return file
+        with self.lock:
+            if filePath not in self.openedFile or self.openedFile[filePath].isLeaf:
+                raise Exception("文件未打开。在目录视图中点击文件打开。")
+            return self.openedFile[filePath].file
 
     def powerOff(self):
-        for disk in self.disks:
-            disk.disk.saveToDisk()
-        os._exit(0)
+        with self.lock:
+            for disk in self.disks:
+                disk.disk.saveToDisk()
+            os._exit(0)
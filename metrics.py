@@ -0,0 +1,139 @@
+import os
+import threading
+import time
+from collections import defaultdict
+
+# 关闭时各处的计数代码都只剩一次对ENABLED的判断
+ENABLED = os.environ.get("HBDK_METRICS", "0") == "1" or os.environ.get("HBDK_TRACE", "0") == "1"
+# 打开时每个请求结束后输出这个请求的计数明细
+TRACE = os.environ.get("HBDK_TRACE", "0") == "1"
+
+# 操作的累计耗时（秒）也记在计数里，输出时单独作为一个指标，不算在事件数中
+OPERATION_SECONDS = "operationSeconds"
+
+# 当前线程正在处理的请求的计数
+requestState = threading.local()
+# 按接口汇总的请求数、耗时和计数
+endpointRequests = defaultdict(int)
+endpointSeconds = defaultdict(float)
+endpointCounters = defaultdict(lambda: defaultdict(int))
+endpointLock = threading.Lock()
+
+
+def enable(trace: bool = False):
+    global ENABLED, TRACE
+    ENABLED = True
+    TRACE = trace
+
+
+def disable():
+    global ENABLED, TRACE
+    ENABLED = False
+    TRACE = False
+
+
+def newCounters():
+    return defaultdict(int)
+
+
+# 计数同时记到所属空间和当前请求上。为了不在热路径上加锁，多线程同时计数时可能少记几次
+def count(counters, name: str, n: int = 1):
+    counters[name] += n
+    current = getattr(requestState, "counters", None)
+    if current is not None:
+        current[name] += n
+
+
+def beginRequest():
+    requestState.counters = defaultdict(int)
+    requestState.start = time.perf_counter()
+
+
+# 结束当前请求的计数并汇总到接口上，返回(计数, 耗时秒数)。流式响应在返回之后产生的计数不算在请求里
+def endRequest(endpoint: str):
+    counters = getattr(requestState, "counters", None)
+    if counters is None:
+        return None
+    seconds = time.perf_counter() - requestState.start
+    requestState.counters = None
+    endpoint = endpoint or "unknown"
+    with endpointLock:
+        endpointRequests[endpoint] += 1
+        endpointSeconds[endpoint] += seconds
+        total = endpointCounters[endpoint]
+        for name, value in counters.items():
+            total[name] += value
+    return counters, seconds
+
+
+def escapeLabel(value: str):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+# 以Prometheus文本格式输出所有空间和接口的计数
+def render(disks) -> str:
+    lines = [
+        "# HELP hbdisk_events_total Storage engine events per disk.",
+        "# TYPE hbdisk_events_total counter"
+    ]
+    for disk in disks:
+        label = escapeLabel(disk.diskName)
+        for name, value in sorted(disk.counters.items()):
+            if name != OPERATION_SECONDS:
+                lines.append("hbdisk_events_total{disk=\"%s\",event=\"%s\"} %s" % (label, name, value))
+    lines += [
+        "# HELP hbdisk_operation_seconds_total Time spent in metadata operations per disk.",
+        "# TYPE hbdisk_operation_seconds_total counter"
+    ]
+    for disk in disks:
+        lines.append("hbdisk_operation_seconds_total{disk=\"%s\"} %.6f" %
+                     (escapeLabel(disk.diskName), disk.counters.get(OPERATION_SECONDS, 0)))
+    # 没有正常关闭的空间在重新统计之前不知道空闲数，不输出
+    lines += [
+        "# HELP hbdisk_free_blocks Free data blocks per disk.",
+        "# TYPE hbdisk_free_blocks gauge"
+    ]
+    for disk in disks:
+        blocksLeft = disk.getBlocksLeft()
+        if blocksLeft is not None:
+            lines.append("hbdisk_free_blocks{disk=\"%s\"} %d" % (escapeLabel(disk.diskName), blocksLeft))
+    lines += [
+        "# HELP hbdisk_free_inodes Free inodes per disk.",
+        "# TYPE hbdisk_free_inodes gauge"
+    ]
+    for disk in disks:
+        inodesLeft = disk.getINodesLeft()
+        if inodesLeft is not None:
+            lines.append("hbdisk_free_inodes{disk=\"%s\"} %d" % (escapeLabel(disk.diskName), inodesLeft))
+    with endpointLock:
+        lines += [
+            "# HELP hbdisk_requests_total Requests handled per endpoint.",
+            "# TYPE hbdisk_requests_total counter"
+        ]
+        for endpoint, value in sorted(endpointRequests.items()):
+            lines.append("hbdisk_requests_total{endpoint=\"%s\"} %d" % (escapeLabel(endpoint), value))
+        lines += [
+            "# HELP hbdisk_request_seconds_total Time spent handling requests per endpoint.",
+            "# TYPE hbdisk_request_seconds_total counter"
+        ]
+        for endpoint, value in sorted(endpointSeconds.items()):
+            lines.append("hbdisk_request_seconds_total{endpoint=\"%s\"} %.6f" % (escapeLabel(endpoint), value))
+        lines += [
+            "# HELP hbdisk_request_events_total Storage engine events caused by requests per endpoint.",
+            "# TYPE hbdisk_request_events_total counter"
+        ]
+        for endpoint, counters in sorted(endpointCounters.items()):
+            for name, value in sorted(counters.items()):
+                if name == OPERATION_SECONDS:
+                    continue
+                lines.append("hbdisk_request_events_total{endpoint=\"%s\",event=\"%s\"} %s" %
+                             (escapeLabel(endpoint), name, value))
+        lines += [
+            "# HELP hbdisk_request_operation_seconds_total Time spent in metadata operations per endpoint.",
+            "# TYPE hbdisk_request_operation_seconds_total counter"
+        ]
+        for endpoint, counters in sorted(endpointCounters.items()):
+            if OPERATION_SECONDS in counters:
+                lines.append("hbdisk_request_operation_seconds_total{endpoint=\"%s\"} %.6f" %
+                             (escapeLabel(endpoint), counters[OPERATION_SECONDS]))
+    return "\n".join(lines) + "\n"
@@ -1,21 +1,78 @@
+import logging
 import math
-from hbdisk import HbDisk
-from flask import Flask, request, send_file, jsonify, redirect
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+import metrics
+from hbdisk import DEFAULT_BLOCK_SIZE, HbDisk
+from flask import Flask, Response, request, jsonify, redirect
 import os
 from manager import StorageManager, DiskManager
 
 app = Flask(__name__, static_url_path="")
 
 
+# 计数打开时统计每个请求引起的存储引擎事件，HBDK_TRACE=1时在日志中输出每个请求的明细
+@app.before_request
+def beginMetrics():
+    if metrics.ENABLED:
+        metrics.beginRequest()
+
+
+@app.after_request
+def endMetrics(response):
+    if metrics.ENABLED:
+        result = metrics.endRequest(request.endpoint)
+        if result is not None and metrics.TRACE:
+            counters, seconds = result
+            detail = " ".join("%s=%s" % (name, value) for name, value in sorted(counters.items()))
+            app.logger.info("%s %s %.3fms %s", request.method, request.path, seconds * 1000, detail)
+    return response
+
+
+@app.route("/metrics")
+def get_metrics():
+    return Response(metrics.render(storageMgr.getDisks()), mimetype="text/plain; version=0.0.4")
+
+
+# 支持单个区间的Range请求，用于断点续传；多个区间时返回整个文件
 @app.route('/download/<path:filename>', methods=['GET'])
 def download_file(filename):
     try:
-        fileBytes = storageMgr.downloadFile(filename)
-        return send_file(fileBytes, as_attachment=True, download_name=filename.split("/")[-1])
+        file = storageMgr.downloadFile(filename)
+        size = file.getSize()
+        downloadName = filename.split("/")[-1]
+        byteRange = request.range
+        if byteRange is not None and byteRange.units == "bytes" and len(byteRange.ranges) == 1:
+            bounds = byteRange.range_for_length(size)
+            if bounds is None:
+                response = Response(status=416)
+                response.headers.set("Content-Range", "bytes */%d" % size)
+                return response
+            start, end = bounds
+            response = genDownloadResponse(file.iterChunks(pos=start, end=end), end - start, downloadName)
+            response.status_code = 206
+            response.headers.set("Content-Range", "bytes %d-%d/%d" % (start, end - 1, size))
+            return response
+        return genDownloadResponse(file.iterChunks(pos=0), size, downloadName)
     except Exception as e:
         return genResponse("", False, e.args[0])
 
 
+# 以流的形式返回文件内容，不把整个文件读进内存
+def genDownloadResponse(chunks, size, downloadName):
+    response = Response(chunks, mimetype="application/octet-stream", direct_passthrough=True)
+    response.content_length = size
+    response.headers.set("Accept-Ranges", "bytes")
+    asciiName = unicodedata.normalize("NFKD", downloadName).encode("ascii", "ignore").decode("ascii")
+    if asciiName == downloadName:
+        response.headers.set("Content-Disposition", "attachment", filename=downloadName)
+    else:
+        response.headers.set("Content-Disposition", "attachment", filename=asciiName,
+                             **{"filename*": "UTF-8''" + quote(downloadName, safe="!#$&+-.^_`|~")})
+    return response
+
+
 @app.route('/goto', methods=['POST'])
 def goto_directory():
     data = request.get_json()
@@ -63,9 +120,67 @@ def create_disk():
     data = request.get_json()
     try:
         size: float = data.get("size")  # 磁盘大小多少M
-        dataBlockCount = math.ceil(size * 64) * 8
+        # 块大小（字节），大文件为主的空间可以用较大的块
+        blockSize = int(data.get("blockSize") or DEFAULT_BLOCK_SIZE)
+        HbDisk.checkBlockSize(blockSize)
+        dataBlockCount = math.ceil(size * (1024 * 1024 // blockSize) / 8) * 8
         inodeCount = math.ceil(size * 4) * 8
-        storageMgr.createDisk(dataBlockCount, inodeCount, data.get("diskName"))
+        # 新建文件默认的压缩方式：""、"zlib"或"lzma"
+        # dedup为真时对上传的重复内容去重
+        storageMgr.createDisk(dataBlockCount, inodeCount, data.get("diskName"), blockSize,
+                              data.get("compression") or "", bool(data.get("dedup")))
+        return get_files()
+    except Exception as e:
+        return genResponse("", False, e.args[0])
+
+
+# 快照只复制元数据，数据块与空间共用，修改时才复制
+@app.route('/create_snapshot', methods=['POST'])
+def create_snapshot():
+    data = request.get_json()
+    try:
+        storageMgr.createSnapshot(data.get("diskName"), data.get("snapshotName"))
+        return get_files()
+    except Exception as e:
+        return genResponse("", False, e.args[0])
+
+
+@app.route('/delete_snapshot', methods=['POST'])
+def delete_snapshot():
+    data = request.get_json()
+    try:
+        storageMgr.deleteSnapshot(data.get("diskName"), data.get("snapshotName"))
+        return get_files()
+    except Exception as e:
+        return genResponse("", False, e.args[0])
+
+
+# 挂载后快照以"空间名@快照名"的只读空间出现
+@app.route('/mount_snapshot', methods=['POST'])
+def mount_snapshot():
+    data = request.get_json()
+    try:
+        storageMgr.mountSnapshot(data.get("diskName"), data.get("snapshotName"))
+        return get_files()
+    except Exception as e:
+        return genResponse("", False, e.args[0])
+
+
+@app.route('/unmount_snapshot', methods=['POST'])
+def unmount_snapshot():
+    data = request.get_json()
+    try:
+        storageMgr.unmountSnapshot(data.get("diskName"))
+        return get_files()
+    except Exception as e:
+        return genResponse("", False, e.args[0])
+
+
+@app.route('/clone_snapshot', methods=['POST'])
+def clone_snapshot():
+    data = request.get_json()
+    try:
+        storageMgr.cloneSnapshot(data.get("diskName"), data.get("snapshotName"), data.get("newDiskName"))
         return get_files()
     except Exception as e:
         return genResponse("", False, e.args[0])
@@ -76,7 +191,8 @@ def create_file():
     data = request.get_json()
     try:
         fileName: str = data.get("fileName")
-        storageMgr.createFile(fileName)
+        # 不给出时使用空间默认的压缩方式
+        storageMgr.createFile(fileName, data.get("compression"))
         return get_files()
     except Exception as e:
         return genResponse("", False, e.args[0])
@@ -154,6 +270,25 @@ def read_all():
         return genResponse("", False, e.args[0])
 
 
+# 读出文件的一段，用于分页查看大文件。段的边界可能切开多字节字符，无法解码的部分用替换字符表示
+@app.route("/read_range", methods=['POST'])
+def read_range():
+    data = request.get_json()
+    try:
+        filePath: str = data.get("filePath")
+        offset = int(data.get("offset", 0))
+        length = int(data.get("length", 0))
+        content, size = storageMgr.readRange(filePath, offset, length)
+        return genResponse({
+            "content": content.decode("utf-8", errors="replace"),
+            "offset": offset,
+            "length": len(content),
+            "size": size
+        })
+    except Exception as e:
+        return genResponse("", False, e.args[0])
+
+
 @app.route("/write_from_start", methods=['POST'])
 def write_from_start():
     data = request.get_json()
@@ -169,15 +304,27 @@ def write_from_start():
         return genResponse("", False, e.args[0])
 
 
+# 支持两种上传方式：multipart表单中的file字段；或者请求体就是文件内容，文件名放在fileName参数中。
+# 后一种直接从连接上分段读取，并用Content-Length预先分配空间
 @app.route("/upload", methods=['POST'])
 def upload():
-    if 'file' not in request.files:
-        return genResponse("", False, "没有文件被上传!")
-    file = request.files['file']
-    if file.filename == '':
+    if request.mimetype == "multipart/form-data":
+        if 'file' not in request.files:
+            return genResponse("", False, "没有文件被上传!")
+        file = request.files['file']
+        fileName = file.filename
+        stream = file.stream
+        sizeHint = file.content_length or -1
+    else:
+        fileName = request.args.get("fileName")
+        if fileName is None:
+            return genResponse("", False, "没有文件被上传!")
+        stream = request.stream
+        sizeHint = request.content_length or -1
+    if fileName == '':
         return genResponse("", False, "文件名不得为空!")
     try:
-        storageMgr.uploadNewFile(file.stream, file.filename)
+        storageMgr.uploadNewFile(stream, fileName, sizeHint)
         return get_files()
     except Exception as e:
         return genResponse("", False, e.args[0])
@@ -197,8 +344,19 @@ def main():
     return redirect("./dirview.html", code=302)
 
 
+# 启动后在后台预先挂载空间的线程数，0表示只在第一次访问时挂载
+PREWARM_WORKERS = int(os.environ.get("HBDK_PREWARM_WORKERS", "0"))
+# 为1时删除请求立即返回，文件占用的空间由后台线程回收
+DEFERRED_DELETE = os.environ.get("HBDK_DEFERRED_DELETE", "0") == "1"
+
+
+def prewarm(dm: DiskManager):
+    dm.disk.mount()
+    return dm.rootFolder
+
+
 if __name__ == '__main__':
-    # 加载所有hbdk空间文件
+    # 加载所有hbdk空间文件，这里只读取GDT和空间名
     dmList = []
 
     for f in os.listdir('.'):
@@ -210,5 +368,15 @@ if __name__ == '__main__':
             dm = DiskManager(disk)
             dmList.append(dm)
 
-    storageMgr = StorageManager(dmList)
-    app.run()
+    storageMgr = StorageManager(dmList, DEFERRED_DELETE)
+    if metrics.TRACE:
+        app.logger.setLevel(logging.INFO)
+    # 没有正常关闭的空间要重新统计空闲计数，不预热时也在后台挂载，统计完之前空闲块数报告为未知
+    prewarmList = dmList if PREWARM_WORKERS > 0 else [dm for dm in dmList if dm.disk.needsRecount]
+    if len(prewarmList) > 0:
+        prewarmPool = ThreadPoolExecutor(max_workers=max(1, PREWARM_WORKERS))
+        for dm in prewarmList:
+            prewarmPool.submit(prewarm, dm)
+        prewarmPool.shutdown(wait=False)
+    # 存储引擎已经加锁，可以多线程处理请求
+    app.run(threaded=True)
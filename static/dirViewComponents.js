@@ -211,9 +211,14 @@ class DiskItem extends HTMLElement {
         this.querySelector(".fileIcon").classList.add("fas","fa-hdd")
 
         this.diskNameDom.innerHTML = this.diskName
-        this.diskVolBarDom.style.width = (100-(this.blocksLeft/this.totalBlocks*100).toFixed(1))+"%"
-
-        this.diskVolInfoDom.innerHTML = genSizeStr((this.totalBlocks-this.blocksLeft)*2048)+"/"+genSizeStr(this.totalBlocks*2048)
+        if (this.blocksLeft === null) {
+            // 空间上次没有正常关闭，空闲块数还在重新统计
+            this.diskVolBarDom.style.width = "0%"
+            this.diskVolInfoDom.innerHTML = "统计中/"+genSizeStr(this.totalBlocks*2048)
+        } else {
+            this.diskVolBarDom.style.width = (100-(this.blocksLeft/this.totalBlocks*100).toFixed(1))+"%"
+            this.diskVolInfoDom.innerHTML = genSizeStr((this.totalBlocks-this.blocksLeft)*2048)+"/"+genSizeStr(this.totalBlocks*2048)
+        }
 
         let rb = this.querySelector(".renameButton")
         if (rb) {
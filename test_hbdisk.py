@@ -0,0 +1,339 @@
+import os
+import tempfile
+import unittest
+
+from hbdisk import COMPACT_MIN_DEAD_BYTES, INLINE_DATA_SIZE, HbDisk, HbFolder, iterSetBits
+
+
+def newDisk(**kwargs):
+    disk = HbDisk(4096, 256, "m", **kwargs)
+    return disk, HbFolder(disk, "/", disk.rootInode)
+
+
+def newFileDisk(workDir: str, **kwargs):
+    disk = HbDisk(4096, 256, "f", writer=open(os.path.join(workDir, "f.hbdk"), "xb+"), **kwargs)
+    return disk, HbFolder(disk, "/", disk.rootInode)
+
+
+# 正常关闭后重新打开
+def reopen(disk: HbDisk):
+    path = disk.file.name
+    disk.saveToDisk()
+    disk = HbDisk(fileSize=os.path.getsize(path), reader=open(path, "rb+"))
+    return disk, HbFolder(disk, "/", disk.rootInode)
+
+
+# 位图中已分配的块正好是各inode用到的块再加上快照冻结的块，空闲计数与位图一致
+def checkAccounting(test: unittest.TestCase, disk: HbDisk):
+    metaBlocks, dataBlocks = disk.collectBlocks(disk.findDirINodes())
+    used = set(iterSetBits(disk.blockBMHelper.getBitMap(), disk.dataBlockCount))
+    referenced = metaBlocks | dataBlocks
+    test.assertLessEqual(referenced, used)
+    test.assertEqual([i for i in used - referenced if not disk.isFrozen(i)], [])
+    test.assertEqual(disk.getBlocksLeft(), disk.dataBlockCount - len(used))
+    usedINodes = len(list(iterSetBits(disk.inodeBMHelper.getBitMap(), disk.inodeCount)))
+    test.assertEqual(disk.getINodesLeft(), disk.inodeCount - usedINodes)
+
+
+# 每块内容各不相同的数据
+def distinctBlocks(disk: HbDisk, count: int, seed: int = 1) -> bytes:
+    return b"".join(bytes([seed + i]) * disk.blockSize for i in range(count))
+
+
+class SparseFileTest(unittest.TestCase):
+    def testSizeLimit(self):
+        disk, root = newDisk(blockSize=1024)
+        file = root.createFile("a")
+        limit = disk.maxFileSize
+        self.assertEqual(limit, (11 + 128 + 128 ** 2 + 128 ** 3) * 1024)
+        with self.assertRaises(Exception):
+            file.seek(limit + 10 * 2 ** 20)
+        with self.assertRaises(Exception):
+            file.resize(2 * limit)
+        self.assertEqual(file.getSize(), 0)
+        file.seek(limit - 1)
+        file.write(b"x")
+        with self.assertRaises(Exception):
+            file.write(b"y")
+        self.assertEqual(file.getSize(), limit)
+        file.seek(limit - 1)
+        self.assertEqual(file.read(), b"x")
+        file.resize(0)
+        self.assertEqual(disk.dataBlockLeft, disk.dataBlockCount)
+
+    def testFarWriteCostsOnlyWrittenBlocks(self):
+        disk, root = newDisk()
+        file = root.createFile("a")
+        file.seek(30 * 2 ** 30)
+        file.write(b"x")
+        # 一个数据块加上三级间接指针用到的三个指针块
+        self.assertEqual(disk.dataBlockCount - disk.dataBlockLeft, 4)
+        self.assertLessEqual(len(file.inode.blockMap.chunks), 2)
+        file.seek(30 * 2 ** 30)
+        self.assertEqual(file.read(), b"x")
+        file.seek(12345678)
+        self.assertEqual(file.read(10), bytes(10))
+        file.resize(100000)
+        self.assertEqual(disk.dataBlockLeft, disk.dataBlockCount)
+        file.seek(0)
+        self.assertEqual(file.read(), bytes(100000))
+
+
+
+class DedupTest(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.workDir = self.tempDir.name
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def testSharedBlocksAcrossWriteDeleteAndReopen(self):
+        disk, root = newFileDisk(self.workDir, dedup=True)
+        emptyLeft = disk.getBlocksLeft()
+        content = distinctBlocks(disk, 8)
+        root.createFile("a").write(content)
+        root.createFile("b").write(content)
+        self.assertEqual(disk.getDedupStats()["sharedBlocks"], 8)
+        self.assertEqual(disk.getDedupStats()["savedBlocks"], 8)
+        self.assertEqual(emptyLeft - disk.getBlocksLeft(), 8)
+        checkAccounting(self, disk)
+        # 改共用的块时先复制，另一个文件不受影响
+        b = root.getFile("b")
+        b.seek(0)
+        b.write(b"z" * 10)
+        self.assertEqual(disk.getDedupStats()["sharedBlocks"], 7)
+        self.assertEqual(emptyLeft - disk.getBlocksLeft(), 9)
+        self.assertEqual(root.getFile("a").read(), content)
+        checkAccounting(self, disk)
+
+        disk, root = reopen(disk)
+        self.assertEqual(disk.getDedupStats()["sharedBlocks"], 7)
+        self.assertEqual(disk.getDedupStats()["savedBlocks"], 7)
+        self.assertEqual(root.getFile("a").read(), content)
+        self.assertEqual(root.getFile("b").read(), b"z" * 10 + content[10:])
+        checkAccounting(self, disk)
+        # 删掉一个文件只去掉引用，另一个文件仍然完整
+        root.deleteSubFile("a")
+        self.assertEqual(disk.getDedupStats()["sharedBlocks"], 0)
+        self.assertEqual(emptyLeft - disk.getBlocksLeft(), 8)
+        self.assertEqual(root.getFile("b").read(), b"z" * 10 + content[10:])
+        checkAccounting(self, disk)
+        # 同样的内容再写一次仍能找到已有的块
+        root.createFile("c").write(content[disk.blockSize:])
+        self.assertEqual(disk.getDedupStats()["savedBlocks"], 7)
+        root.deleteSubFile("b")
+        root.deleteSubFile("c")
+        self.assertEqual(disk.getBlocksLeft(), emptyLeft)
+        disk, root = reopen(disk)
+        self.assertEqual(disk.getBlocksLeft(), emptyLeft)
+        self.assertEqual(disk.getDedupStats()["savedBlocks"], 0)
+        checkAccounting(self, disk)
+        disk.saveToDisk()
+
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.workDir = self.tempDir.name
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def mountSnapshot(self, disk: HbDisk, snapshotName: str):
+        path = disk.getSnapshotPath(snapshotName)
+        snapshot = HbDisk(fileSize=os.path.getsize(path), reader=open(path, "rb"), journal=False,
+                          readOnly=True, baseDisk=disk)
+        return snapshot, HbFolder(snapshot, "/", snapshot.rootInode)
+
+    def testSnapshotLifecycle(self):
+        disk, root = newFileDisk(self.workDir)
+        emptyLeft = disk.getBlocksLeft()
+        old = distinctBlocks(disk, 6)
+        root.createFile("a").write(old)
+        root.createDir("dir")
+        root.getFile("dir").createFile("small").write(b"s" * 50)
+        disk.createSnapshot("s")
+        self.assertEqual(disk.listSnapshots(), ["s"])
+        # 冻结的块写时复制，旧内容留给快照
+        a = root.getFile("a")
+        a.seek(0)
+        a.write(distinctBlocks(disk, 2, 100))
+        root.createFile("b").write(distinctBlocks(disk, 3, 200))
+        checkAccounting(self, disk)
+
+        snapshot, snapshotRoot = self.mountSnapshot(disk, "s")
+        self.assertEqual(sorted(e.fileName for e in snapshotRoot.fileList), ["a", "dir"])
+        self.assertEqual(snapshotRoot.getFile("a").read(), old)
+        self.assertEqual(snapshotRoot.getFile("dir").getFile("small").read(), b"s" * 50)
+        with self.assertRaises(Exception):
+            snapshotRoot.createFile("x")
+        with self.assertRaises(Exception):
+            snapshotRoot.getFile("a").write(b"x")
+        snapshot.saveToDisk()
+
+        clonePath = os.path.join(self.workDir, "clone.hbdk")
+        disk.cloneSnapshot("s", clonePath)
+        clone = HbDisk(fileSize=os.path.getsize(clonePath), reader=open(clonePath, "rb+"))
+        clone.reclaimUnreferenced()
+        checkAccounting(self, clone)
+        self.assertEqual(clone.getBlocksLeft(), emptyLeft - 6)
+        clone, cloneRoot = reopen(clone)
+        self.assertEqual(cloneRoot.getFile("a").read(), old)
+        # 克隆出来的空间是独立的，修改不影响原空间和快照
+        cloneRoot.deleteSubFile("a")
+        checkAccounting(self, clone)
+        clone.saveToDisk()
+        snapshot, snapshotRoot = self.mountSnapshot(disk, "s")
+        self.assertEqual(snapshotRoot.getFile("a").read(), old)
+        snapshot.saveToDisk()
+
+        # 删除快照引用的文件时块还不能释放，删除快照后才回收
+        root.deleteSubFile("a")
+        checkAccounting(self, disk)
+        self.assertEqual(emptyLeft - disk.getBlocksLeft(), 3 + 6)
+        disk, root = reopen(disk)
+        checkAccounting(self, disk)
+        self.assertEqual(disk.listSnapshots(), ["s"])
+        disk.deleteSnapshot("s")
+        self.assertEqual(disk.listSnapshots(), [])
+        self.assertIsNone(disk.frozenBits)
+        self.assertEqual(emptyLeft - disk.getBlocksLeft(), 3)
+        checkAccounting(self, disk)
+        disk, root = reopen(disk)
+        self.assertEqual(emptyLeft - disk.getBlocksLeft(), 3)
+        self.assertEqual(root.getFile("b").read(), distinctBlocks(disk, 3, 200))
+        checkAccounting(self, disk)
+        disk.saveToDisk()
+
+
+
+class InlineTest(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.workDir = self.tempDir.name
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def checkTransitions(self, compression: str):
+        disk, root = newFileDisk(self.workDir, compression=compression)
+        emptyLeft = disk.getBlocksLeft()
+        file = root.createFile("a")
+        file.write(b"i" * INLINE_DATA_SIZE)
+        self.assertTrue(file.inode.isInline())
+        self.assertEqual(disk.getBlocksLeft(), emptyLeft)
+        # 多写一个字节就改用数据块，原来的内容保留
+        file.write(b"j")
+        self.assertFalse(file.inode.isInline())
+        self.assertEqual(emptyLeft - disk.getBlocksLeft(), 1)
+        file.seek(0)
+        self.assertEqual(file.read(), b"i" * INLINE_DATA_SIZE + b"j")
+        file.seek(0)
+        file.write(b"k" * 3 * disk.blockSize)
+        checkAccounting(self, disk)
+
+        disk, root = reopen(disk)
+        file = root.getFile("a")
+        self.assertFalse(file.inode.isInline())
+        self.assertEqual(file.read(), b"k" * 3 * disk.blockSize)
+        # 缩小到能放进inode时移回inode并释放所有块
+        file.resize(INLINE_DATA_SIZE - 2)
+        self.assertTrue(file.inode.isInline())
+        self.assertEqual(disk.getBlocksLeft(), emptyLeft)
+        checkAccounting(self, disk)
+        # 指针区域中文件尾之后的部分是0，再变大时读出来也是0
+        file.resize(INLINE_DATA_SIZE)
+        file.seek(0)
+        self.assertEqual(file.read(), b"k" * (INLINE_DATA_SIZE - 2) + bytes(2))
+
+        disk, root = reopen(disk)
+        file = root.getFile("a")
+        self.assertTrue(file.inode.isInline())
+        self.assertEqual(file.read(), b"k" * (INLINE_DATA_SIZE - 2) + bytes(2))
+        # 在内联文件后面留出空洞再写
+        file.seek(5 * disk.blockSize)
+        file.write(b"t")
+        # 压缩文件按簇存放，这两段可能压进同一个块
+        if compression == "":
+            self.assertEqual(emptyLeft - disk.getBlocksLeft(), 2)
+        file.seek(0)
+        self.assertEqual(file.read(),
+                         b"k" * (INLINE_DATA_SIZE - 2) + bytes(5 * disk.blockSize - INLINE_DATA_SIZE + 2) + b"t")
+        checkAccounting(self, disk)
+        root.deleteSubFile("a")
+        self.assertEqual(disk.getBlocksLeft(), emptyLeft)
+        disk, root = reopen(disk)
+        self.assertEqual(disk.getBlocksLeft(), emptyLeft)
+        self.assertEqual(disk.getINodesLeft(), disk.inodeCount - 1)
+        checkAccounting(self, disk)
+        disk.saveToDisk()
+
+    def testTransitions(self):
+        self.checkTransitions("")
+
+    def testCompressedTransitions(self):
+        self.checkTransitions("zlib")
+
+
+
+class DirTombstoneTest(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.workDir = self.tempDir.name
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def testTombstonesAndCompaction(self):
+        disk, root = newFileDisk(self.workDir)
+        emptyLeft = disk.getBlocksLeft()
+        root.createDir("dir")
+        folder = root.getFile("dir")
+        # 长文件名，墓碑积累得快一些
+        names = ["file%03d" % i + "-" * 40 for i in range(240)]
+        for name in names:
+            folder.createFile(name)
+        fullSize = folder.getSize()
+        # 删除和改变长度的改名只留下墓碑，目录文件不变小
+        folder.deleteSubFile(names[0])
+        folder.renameSubFile(names[1], "renamed01")
+        self.assertEqual(folder.inode.dirDeadBytes, 2 * (10 + 47))
+        self.assertEqual(folder.getSize(), fullSize + 10 + 9)
+        checkAccounting(self, disk)
+
+        disk, root = reopen(disk)
+        folder = root.getFile("dir")
+        self.assertEqual(folder.inode.dirDeadBytes, 2 * (10 + 47))
+        self.assertEqual(sorted(folder.entries), sorted([".", ".."] + names[2:] + ["renamed01"]))
+        # 墓碑超过COMPACT_MIN_DEAD_BYTES并且超过一半时整理
+        for name in names[2:230]:
+            folder.deleteSubFile(name)
+        self.assertLessEqual(folder.inode.dirDeadBytes, COMPACT_MIN_DEAD_BYTES)
+        self.assertLess(folder.getSize(), fullSize // 2)
+        remaining = sorted([".", ".."] + names[230:] + ["renamed01"])
+        self.assertEqual(sorted(folder.entries), remaining)
+        checkAccounting(self, disk)
+
+        disk, root = reopen(disk)
+        folder = root.getFile("dir")
+        self.assertEqual(sorted(folder.entries), remaining)
+        # 整理之后的位置正确，原地改名和再删除都写在对的目录项上
+        folder.renameSubFile(names[230], names[230].upper())
+        folder.deleteSubFile(names[239])
+        disk, root = reopen(disk)
+        folder = root.getFile("dir")
+        self.assertIn(names[230].upper(), folder.entries)
+        self.assertNotIn(names[230], folder.entries)
+        self.assertNotIn(names[239], folder.entries)
+        self.assertEqual(len(folder.entries), len(remaining) - 1)
+        checkAccounting(self, disk)
+        root.deleteSubFile("dir", recursive=True)
+        self.assertEqual(disk.getBlocksLeft(), emptyLeft)
+        self.assertEqual(disk.getINodesLeft(), disk.inodeCount - 1)
+        disk.saveToDisk()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,198 @@
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+
+import metrics
+from hbdisk import EXT_HEADER_PTR, HbDisk, HbFolder
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# 在子进程中操作空间文件，最后用os._exit模拟崩溃：不做检查点，也不正常关闭
+def runAndCrash(workDir: str, body: str, journalInterval: float = 0.01):
+    script = textwrap.dedent('''
+        import os, shutil, sys, time
+        sys.path.insert(0, %r)
+        from hbdisk import HbDisk, HbFolder
+        disk = HbDisk(4096, 256, "c", writer=open("c.hbdk", "xb+"), journalInterval=%r)
+        root = HbFolder(disk, "/", disk.rootInode)
+    ''' % (REPO_DIR, journalInterval)) + textwrap.dedent(body) + "\nos._exit(0)\n"
+    subprocess.run([sys.executable, "-c", script], cwd=workDir, check=True)
+
+
+def openDisk(workDir: str):
+    path = os.path.join(workDir, "c.hbdk")
+    return HbDisk(fileSize=os.path.getsize(path), reader=open(path, "rb+"))
+
+
+def remount(workDir: str):
+    disk = openDisk(workDir)
+    return disk, HbFolder(disk, "/", disk.rootInode)
+
+
+class JournalReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.workDir = self.tempDir.name
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def testReplayKeepsDataInFreedDirBlocks(self):
+        runAndCrash(self.workDir, '''
+            root.createDir("dir")
+            sub = root.getFile("dir")
+            for i in range(100):
+                sub.createFile("file%d" % i)
+            root.deleteSubFile("dir", recursive=True)
+            root.createFile("data").write(b"U" * 20000)
+            time.sleep(0.3)
+        ''')
+        self.assertTrue(os.path.getsize(os.path.join(self.workDir, "c.hbdk.journal")) > 0)
+        disk, root = remount(self.workDir)
+        self.assertEqual([e.fileName for e in root.fileList], ["data"])
+        self.assertEqual(root.getFile("data").read(), b"U" * 20000)
+        disk.saveToDisk()
+
+    def testReplayRestoresCommittedOperations(self):
+        runAndCrash(self.workDir, '''
+            for i in range(10):
+                root.createDir("dir%d" % i)
+                root.getFile("dir%d" % i).createFile("file").write(b"x" * (i * 1000))
+            root.deleteSubFile("dir3", recursive=True)
+            root.renameSubFile("dir4", "renamed")
+            time.sleep(0.3)
+        ''')
+        disk, root = remount(self.workDir)
+        names = sorted(e.fileName for e in root.fileList)
+        self.assertEqual(names, sorted(["dir%d" % i for i in range(10) if i not in (3, 4)] + ["renamed"]))
+        for i in range(10):
+            if i == 3:
+                continue
+            sub = root.getFile("renamed" if i == 4 else "dir%d" % i)
+            self.assertEqual(sub.getFile("file").read(), b"x" * (i * 1000))
+        disk.saveToDisk()
+
+    def testUncommittedMetadataStaysOutOfImage(self):
+        runAndCrash(self.workDir, '''
+            disk.checkpoint()
+            shutil.copy("c.hbdk", "before.hbdk")
+            for i in range(10):
+                root.createDir("dir%d" % i)
+                root.getFile("dir%d" % i).createFile("file").write(b"x" * (i * 1000))
+            root.deleteSubFile("dir3", recursive=True)
+        ''', journalInterval=60)
+        with open(os.path.join(self.workDir, "before.hbdk"), "rb") as f:
+            before = f.read()
+        disk, root = remount(self.workDir)
+        with open(os.path.join(self.workDir, "c.hbdk"), "rb") as f:
+            self.assertEqual(f.read(disk.dataTablePtr), before[:disk.dataTablePtr])
+        self.assertEqual(root.fileList, [])
+        self.assertEqual(disk.dataBlockLeft, disk.dataBlockCount)
+        disk.saveToDisk()
+
+    def testUncleanMountReclaimsPendingDeletes(self):
+        runAndCrash(self.workDir, '''
+            # 不启动后台回收，崩溃时目录项已经去掉但inode和块都还没回收
+            disk.deferDelete = lambda inodePtr, fileType: None
+            root.createDir("dir")
+            sub = root.getFile("dir")
+            for i in range(20):
+                sub.createFile("file%d" % i).write(b"y" * 5000)
+            root.createFile("big").write(b"z" * 100000)
+            root.createFile("kept").write(b"k" * 3000)
+            root.deleteSubFile("dir", recursive=True, deferred=True)
+            root.deleteSubFile("big", deferred=True)
+            time.sleep(0.3)
+        ''')
+        disk, root = remount(self.workDir)
+        disk.drainDeletes()
+        self.assertEqual([e.fileName for e in root.fileList], ["kept"])
+        self.assertEqual(root.getFile("kept").read(), b"k" * 3000)
+        self.assertEqual(disk.inodeLeft, disk.inodeCount - 2)
+        metaBlocks, dataBlocks = disk.collectBlocks()
+        self.assertEqual(disk.dataBlockCount - disk.dataBlockLeft, len(metaBlocks | dataBlocks))
+        disk.saveToDisk()
+
+    def testUncleanMountRecountsLazily(self):
+        runAndCrash(self.workDir, '''
+            root.createFile("file").write(b"w" * 10000)
+            time.sleep(0.3)
+        ''')
+        disk = openDisk(self.workDir)
+        self.assertFalse(disk.mounted)
+        self.assertIsNone(disk.getBlocksLeft())
+        # 没有挂载就关闭时也要先重新统计，之后才算正常关闭
+        disk.saveToDisk()
+        disk = openDisk(self.workDir)
+        self.assertFalse(disk.mounted)
+        self.assertEqual(disk.getBlocksLeft(), disk.dataBlockCount - math.ceil(10000 / disk.blockSize))
+        disk.saveToDisk()
+
+    def testMetricsSkipUnknownFreeCounts(self):
+        runAndCrash(self.workDir, '''
+            root.createFile("file").write(b"w" * 10000)
+            time.sleep(0.3)
+        ''')
+        metrics.enable()
+        self.addCleanup(metrics.disable)
+        disk = openDisk(self.workDir)
+        text = metrics.render([disk])
+        self.assertNotIn("hbdisk_free_blocks{", text)
+        self.assertNotIn("hbdisk_free_inodes{", text)
+        disk, root = remount(self.workDir)
+        root.createFile("other")
+        text = metrics.render([disk])
+        self.assertIn("hbdisk_free_blocks{disk=\"c\"} %d" % disk.dataBlockLeft, text)
+        self.assertIn("hbdisk_free_inodes{disk=\"c\"} %d" % (disk.inodeCount - 3), text)
+        self.assertIn("hbdisk_operation_seconds_total{disk=\"c\"} ", text)
+        self.assertNotIn("event=\"operationSeconds\"", text)
+        disk.saveToDisk()
+
+    def testCompressionCountersSurviveCrash(self):
+        runAndCrash(self.workDir, '''
+            text = b"".join(b"line %d\\n" % i for i in range(20000))
+            root.createFile("a", "zlib").write(text)
+            root.createFile("b", "zlib").write(text)
+            root.getFile("b").resize(30000)
+            time.sleep(0.3)
+        ''')
+        disk, root = remount(self.workDir)
+        stats = disk.getCompressionStats()
+        self.assertEqual(stats["logicalBytes"], root.getFile("a").getSize() + 30000)
+        self.assertGreater(stats["ratio"], 1)
+        disk.saveToDisk()
+
+    def testLegacyCompressionCountersCountedOnMount(self):
+        runAndCrash(self.workDir, '''
+            text = b"".join(b"line %d\\n" % i for i in range(20000))
+            root.createFile("a", "zlib").write(text)
+            disk.saveToDisk()
+        ''')
+        # 去掉计数有效的标记，相当于加入压缩计数之前的空间文件
+        with open(os.path.join(self.workDir, "c.hbdk"), "rb+") as f:
+            os.pwrite(f.fileno(), b"\0", EXT_HEADER_PTR + 8)
+        disk = openDisk(self.workDir)
+        stats = disk.getCompressionStats()
+        self.assertIsNone(stats["ratio"])
+        self.assertIsNone(stats["logicalBytes"])
+        # 取统计信息不能挂载空间
+        self.assertFalse(disk.mounted)
+        disk.mount()
+        root = HbFolder(disk, "/", disk.rootInode)
+        stats = disk.getCompressionStats()
+        self.assertEqual(stats["logicalBytes"], root.getFile("a").getSize())
+        self.assertGreater(stats["ratio"], 1)
+        disk.saveToDisk()
+        disk = openDisk(self.workDir)
+        self.assertEqual(disk.getCompressionStats()["logicalBytes"], stats["logicalBytes"])
+        self.assertEqual(disk.getCompressionStats()["ratio"], stats["ratio"])
+        disk.saveToDisk()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+import threading
+import unittest
+
+from hbdisk import HbDisk
+from manager import DiskManager, StorageManager
+
+
+# 上传用的流：读到一半时停下，等测试放行后再继续
+class SlowStream:
+    def __init__(self, chunks: int, chunkSize: int, failAt: int = -1):
+        self.chunks = chunks
+        self.chunkSize = chunkSize
+        self.failAt = failAt
+        self.sent = 0
+        self.halfway = threading.Event()
+        self.resume = threading.Event()
+
+    def read(self, n: int) -> bytes:
+        if self.sent == self.chunks // 2:
+            self.halfway.set()
+            self.resume.wait()
+        if self.sent == self.failAt:
+            raise Exception("连接中断。")
+        if self.sent >= self.chunks:
+            return b""
+        self.sent += 1
+        return bytes([self.sent % 256]) * min(n, self.chunkSize)
+
+
+class UploadTest(unittest.TestCase):
+    def setUp(self):
+        self.disk = HbDisk(4096, 256, "m", blockSize=1024)
+        self.storageMgr = StorageManager([DiskManager(self.disk)])
+        self.storageMgr.switchDisk("m")
+
+    def startUpload(self, stream, fileName="up"):
+        errors = []
+
+        def run():
+            try:
+                self.storageMgr.uploadNewFile(stream, fileName)
+            except Exception as e:
+                errors.append(e)
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        # 测试失败时也要放行，否则上传线程一直等着
+        self.addCleanup(stream.resume.set)
+        stream.halfway.wait()
+        return thread, errors
+
+    def testDeleteDuringUploadIsRejected(self):
+        stream = SlowStream(50, 65536)
+        thread, errors = self.startUpload(stream)
+        with self.assertRaises(Exception):
+            self.storageMgr.deleteFile("up")
+        with self.assertRaises(Exception):
+            self.storageMgr.renameFile("up", "other")
+        stream.resume.set()
+        thread.join()
+        self.assertEqual(errors, [])
+        size = [f["size"] for f in self.storageMgr.getFileList() if f["name"] == "up"]
+        self.assertEqual(size, [50 * 65536])
+        self.storageMgr.deleteFile("up")
+        self.assertEqual(self.disk.getBlocksLeft(), self.disk.dataBlockCount)
+
+    def testDeleteParentDuringUploadIsRejected(self):
+        self.storageMgr.createFolder("dir")
+        self.storageMgr.switchDir(["dir"])
+        stream = SlowStream(10, 65536)
+        thread, errors = self.startUpload(stream)
+        self.storageMgr.switchDir([])
+        with self.assertRaises(Exception):
+            self.storageMgr.deleteFolder("dir")
+        stream.resume.set()
+        thread.join()
+        self.assertEqual(errors, [])
+        self.storageMgr.deleteFolder("dir")
+        self.assertEqual(self.disk.getBlocksLeft(), self.disk.dataBlockCount)
+
+    def testFailedUploadIsRemoved(self):
+        stream = SlowStream(50, 65536, failAt=30)
+        stream.resume.set()
+        with self.assertRaises(Exception):
+            self.storageMgr.uploadNewFile(stream, "up")
+        self.assertEqual(self.storageMgr.getFileList(), [])
+        self.assertEqual(self.disk.getBlocksLeft(), self.disk.dataBlockCount)
+        self.assertEqual(self.disk.inodeLeft, self.disk.inodeCount - 1)
+        # 上传结束后同名文件可以正常删除
+        self.storageMgr.createFile("up")
+        self.storageMgr.deleteFile("up")
+
+
+
+class DentryCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.disk = HbDisk(4096, 256, "m", blockSize=1024)
+        self.diskMgr = DiskManager(self.disk)
+        self.diskMgr.createFolder("a")
+        self.diskMgr.gotoDir(["a"])
+        self.diskMgr.createFolder("b")
+        self.diskMgr.gotoDir(["a", "b"])
+        self.diskMgr.createFile("file").write(b"x" * 5000)
+        self.diskMgr.gotoDir([])
+
+    def getINodePtrs(self, dirs):
+        return [folder.inode.ptr for folder in self.diskMgr.resolveDir(tuple(dirs))]
+
+    def testRenameInvalidatesSubdirectories(self):
+        oldPtrs = self.getINodePtrs(["a", "b"])
+        self.assertIn(("a", "b"), self.diskMgr.dentryCache)
+        self.diskMgr.rename("a", "c")
+        self.assertNotIn(("a",), self.diskMgr.dentryCache)
+        self.assertNotIn(("a", "b"), self.diskMgr.dentryCache)
+        with self.assertRaises(Exception):
+            self.diskMgr.gotoDir(["a", "b"])
+        self.assertEqual(self.getINodePtrs(["c", "b"]), oldPtrs)
+        # 改成一个已经缓存过、后来被删掉的名字时也不能用到旧的缓存
+        self.diskMgr.createFolder("d")
+        self.getINodePtrs(["d"])
+        self.diskMgr.deleteFile("d", True)
+        self.diskMgr.rename("c", "d")
+        self.assertEqual(self.getINodePtrs(["d", "b"]), oldPtrs)
+        self.diskMgr.gotoDir(["d", "b"])
+        self.assertEqual(self.diskMgr.dirList[-1].getFile("file").read(), b"x" * 5000)
+
+    def testDeleteAndRecreateResolvesNewFolder(self):
+        oldPtrs = self.getINodePtrs(["a", "b"])
+        blocksLeft = self.disk.getBlocksLeft()
+        self.diskMgr.deleteFile("a", True)
+        self.assertEqual(len(self.diskMgr.dentryCache), 0)
+        self.assertGreater(self.disk.getBlocksLeft(), blocksLeft)
+        self.assertEqual(self.disk.getINodesLeft(), self.disk.inodeCount - 1)
+        with self.assertRaises(Exception):
+            self.diskMgr.gotoDir(["a", "b"])
+        # 先占掉一个inode，新的a不会恰好用回原来的inode
+        self.diskMgr.createFolder("x")
+        self.diskMgr.createFolder("a")
+        newPtrs = self.getINodePtrs(["a"])
+        self.assertNotEqual(newPtrs, oldPtrs[:2])
+        self.assertEqual(newPtrs[-1], self.diskMgr.rootFolder.findFileEntry("a").inodePtr)
+        with self.assertRaises(Exception):
+            self.diskMgr.gotoDir(["a", "b"])
+        # 同名的文件也不能被当成缓存中的目录
+        self.diskMgr.deleteFile("a", True)
+        self.diskMgr.createFile("a")
+        with self.assertRaises(Exception):
+            self.diskMgr.gotoDir(["a"])
+
+    def testCacheEvictionKeepsResolving(self):
+        diskMgr = DiskManager(self.disk, dentryCacheSize=2)
+        for name in ["p", "q", "r"]:
+            diskMgr.createFolder(name)
+            diskMgr.resolveDir((name,))
+        self.assertEqual(list(diskMgr.dentryCache), [("q",), ("r",)])
+        self.assertEqual(diskMgr.resolveDir(("p",))[-1].inode.ptr, diskMgr.rootFolder.findFileEntry("p").inodePtr)
+        self.assertEqual(list(diskMgr.dentryCache), [("r",), ("p",)])
+
+
+if __name__ == "__main__":
+    unittest.main()